@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+
+Sets `lineage_id` on models created before it was stored.
+
+The lineage of a model is the id of its first version: the model reached by
+following `prev_version` links until there are none. All versions of a model
+share it, so that `/models/{model_id}/versions` fetches them with one search
+instead of one get per version. Models without a lineage still work, through
+the previous version walk, until this backfill runs.
+
+```
+./scripts/backfill_model_lineage.py --es-host "localhost:9200" --dry-run
+./scripts/backfill_model_lineage.py --es-host "localhost:9200"
+```
+
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from elasticsearch import Elasticsearch, helpers
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from src.model_lineage import lineages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill model lineage ids")
+    parser.add_argument("--es-host", default="localhost:9200")
+    parser.add_argument("--index", default="models")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.es_host])
+
+    prev_versions = {}
+    current = {}
+    for hit in helpers.scan(es, index=args.index, _source=["prev_version", "lineage_id"]):
+        prev_versions[hit["_id"]] = hit["_source"].get("prev_version")
+        current[hit["_id"]] = hit["_source"].get("lineage_id")
+
+    updates = {
+        model_id: lineage_id
+        for model_id, lineage_id in lineages(prev_versions).items()
+        if current[model_id] != lineage_id
+    }
+    print(f"{len(updates)} of {len(prev_versions)} models need a lineage id")
+
+    if not args.dry_run:
+        helpers.bulk(es, (
+            {
+                "_op_type": "update",
+                "_index": args.index,
+                "_id": model_id,
+                "doc": {"lineage_id": lineage_id},
+            }
+            for model_id, lineage_id in updates.items()
+        ))
+        print("Done")
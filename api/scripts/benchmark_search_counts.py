@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+
+Latency comparison of the two ways listing endpoints (`/indicators`,
+`/models`) get a page of results and its total hit count:
+
+- search_count: an `es.search` followed by an `es.count` with the same query,
+  on every page (the previous search_and_scroll behavior).
+- track_total_hits: a single `es.search` with `track_total_hits`, as done by
+  src/pagination.py on first pages (continuations don't count at all).
+
+To run against a local instance:
+
+```
+./scripts/benchmark_search_counts.py --index indicators --runs 50
+```
+
+Or against a deployed one through an ssh tunnel (see hybrid_search.py):
+
+```
+./scripts/benchmark_search_counts.py --es-host "localhost:9201" -q "rainfall"
+```
+
+"""
+
+import argparse
+import statistics
+import time
+
+from elasticsearch import Elasticsearch
+
+
+def query_body(query):
+    if query:
+        return {"query": {"query_string": {"query": query}}}
+    return {"query": {"match_all": {}}}
+
+
+def search_count(es, index, body, size):
+    results = es.search(index=index, body=body, size=size)
+    count = es.count(index=index, body=body)
+    return len(results["hits"]["hits"]), count["count"]
+
+
+def track_total_hits(es, index, body, size):
+    results = es.search(index=index, body={**body, "track_total_hits": True}, size=size)
+    return len(results["hits"]["hits"]), results["hits"]["total"]["value"]
+
+
+def benchmark(mode, es, index, body, size, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        page, total = mode(es, index, body, size)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings, total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare hit count strategies")
+    parser.add_argument("--es-host", default="localhost:9200")
+    parser.add_argument("--index", default="indicators")
+    parser.add_argument("-q", "--query", default=None)
+    parser.add_argument("--size", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=30)
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.es_host])
+    body = query_body(args.query)
+
+    # warm up caches so that both modes start from the same state
+    for mode in (search_count, track_total_hits):
+        mode(es, args.index, body, args.size)
+
+    print(f"{'mode':>18} {'total':>8} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8}")
+    for mode in (search_count, track_total_hits):
+        timings, total = benchmark(mode, es, args.index, body, args.size, args.runs)
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        print(
+            f"{mode.__name__:>18} {total:>8} {statistics.median(timings):>8.1f} "
+            f"{p95:>8.1f} {statistics.mean(timings):>8.1f}"
+        )
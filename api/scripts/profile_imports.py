@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+
+Import-time profile of the API server, to keep startup regressions visible.
+
+Imports `server` (all routers) in a fresh interpreter with `python -X importtime`
+and reports the slowest modules by cumulative import time. Heavy models are
+loaded lazily by src/registry.py, so they should not show up here.
+
+From the api directory:
+
+```
+./scripts/profile_imports.py --top 25
+```
+
+Use `--max-seconds` in CI to fail when the total import time grows too much:
+
+```
+./scripts/profile_imports.py --max-seconds 10
+```
+
+"""
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent
+
+
+def profile(module):
+    """
+    Returns [(module, self_seconds, cumulative_seconds)] of every module
+    imported while importing `module`, parsed from -X importtime output.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=API_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        sys.exit(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+
+    timings = []
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append((name.rstrip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return timings
+
+
+def report(timings, top):
+    total = sum(self_seconds for _, self_seconds, _ in timings)
+    print(f"Imported {len(timings)} modules in {total:.2f}s\n")
+    print(f"{'cumulative':>10} {'self':>8}  module")
+    for name, self_seconds, cumulative in sorted(timings, key=lambda t: -t[2])[:top]:
+        print(f"{cumulative:>9.3f}s {self_seconds:>7.3f}s  {name}")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import-time profile of the API")
+    parser.add_argument("--module", default="server", help="Module to import")
+    parser.add_argument("--top", type=int, default=20, help="Modules to list")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="Exit with an error when importing takes longer")
+    args = parser.parse_args()
+
+    total = report(profile(args.module), args.top)
+
+    if args.max_seconds is not None and total > args.max_seconds:
+        sys.exit(f"\nImport time {total:.2f}s exceeds {args.max_seconds:.2f}s")
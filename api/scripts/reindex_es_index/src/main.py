@@ -1,6 +1,27 @@
+import argparse
+import json
+
 from elasticsearch import Elasticsearch
 
 
+def load_index_config(path):
+    """
+    Loads an index config (settings/mappings) json file, such as the ones in
+    api/es-mappings.
+    """
+    with open(path) as config_file:
+        return json.load(config_file)
+
+
+def requires_knn(index_config):
+    """Whether the mappings HNSW index a dense_vector field (Elasticsearch >= 8.8)."""
+    properties = index_config.get("mappings", {}).get("properties", {})
+    return any(
+        field.get("type") == "dense_vector" and field.get("index")
+        for field in properties.values()
+    )
+
+
 def create_and_reindex_index(es, index_name, version, new_index_config):
     """
     """
@@ -28,8 +49,19 @@ def create_and_reindex_index(es, index_name, version, new_index_config):
 
 
 if __name__ == "__main__":
-    index_name = "document_paragraphs" # Set your index here
-    current_version = 1                        # Set current version here
+    parser = argparse.ArgumentParser(description="Reindex an index into new mappings")
+    parser.add_argument("--index", default="document_paragraphs")
+    parser.add_argument("--version", type=int, default=1, help="current version of the index")
+    parser.add_argument(
+        "--config",
+        help="settings/mappings json file, such as ../../es-mappings/features_knn.json",
+    )
+    parser.add_argument("--es-host", default="localhost")
+    parser.add_argument("--es-port", type=int, default=9200)
+    args = parser.parse_args()
+
+    index_name = args.index
+    current_version = args.version
 
     # !WARNING! PLEASE READ
     # NOTE Set your new index settings/mappings here!
@@ -112,10 +144,22 @@ if __name__ == "__main__":
     #     }
     # }
 
-    es = Elasticsearch([{'host': 'localhost', 'port': 9200}],
+    # Or pass it with --config, e.g. the es-mappings/*_knn.json mappings of the
+    # features and document_paragraphs indices used by VECTOR_SEARCH_MODE=knn
+    if args.config:
+        new_index_config = load_index_config(args.config)
+
+    es = Elasticsearch([{'host': args.es_host, 'port': args.es_port}],
                        timeout=30,         # Adjust this as needed
                        max_retries=3       # Adjust this as needed
-                       )  # Update with your Elasticsearch connection details
+                       )
+
+    if requires_knn(new_index_config):
+        version = es.info()["version"]["number"]
+        if tuple(int(part) for part in version.split(".")[:2]) < (8, 8):
+            raise SystemExit(
+                f"These mappings need Elasticsearch >= 8.8, the cluster runs {version}"
+            )
 
     create_and_reindex_index(es, index_name, current_version, new_index_config)
 
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+
+Reindexes the `runs` index into the current es-mappings/runs.json mapping.
+
+Runs indices created before run parameters were mapped as nested (with a
+`wildcard` value field) and `created_at` as long are searched by `/runs`
+through a slower fallback: parameter filters are applied in python, one page
+at a time. This copies every run into a new index with the current mapping,
+then points the `runs` alias at it, replacing the old index.
+
+```
+./scripts/reindex_runs.py --es-host "localhost:9200" --dry-run
+./scripts/reindex_runs.py --es-host "localhost:9200"
+```
+
+The old index is only removed once every run was copied. When `runs` is an
+index rather than an alias, it is deleted before the alias is created:
+`/runs` requests fail for that moment.
+
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+from elasticsearch import Elasticsearch
+
+MAPPING_PATH = Path(__file__).resolve().parent.parent / "es-mappings" / "runs.json"
+
+
+def current_index(es, name):
+    """Index behind `name`, and whether `name` is an alias."""
+    if es.indices.exists_alias(name=name):
+        return next(iter(es.indices.get_alias(name=name))), True
+    return name, False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reindex runs into the current mapping")
+    parser.add_argument("--es-host", default="localhost:9200")
+    parser.add_argument("--alias", default="runs")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    es = Elasticsearch([args.es_host], timeout=300)
+
+    source, is_alias = current_index(es, args.alias)
+    target = f"{args.alias}-{time.strftime('%Y%m%d%H%M%S')}"
+    count = es.count(index=source)["count"]
+    print(f"{count} runs to copy from {source} to {target}")
+    if args.dry_run:
+        raise SystemExit(0)
+
+    with open(MAPPING_PATH) as mapping_file:
+        es.indices.create(index=target, body=json.load(mapping_file))
+    # created_at strings are coerced to longs by the new mapping
+    es.reindex(body={"source": {"index": source}, "dest": {"index": target}}, wait_for_completion=True)
+    es.indices.refresh(index=target)
+
+    copied = es.count(index=target)["count"]
+    if copied != count:
+        raise SystemExit(f"Only {copied} of {count} runs were copied, {source} is left as is")
+
+    if is_alias:
+        es.indices.update_aliases(body={"actions": [
+            {"remove": {"index": source, "alias": args.alias}},
+            {"add": {"index": target, "alias": args.alias}},
+        ]})
+        es.indices.delete(index=source)
+    else:
+        es.indices.delete(index=source)
+        es.indices.put_alias(index=target, name=args.alias)
+    print(f"{args.alias} now points to {target}")
@@ -1,7 +1,7 @@
 import logging
 
 import uvicorn
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
 from fastapi import FastAPI, exceptions
 from fastapi.responses import JSONResponse
 from pydantic import ValidationError
@@ -21,6 +21,7 @@ from src import (
     knowledge
 )
 from src.settings import settings
+from src.vector_search import dense_vector_mapping
 
 logger = logging.getLogger(__name__)
 
@@ -149,6 +150,7 @@ def setup_elasticsearch_indexes():
                         "type": "text",
                         "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
                     },
+                    "file_extension": {"type": "keyword"},
                     "outputs": {"type": "nested"},
                     "period": {
                         "properties": {"gte": {"type": "long"}, "lte": {"type": "long"}}
@@ -166,16 +168,50 @@ def setup_elasticsearch_indexes():
                 }
             }
         },
-        "models": {},
+        "models": {
+            "mappings": {
+                "properties": {
+                    # Shared by every version of a model, see model_versions
+                    "lineage_id": {
+                        "type": "text",
+                        "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+                    },
+                }
+            }
+        },
         "outputfiles": {},
-        "runs": {},
+        "runs": {
+            "mappings": {
+                "properties": {
+                    "created_at": {"type": "long"},
+                    # Nested, so that run parameter filters match a name and value pair
+                    "parameters": {
+                        "type": "nested",
+                        "properties": {
+                            "name": {
+                                "type": "text",
+                                "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+                            },
+                            "value": {
+                                "type": "text",
+                                "fields": {
+                                    "keyword": {"type": "keyword", "ignore_above": 256},
+                                    # Substring filters on values of any length
+                                    "wildcard": {"type": "wildcard"},
+                                    "numeric": {"type": "double", "ignore_malformed": True},
+                                    "date": {"type": "date", "ignore_malformed": True},
+                                },
+                            },
+                        },
+                    },
+                }
+            }
+        },
         "features": {
             "mappings": {
                 "properties": {
-                    "embeddings": {
-                        "type": "dense_vector",
-                        "dims": 1536
-                    }
+                    "embeddings": dense_vector_mapping(),
+                    "description_hash": {"type": "keyword"}
                 }
             }
         },
@@ -221,10 +257,7 @@ def setup_elasticsearch_indexes():
         "document_paragraphs": {
             "mappings": {
                 "properties": {
-                    "embeddings": {
-                        "type": "dense_vector",
-                        "dims": 1536
-                    },
+                    "embeddings": dense_vector_mapping(),
                     "length": {
                         "type": "short"
                     },
@@ -248,7 +281,7 @@ def setup_elasticsearch_indexes():
             }
         }
     }
-    es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+    es = get_es()
 
     for idx, config in indices.items():
         if not es.indices.exists(index=idx):
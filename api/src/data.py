@@ -14,6 +14,7 @@ from redis import Redis
 from rq.exceptions import NoSuchJobError
 import boto3
 
+from src.embedding_cache import EmbeddingCache
 from src.utils import get_rawfile, put_rawfile
 from src.settings import settings
 
@@ -30,6 +31,9 @@ redis = Redis(
 )
 q = Queue(connection=redis, default_timeout=-1)
 
+# Text embeddings cache shared by the embedders of this process
+embedding_cache = EmbeddingCache.from_settings(settings, redis)
+
 # S3 OBJECT
 s3 = boto3.resource("s3")
 
@@ -4,12 +4,12 @@ import uuid
 from fastapi import APIRouter, HTTPException, status, Response
 from fastapi.logger import logger
 from fastapi.responses import JSONResponse
-from elasticsearch import Elasticsearch, exceptions
-from src.settings import settings
+from elasticsearch import exceptions
+from src.elasticsearch_client import get_es
 from validation.DataModelingSchema import DataModeling
 
 router = APIRouter()
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+es = get_es()
 
 # For created_at times in epoch milliseconds
 def current_milli_time():
@@ -7,12 +7,12 @@
 import logging
 import requests
 from uuid import UUID
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
 from elasticsearch.exceptions import NotFoundError
 
 from src.settings import settings
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+es = get_es()
 
 logger: logging.Logger = logging.getLogger(__name__)
 
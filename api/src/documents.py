@@ -4,7 +4,7 @@ import time
 import re
 import uuid
 from typing import List, Optional
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
 from elasticsearch.exceptions import RequestError, NotFoundError
 from fastapi import (
     APIRouter,
@@ -24,22 +24,22 @@ import requests
 from validation import DocumentSchema
 from src.settings import settings
 
-from src.utils import put_rawfile, get_rawfile
+from src.utils import put_rawfile, stream_rawfile
 from src.urls import clean_and_decode_str
 
 from rq import Queue
 from redis import Redis
 from pydantic import BaseModel
-from jatarag.embedder import AdaEmbedder
-from src.semantic_highlighter import highlighter
+from src.vector_search import cosine_script_score, knn_clause, knn_enabled, knn_search
+from src.pagination import search_page
+from src.registry import embedder, highlighter
 
 
 PARAGRAPHS_INDEX = "document_paragraphs"
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
-embedder = AdaEmbedder()
+es = get_es()
 
 # REDIS CONNECTION AND QUEUE OBJECTS
 redis = Redis(
@@ -69,30 +69,20 @@ def list_paragraphs(scroll_id: Optional[str] = None, size: int = 10):
     pagination to 10 items per page (size).
     """
 
-    q = {
-        "query": {
-            "match_all": {}
-        },
-        "_source": {
-            "excludes": ["embeddings"]
+    def list_query():
+        return {
+            "query": {
+                "match_all": {}
+            },
+            "_source": {
+                "excludes": ["embeddings"]
+            }
         }
-    }
 
-    if not scroll_id:
-        results = es.search(index=PARAGRAPHS_INDEX,
-                            body=q,
-                            scroll="2m",
-                            size=size)
-    else:
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
+    results, scroll_id = search_page(es, PARAGRAPHS_INDEX, size, scroll_id, list_query, {})
 
     totalDocsInPage = len(results["hits"]["hits"])
 
-    if totalDocsInPage < size:
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
-
     return {
         "hits": results["hits"]["total"]["value"],
         "items_in_page": totalDocsInPage,
@@ -126,6 +116,39 @@ def semantic_highlight_paragraphs(payload: HighlightData):
     }
 
 
+MIN_TEXT_LENGTH_THRESHOLD = 50
+
+
+def paragraph_length_filter():
+    return [
+        {
+            "range": {
+                "length": {
+                    "gte": MIN_TEXT_LENGTH_THRESHOLD
+                }
+            }
+        }
+    ]
+
+
+def semantic_paragraphs_query(query):
+    # Retrieve first item in output, since it accepts an array and returns
+    # an array, and we provided only one item (query)
+    query_embedding = embedder.embed_paragraphs([query])[0]
+
+    return {
+        "query": {
+            "bool": {
+                "must": [cosine_script_score(query_embedding)],
+                "filter": paragraph_length_filter()
+            }
+        },
+        "_source": {
+            "excludes": ["embeddings"]
+        }
+    }
+
+
 @router.get(
     "/paragraphs/search", response_model=DocumentSchema.ParagraphSearchResponse
 )
@@ -142,55 +165,25 @@ def semantic_search_paragraphs(query: str,
 
     clean_query = clean_and_decode_str(query)
 
-    if scroll_id:
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
-    else:
+    results = None
+    if knn_enabled() and not scroll_id:
         # Retrieve first item in output, since it accepts an array and returns
         # an array, and we provided only one item (query)
         query_embedding = embedder.embed_paragraphs([clean_query])[0]
-
-        MIN_TEXT_LENGTH_THRESHOLD = 50
-
-        p_query = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {
-                            "script_score": {
-                                "query": {"match_all": {}},
-                                "script": {
-                                    # ES doesnt allow negative numbers. We can either:
-                                    # - a) clamp at 0, and not allow negatives, or
-                                    # - b) Add 1 to the result to compare score
-                                    # We use option (a): it has better score % for top results
-                                    "source": "Math.max(cosineSimilarity(params.query_vector, 'embeddings'), 0)",
-                                    "params": {
-                                        "query_vector": query_embedding
-                                    }
-                                }
-                            }
-                        }
-                    ],
-                    "filter": [
-                        {
-                            "range": {
-                                "length": {
-                                    "gte": MIN_TEXT_LENGTH_THRESHOLD
-                                }
-                            }
-                        }
-                    ]
-                }
-            },
+        knn_query = {
+            "knn": knn_clause(query_embedding, size, filter=paragraph_length_filter()),
             "_source": {
                 "excludes": ["embeddings"]
             }
         }
-
-        results = es.search(index=PARAGRAPHS_INDEX,
-                            body=p_query,
-                            scroll="2m",
-                            size=size)
+        # Approximate nearest neighbors are a single page of results
+        results = knn_search(es, PARAGRAPHS_INDEX, knn_query)
+    if results is None:
+        results, scroll_id = search_page(
+            es, PARAGRAPHS_INDEX, size, scroll_id, semantic_paragraphs_query, {"query": clean_query}
+        )
+    else:
+        scroll_id = None
 
     hits = results["hits"]["hits"]
 
@@ -200,11 +193,6 @@ def semantic_search_paragraphs(query: str,
 
     result_len = len(hits)
 
-    if result_len < size:
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
-
     max_score = results["hits"]["max_score"]
 
     def formatOneResult(r, index):
@@ -290,31 +278,24 @@ def latest_documents(scroll_id: Optional[str] = None, size: int = 10):
     """
     """
 
-    q = {
-        "query": {
-            "match_all": {}
-        },
-        "sort": [
-            {
-                "uploaded_at": {
-                    "order": "desc"
+    def latest_query():
+        return {
+            "query": {
+                "match_all": {}
+            },
+            "sort": [
+                {
+                    "uploaded_at": {
+                        "order": "desc"
+                    }
                 }
-            }
-        ]
-    }
+            ]
+        }
 
-    if not scroll_id:
-        results = es.search(index="documents", body=q, scroll="2m", size=size)
-    else:
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
+    results, scroll_id = search_page(es, "documents", size, scroll_id, latest_query, {})
 
     totalDocsInPage = len(results["hits"]["hits"])
 
-    if totalDocsInPage < size:
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
-
     return {
         "hits": results["hits"]["total"]["value"],
         "items_in_page": totalDocsInPage,
@@ -348,34 +329,29 @@ def list_documents(
     if sort_by in ["title", "publisher"]:
         sort_by += ".lowersortable"
 
-    q = {
-        "query": {
-            "match_all": {}
-        },
-        "sort": [
-            {
-                sort_by: {
-                    "order": order
+    def list_query(sort_by, order):
+        return {
+            "query": {
+                "match_all": {}
+            },
+            "sort": [
+                {
+                    sort_by: {
+                        "order": order
+                    }
                 }
-            }
-        ]
-    }
+            ]
+        }
 
     try:
-        if not scroll_id:
-            results = es.search(index="documents", body=q, scroll="2m", size=size)
-        else:
-            results = es.scroll(scroll_id=scroll_id, scroll="2m")
+        results, scroll_id = search_page(
+            es, "documents", size, scroll_id, list_query, {"sort_by": sort_by, "order": order}
+        )
     except RequestError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     totalDocsInPage = len(results["hits"]["hits"])
 
-    if totalDocsInPage < size:
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
-
     return {
         "hits": results["hits"]["total"]["value"],
         "items_in_page": totalDocsInPage,
@@ -396,20 +372,17 @@ def search_documents(
         size: int = 10,
 ):
 
-    if scroll_id:
-        documents = es.scroll(scroll_id=scroll_id, scroll="2m")
-    else:
-
-        if order not in ["asc", "desc"]:
-            raise HTTPException(status_code=400, detail="Invalid sort order. Must be either 'asc' or 'desc'")
+    if order not in ["asc", "desc"]:
+        raise HTTPException(status_code=400, detail="Invalid sort order. Must be either 'asc' or 'desc'")
 
-        if sort_by in ["type", "description", "original_language", "classification", "producer", "stated_genre"]:
-            sort_by += ".keyword"
+    if sort_by in ["type", "description", "original_language", "classification", "producer", "stated_genre"]:
+        sort_by += ".keyword"
 
-        if sort_by in ["title", "publisher"]:
-            sort_by += ".lowersortable"
+    if sort_by in ["title", "publisher"]:
+        sort_by += ".lowersortable"
 
-        q = {
+    def search_query(query, sort_by, order):
+        return {
             "query": {
                 "bool": {
                     "should": [
@@ -441,15 +414,13 @@ def search_documents(
             ]
         }
 
-        documents = es.search(index="documents", body=q, size=size, scroll="2m")
+    documents, scroll_id = search_page(
+        es, "documents", size, scroll_id, search_query,
+        {"query": query, "sort_by": sort_by, "order": order}
+    )
 
     totalDocsInPage = len(documents["hits"]["hits"])
 
-    if totalDocsInPage < size:
-        scroll_id = None
-    else:
-        scroll_id = documents.get("_scroll_id", None)
-
     return {
         "hits": documents["hits"]["total"]["value"],
         "items_in_page": totalDocsInPage,
@@ -468,36 +439,35 @@ def get_document_text(document_id: str,
     Returns a document's text, where each entry is a paragraph. Paragraphs are
     defined as any extracted text within the document ending with a newline.
     """
-    if not scroll_id:
-        try:
-            q = {
-                "query": {
-                    "match": {"document_id.keyword": document_id}
-                },
-                "sort": [
-                    {
-                        "index": {
-                            "order": "asc"
-                        }
+    def paragraphs_query(document_id):
+        return {
+            "query": {
+                "match": {"document_id.keyword": document_id}
+            },
+            "sort": [
+                {
+                    "index": {
+                        "order": "asc"
                     }
-                ],
-                "_source": {"excludes": ["embeddings"]}
-            }
-            # Get all the paragraphs for the document, ordered by indexed order
-            #  (should follow paragraph order).
-            paragraphs = es.search(index=PARAGRAPHS_INDEX, body=q, size=size, scroll="2m")
-        except Exception as e:
-            logger.exception(e)
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
-    else:
-        paragraphs = es.scroll(scroll_id=scroll_id, scroll="2m")
+                }
+            ],
+            "_source": {"excludes": ["embeddings"]}
+        }
 
-    totalDocsInPage = len(paragraphs["hits"]["hits"])
+    try:
+        # Get all the paragraphs for the document, ordered by indexed order
+        #  (should follow paragraph order).
+        paragraphs, scroll_id = search_page(
+            es, PARAGRAPHS_INDEX, size, scroll_id, paragraphs_query, {"document_id": document_id}
+        )
+    except HTTPException:
+        # Invalid pagination cursors
+        raise
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
-    if totalDocsInPage < size:
-        scroll_id = None
-    else:
-        scroll_id = paragraphs.get("_scroll_id", None)
+    totalDocsInPage = len(paragraphs["hits"]["hits"])
 
     return {
         "hits": paragraphs["hits"]["total"]["value"],
@@ -684,7 +654,7 @@ def upload_file(
 
 
 @router.get("/documents/{document_id}/file")
-def get_document_uploaded_file(document_id: str):
+def get_document_uploaded_file(document_id: str, request: Request):
     """
     Downloads the original file (PDF) of an uploaded document.
     """
@@ -701,11 +671,14 @@ def get_document_uploaded_file(document_id: str):
             content=json.dumps({"error": "Document has no uploaded source file."})
         )
 
-    file = get_rawfile(path=s3_url)
-
     headers = {'Content-Disposition': f'inline; filename="{file_name}"'}
 
     try:
-        return Response(content=file.read(), media_type="application/pdf", headers=headers)
+        return stream_rawfile(
+            s3_url,
+            range_header=request.headers.get("range"),
+            media_type="application/pdf",
+            headers=headers,
+        )
     except FileNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
@@ -1,11 +1,14 @@
 import os
 import io
+import json
 import requests
 import uuid
 
-from typing import List
+from typing import Dict, List
 
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
+from src.pagination import search_page
+from elasticsearch import helpers
 from elasticsearch.exceptions import NotFoundError
 
 from fastapi import APIRouter, Response, status, Request, HTTPException
@@ -18,6 +21,7 @@ from src.utils import (
     get_rawfile,
     stream_csv_from_data_paths,
     compress_stream,
+    wide_format_cache_path,
 )
 import logging
 
@@ -25,7 +29,7 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+es = get_es()
 
 
 def search_by_model(model_id):
@@ -63,7 +67,7 @@ def search_for_config(model_id, path):
     return q
 
 
-def search_and_scroll(index, query=None, size=10, scroll_id=None):
+def query_string_body(query=None, source=None):
     if query:
         q = {
             "query": {
@@ -74,23 +78,22 @@ def search_and_scroll(index, query=None, size=10, scroll_id=None):
         }
     else:
         q = {"query": {"match_all": {}}}
-    if not scroll_id:
-        # we need to kick off the query
-        results = es.search(index=index, body=q, scroll="2m", size=size)
-    else:
-        # otherwise, we can use the scroll
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
+    if source:
+        q["_source"] = source
+    return q
 
-    # get count
-    count = es.count(index=index, body=q)
 
-    # if results are less than the page size (10) don't return a scroll_id
-    if len(results["hits"]["hits"]) < size:
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
+def search_and_scroll(index, query=None, size=10, scroll_id=None, source=None):
+    """
+    `source` is an optional ES `_source` filter ({"includes": [...],
+    "excludes": [...]}), applied to every page.
+    """
+    results, scroll_id = search_page(
+        es, index, size, scroll_id, query_string_body, {"query": query, "source": source}
+    )
+
     return {
-        "hits": count["count"],
+        "hits": results["hits"]["total"]["value"],
         "scroll_id": scroll_id,
         "results": [i["_source"] for i in results["hits"]["hits"]],
     }
@@ -153,20 +156,6 @@ def get_directive(model_id: str) -> DojoSchema.ModelDirective:
         )
 
 
-def copy_directive(model_id: str, new_model_id: str):
-    """
-    Copy the directive from one model_id to a new_model_id
-    """
-    directive = get_directive(model_id)
-    if type(directive) == Response:
-        return False
-    directive["id"] = str(uuid.uuid4())
-    directive["model_id"] = new_model_id
-
-    d = DojoSchema.ModelDirective(**directive)
-    create_directive(d)
-
-
 def get_config_path(model_id, path):
     return f"{settings.CONFIG_STORAGE_BASE}{model_id}{path}"
 
@@ -251,32 +240,6 @@ def delete_config(model_id: str, path: str):
     )
 
 
-def copy_configs(model_id: str, new_model_id: str):
-    """
-    Copy config files for one model_id to a new_model_id
-    """
-    configs = get_configs(model_id)
-    if type(configs) == Response:
-        return False
-    config_create_request = []
-
-    for config in configs:
-        content = (
-            get_rawfile(get_config_path(config["model_id"], config["path"]))
-            .read()
-            .decode()
-        )
-        config["id"] = str(uuid.uuid4())
-        config["model_id"] = new_model_id
-
-        config_data = DojoSchema.ModelConfigCreate(
-            model_config=DojoSchema.ModelConfig(**config), file_content=content
-        )
-        config_create_request.append(config_data)
-
-    create_configs(config_create_request)
-
-
 @router.get("/dojo/parameters/{model_id}")
 def get_parameters(model_id: str) -> List[DojoSchema.Parameter]:
     config_params = [
@@ -359,30 +322,6 @@ def delete_outputfile(outputfile_id: str):
         )
 
 
-def copy_outputfiles(model_id: str, new_model_id: str):
-    """
-    Copy outputfiles for a single model_id to a new_model_id
-    """
-    outputfiles = get_outputfiles(model_id)
-    if type(outputfiles) == Response:
-        return False
-    model_outputs = []
-    changed_uuids = {}
-
-    for outputfile_dict in outputfiles:
-        old_id = outputfile_dict["id"]
-        outputfile_dict["id"] = str(uuid.uuid4())
-        changed_uuids[old_id] = outputfile_dict["id"]
-        outputfile_dict["model_id"] = new_model_id
-        outputfile_dict["prev_id"] = old_id
-
-        model_output_obj = DojoSchema.ModelOutputFile(**outputfile_dict)
-        model_outputs.append(model_output_obj)
-
-    create_outputfiles(model_outputs)
-    return changed_uuids
-
-
 ### Accessories Endpoints
 
 
@@ -500,25 +439,83 @@ def delete_accessory(accessory_id: str):
         )
 
 
-def copy_accessory_files(model_id: str, new_model_id: str):
-    """
-    Copy the accessory_files from one model_id to a new_model_id
-    """
+### Model versioning
 
-    a_files = get_accessory_files(model_id)
 
-    if type(a_files) == Response:
-        return False
+# Indices of the documents cloned with a model, by the model they belong to
+MODEL_ARTIFACT_INDICES = ["directives", "configs", "outputfiles", "accessories"]
 
-    model_accessories = []
 
-    for f in a_files:
-        f["id"] = str(uuid.uuid4())
-        f["model_id"] = new_model_id
-        ma = DojoSchema.ModelAccessory(**f)
-        model_accessories.append(ma)
+def clone_model_artifacts(model_id: str, new_model_id: str) -> Dict[str, str]:
+    """
+    Copies the directive, configs (and their files), outputfiles and accessory
+    files of `model_id` to `new_model_id`. Documents are read with a single
+    msearch and written with a single bulk request.
 
-    create_accessory_files(model_accessories)
+    Returns the new outputfile id of each original outputfile id.
+    """
+    searches = []
+    for index in MODEL_ARTIFACT_INDICES:
+        searches += [{"index": index}, {**search_by_model(model_id), "size": 10000}]
+    found = {}
+    for index, response in zip(MODEL_ARTIFACT_INDICES, es.msearch(body=searches)["responses"]):
+        error = response.get("error")
+        if error and error.get("type") != "index_not_found_exception":
+            raise RuntimeError(f"Failed to read {index} of model {model_id}: {error}")
+        found[index] = [hit["_source"] for hit in response.get("hits", {}).get("hits", [])]
+
+    documents = []
+
+    # A model has a single directive, the last one indexed is used
+    if found["directives"]:
+        directive = found["directives"][-1]
+        directive["id"] = str(uuid.uuid4())
+        directive["model_id"] = new_model_id
+        documents.append(("directives", new_model_id, DojoSchema.ModelDirective(**directive)))
+
+    for config in found["configs"]:
+        content = get_rawfile(get_config_path(model_id, config["path"])).read()
+        put_rawfile(get_config_path(new_model_id, config["path"]), io.BytesIO(content))
+        config["id"] = str(uuid.uuid4())
+        config["model_id"] = new_model_id
+        documents.append(("configs", None, DojoSchema.ModelConfig(**config)))
+
+    outputfile_ids = {}
+    for outputfile in found["outputfiles"]:
+        old_id = outputfile["id"]
+        outputfile["id"] = outputfile_ids[old_id] = str(uuid.uuid4())
+        outputfile["model_id"] = new_model_id
+        outputfile["prev_id"] = old_id
+        documents.append(("outputfiles", outputfile["id"], DojoSchema.ModelOutputFile(**outputfile)))
+
+    for accessory in found["accessories"]:
+        accessory["id"] = str(uuid.uuid4())
+        accessory["model_id"] = new_model_id
+        documents.append(("accessories", accessory["id"], DojoSchema.ModelAccessory(**accessory)))
+
+    actions = []
+    for index, doc_id, document in documents:
+        action = {"_index": index, "_source": json.loads(document.json())}
+        if doc_id:
+            action["_id"] = doc_id
+        actions.append(action)
+    if actions:
+        helpers.bulk(es, actions)
+
+    return outputfile_ids
+
+
+def delete_model_artifacts(model_id: str):
+    """Deletes every document cloned by clone_model_artifacts for `model_id`."""
+    # Make documents indexed by a failed clone visible to delete_by_query
+    es.indices.refresh(index=MODEL_ARTIFACT_INDICES, ignore_unavailable=True)
+    es.delete_by_query(
+        index=MODEL_ARTIFACT_INDICES,
+        body=search_by_model(model_id),
+        conflicts="proceed",
+        ignore_unavailable=True,
+        refresh=True,
+    )
 
 
 @router.get("/dojo/domains", response_model=List[str])
@@ -567,15 +564,22 @@ def get_csv(index: str, obj_id: str, request: Request, wide_format: str = "false
 
     run_status = run.get("attributes", {}).get("status", None)
 
+    cache_path = None
+    if wide_format == "true":
+        cache_path = wide_format_cache_path(index, obj_id, run["data_paths"])
+    content = stream_csv_from_data_paths(
+        run["data_paths"], wide_format, cache_path=cache_path
+    )
+
     if "deflate" in request.headers.get("accept-encoding", ""):
         return StreamingResponse(
-            compress_stream(stream_csv_from_data_paths(run["data_paths"], wide_format)),
+            compress_stream(content),
             media_type="text/csv",
             headers={"Content-Encoding": "deflate"},
         )
     else:
         return StreamingResponse(
-            stream_csv_from_data_paths(run["data_paths"], wide_format),
+            content,
             media_type="text/csv",
         )
 
@@ -0,0 +1,107 @@
+"""
+Elasticsearch client shared by every API module.
+
+One client means one connection pool: keep-alive connections are reused
+across routers instead of each module churning through its own pool. Requests
+are timed per endpoint, see `/healthcheck/elasticsearch`.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+from elasticsearch import Elasticsearch, Transport
+
+from src.settings import settings
+
+
+# Path parts followed by a document or scroll id
+ID_PATH_PARTS = {"_doc", "_create", "_update", "_source", "_explain", "_termvectors", "scroll"}
+
+
+class RequestMetrics:
+    """Request count, errors and latency per Elasticsearch endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = defaultdict(
+            lambda: {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        )
+
+    @staticmethod
+    def endpoint(method: str, url: str) -> str:
+        """
+        Groups urls by API endpoint: document ids and scroll ids in the path
+        are replaced, index names and `_api` parts are kept.
+        """
+        parts = [part for part in url.split("?")[0].split("/") if part]
+        path = [
+            "{id}" if index > 0 and parts[index - 1] in ID_PATH_PARTS else part
+            for index, part in enumerate(parts)
+        ]
+        return f"{method} /{'/'.join(path)}"
+
+    def record(self, endpoint: str, seconds: float, error: bool = False):
+        with self._lock:
+            stats = self._endpoints[endpoint]
+            stats["count"] += 1
+            stats["errors"] += int(error)
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                endpoint: {
+                    **stats,
+                    "mean_seconds": stats["total_seconds"] / stats["count"],
+                }
+                for endpoint, stats in sorted(self._endpoints.items())
+            }
+
+
+metrics = RequestMetrics()
+
+
+class TimedTransport(Transport):
+    def perform_request(self, method, url, *args, **kwargs):
+        endpoint = RequestMetrics.endpoint(method, url)
+        started = time.perf_counter()
+        try:
+            result = super().perform_request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.record(endpoint, time.perf_counter() - started, error=True)
+            raise
+        metrics.record(endpoint, time.perf_counter() - started)
+        return result
+
+
+def create_client(**overrides) -> Elasticsearch:
+    """New client configured from settings, `overrides` are client kwargs."""
+    options = {
+        "port": settings.ELASTICSEARCH_PORT,
+        "transport_class": TimedTransport,
+        "maxsize": settings.ELASTICSEARCH_POOL_SIZE,
+        "timeout": settings.ELASTICSEARCH_TIMEOUT,
+        "max_retries": settings.ELASTICSEARCH_MAX_RETRIES,
+        "retry_on_timeout": settings.ELASTICSEARCH_RETRY_ON_TIMEOUT,
+        "http_compress": settings.ELASTICSEARCH_HTTP_COMPRESS,
+    }
+    options.update(overrides)
+    return Elasticsearch([settings.ELASTICSEARCH_URL], **options)
+
+
+_client: Optional[Elasticsearch] = None
+_client_lock = threading.Lock()
+
+
+def get_es() -> Elasticsearch:
+    """The process-wide shared client."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = create_client()
+    return _client
@@ -0,0 +1,24 @@
+from src.elasticsearch_client import RequestMetrics, get_es
+
+
+def test_endpoint_groups_document_ids():
+    assert RequestMetrics.endpoint("GET", "/indicators/_doc/1234-abcd") == "GET /indicators/_doc/{id}"
+    assert RequestMetrics.endpoint("POST", "/features/_search?scroll=2m") == "POST /features/_search"
+    assert RequestMetrics.endpoint("POST", "/_search/scroll") == "POST /_search/scroll"
+    assert RequestMetrics.endpoint("DELETE", "/_search/scroll/DXF1ZXJ5") == "DELETE /_search/scroll/{id}"
+
+
+def test_metrics_summary():
+    metrics = RequestMetrics()
+    metrics.record("POST /features/_search", 0.2)
+    metrics.record("POST /features/_search", 0.4, error=True)
+
+    stats = metrics.summary()["POST /features/_search"]
+    assert stats["count"] == 2
+    assert stats["errors"] == 1
+    assert stats["max_seconds"] == 0.4
+    assert abs(stats["mean_seconds"] - 0.3) < 1e-9
+
+
+def test_client_is_shared():
+    assert get_es() is get_es()
@@ -0,0 +1,220 @@
+"""
+Content-addressed cache for text embeddings.
+
+Embeddings are keyed by a hash of the embedding model name and the
+normalized text, so any process embedding the same text with the same model
+(API search queries, rq workers embedding features and paragraphs) can reuse
+the vector instead of calling the embeddings API again.
+
+Two tiers are used:
+- an in-process LRU, bounded by entry count and TTL
+- Redis, shared by all API replicas and workers, bounded by TTL and by
+  entry count (least recently used keys are evicted)
+
+Embeddings are stored as float32, the precision of Elasticsearch
+dense_vector fields: an ada-002 embedding takes 6KB.
+
+This module is also imported by the rq workers (tasks/, which have /api on
+their PYTHONPATH), so it must not import anything else from `src`: each
+process builds its cache from its own settings with `from_settings`.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from redis import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = "text-embedding-ada-002"
+
+DTYPE = np.float32
+
+
+def normalize_text(text: str) -> str:
+    """Collapses whitespace runs, which don't change the meaning of the text."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        redis: Optional[Redis] = None,
+        max_entries: int = 2048,
+        redis_max_entries: int = 10000,
+        ttl: int = 60 * 60 * 24 * 7,
+        namespace: str = "embedding-cache-f32",
+    ):
+        self.redis = redis
+        self.max_entries = max_entries
+        self.redis_max_entries = redis_max_entries
+        self.ttl = ttl
+        self.namespace = namespace
+        self.counters = Counter()
+        self._entries: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings, redis: Optional[Redis] = None) -> "EmbeddingCache":
+        """Cache sized by the `EMBEDDING_CACHE_*` settings of the API or the workers."""
+        return cls(
+            redis,
+            max_entries=settings.EMBEDDING_CACHE_MAX_ENTRIES,
+            redis_max_entries=settings.EMBEDDING_CACHE_REDIS_MAX_ENTRIES,
+            ttl=settings.EMBEDDING_CACHE_TTL,
+        )
+
+    def key(self, text: str, model_name: str = DEFAULT_MODEL_NAME) -> str:
+        digest = hashlib.sha256(
+            f"{model_name}\0{normalize_text(text)}".encode("utf-8")
+        ).hexdigest()
+        return f"{self.namespace}:{model_name}:{digest}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns the cached embeddings found for `keys`, looking in process
+        memory first and then in Redis.
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, embedding = entry
+                if expires_at < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = embedding
+        counts = {"memory_hits": len(found)}
+
+        remaining = [key for key in keys if key not in found]
+        if remaining and self.redis is not None:
+            try:
+                values = self.redis.mget(remaining)
+                redis_found = {
+                    key: np.frombuffer(value, dtype=DTYPE)
+                    for key, value in zip(remaining, values)
+                    if value is not None
+                }
+                if redis_found:
+                    # Touch the keys so that the size-based eviction is LRU
+                    self.redis.zadd(f"{self.namespace}:index", {key: now for key in redis_found})
+            except RedisError as error:
+                logger.warning(f"Embedding cache Redis tier unavailable: {error}")
+                redis_found = {}
+            counts["redis_hits"] = len(redis_found)
+            self._remember(redis_found)
+            found.update(redis_found)
+
+        counts["misses"] = len(keys) - len(found)
+        self._count(counts)
+        return found
+
+    def set_many(self, embeddings: Dict[str, np.ndarray]):
+        embeddings = {
+            key: np.asarray(embedding, dtype=DTYPE)
+            for key, embedding in embeddings.items()
+        }
+        self._remember(embeddings)
+
+        if not embeddings or self.redis is None:
+            return
+        index = f"{self.namespace}:index"
+        now = time.time()
+        try:
+            pipeline = self.redis.pipeline()
+            for key, embedding in embeddings.items():
+                pipeline.set(key, embedding.tobytes(), ex=self.ttl)
+            pipeline.zadd(index, {key: now for key in embeddings})
+            pipeline.zremrangebyscore(index, "-inf", now - self.ttl)
+            pipeline.zcard(index)
+            size = pipeline.execute()[-1]
+
+            if size > self.redis_max_entries:
+                evicted = [
+                    key for key, _ in self.redis.zpopmin(index, size - self.redis_max_entries)
+                ]
+                self.redis.delete(*evicted)
+                self._count({"redis_evictions": len(evicted)})
+        except RedisError as error:
+            logger.warning(f"Embedding cache Redis tier unavailable: {error}")
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters of this process and, when available, all processes."""
+        result = {"process": dict(self.counters), "memory_entries": len(self._entries)}
+        if self.redis is not None:
+            try:
+                result["shared"] = {
+                    name.decode(): int(count)
+                    for name, count in self.redis.hgetall(f"{self.namespace}:stats").items()
+                }
+            except RedisError:
+                pass
+        return result
+
+    def _remember(self, embeddings: Dict[str, np.ndarray]):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            for key, embedding in embeddings.items():
+                self._entries[key] = (expires_at, embedding)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, amounts: Dict[str, int]):
+        amounts = {name: amount for name, amount in amounts.items() if amount}
+        self.counters.update(amounts)
+        if not amounts or self.redis is None:
+            return
+        try:
+            pipeline = self.redis.pipeline()
+            for name, amount in amounts.items():
+                pipeline.hincrby(f"{self.namespace}:stats", name, amount)
+            pipeline.execute()
+        except RedisError:
+            pass
+
+
+class CachedEmbedder:
+    """
+    Wraps a jatarag `Embedder`, only embedding the paragraphs that are not
+    already in the cache.
+    """
+
+    def __init__(self, embedder, cache: EmbeddingCache, model_name: str = DEFAULT_MODEL_NAME):
+        self.embedder = embedder
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_paragraphs(self, paragraphs: List[str]) -> np.ndarray:
+        keys = [self.cache.key(paragraph, self.model_name) for paragraph in paragraphs]
+        found = self.cache.get_many(list(dict.fromkeys(keys)))
+
+        missing = {}
+        for key, paragraph in zip(keys, paragraphs):
+            if key not in found:
+                missing.setdefault(key, paragraph)
+        if missing:
+            computed = {
+                key: np.asarray(embedding, dtype=DTYPE)
+                for key, embedding in zip(
+                    missing, self.embedder.embed_paragraphs(list(missing.values()))
+                )
+            }
+            self.cache.set_many(computed)
+            found.update(computed)
+
+        if not keys:
+            return self.embedder.embed_paragraphs([])
+        return np.array([found[key] for key in keys])
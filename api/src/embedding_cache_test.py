@@ -0,0 +1,39 @@
+import numpy as np
+from src.embedding_cache import CachedEmbedder, EmbeddingCache
+
+
+class CountingEmbedder:
+    def __init__(self):
+        self.embedded = []
+
+    def embed_paragraphs(self, paragraphs):
+        self.embedded.extend(paragraphs)
+        return np.array([[len(p), float(sum(map(ord, p)))] for p in paragraphs])
+
+
+def test_cached_embedder__only_embeds_unseen_normalized_text():
+    inner = CountingEmbedder()
+    embedder = CachedEmbedder(inner, EmbeddingCache(redis=None))
+
+    first = embedder.embed_paragraphs(["rainfall", "crop  yield", "rainfall"])
+    second = embedder.embed_paragraphs([" crop yield ", "rainfall", "drought"])
+
+    assert inner.embedded == ["rainfall", "crop  yield", "drought"]
+    assert np.array_equal(first[0], second[1])
+    assert np.array_equal(first[1], second[0])
+    assert first.dtype == second.dtype == np.float32
+    assert embedder.cache.counters == {"memory_hits": 2, "misses": 3}
+
+
+def test_embedding_cache__evicts_least_recently_used_and_expired():
+    cache = EmbeddingCache(redis=None, max_entries=2, ttl=60)
+    cache.set_many({"a": np.zeros(2), "b": np.ones(2)})
+    cache.get_many(["a"])
+    cache.set_many({"c": np.ones(2)})
+
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+
+    expired = EmbeddingCache(redis=None, ttl=-1)
+    expired.set_many({"a": np.zeros(2)})
+
+    assert expired.get_many(["a"]) == {}
@@ -1,6 +1,7 @@
-from jatarag.embedder import AdaEmbedder
+from typing import Optional
 
-embedder = AdaEmbedder()
+from src.registry import embedder
+from src.vector_search import cosine_script_score, knn_clause
 
 
 def keyword_query_v3(phrase):
@@ -223,26 +224,22 @@ def hybrid_query_v0(query):
     return features_query
 
 
-def hybrid_query_v2(term):
+def hybrid_query_v2(term, knn_k: Optional[int] = None):
     """
     Latest and greatest hybrid query, with less keyword-phrase-fuzzy-match
     after hybrid search feedback from MITRE.
+    When `knn_k` is set, the semantic part is an approximate knn search of
+    the `knn_k` nearest features instead of an exact script_score.
     """
 
     embedding = embedder.embed_paragraphs([term])[0]
 
     features_query = keyword_query_v3(term)
 
-    features_query["query"]["bool"]["should"].append({
-        "script_score": {
-            "query": {"match_all": {}},
-            "_name": "semantic_search",
-            "script": {
-                "source": "Math.max(cosineSimilarity(params.query_vector, 'embeddings'), 0)",
-                "params": {
-                    "query_vector": embedding
-                }
-            }
-        }
-    })
+    if knn_k:
+        features_query["knn"] = knn_clause(embedding, knn_k)
+    else:
+        features_query["query"]["bool"]["should"].append(
+            cosine_script_score(embedding, name="semantic_search")
+        )
     return features_query
@@ -6,18 +6,20 @@ import requests
 from typing import Any, Dict, Generator, List, Optional
 import json
 
-from elasticsearch import Elasticsearch
 from pydantic import BaseModel, Field
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from fastapi.logger import logger
 
 from validation import IndicatorSchema
+from src.data import embedding_cache
+from src.elasticsearch_client import get_es, metrics as elasticsearch_metrics
+from src.registry import registry
 from src.settings import settings
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+es = get_es()
 
 dmc_url = settings.DMC_URL
 dmc_port = settings.DMC_PORT
@@ -55,3 +57,30 @@ def get_health():
         "dmc": "ok" if dmc_status == "healthy" else "Failed Health Check",
     }
     return status
+
+
+@router.get("/healthcheck/embedding_cache")
+def get_embedding_cache_stats():
+    """
+    Hit/miss counters of the text embeddings cache, for this API process and
+    shared across all API replicas and rq workers.
+    """
+    return embedding_cache.stats()
+
+
+@router.get("/healthcheck/models")
+def get_models_status():
+    """
+    Heavy models and clients of this API process: whether they have been
+    loaded yet (they are loaded on first use) and how long loading took.
+    """
+    return registry.status()
+
+
+@router.get("/healthcheck/elasticsearch")
+def get_elasticsearch_metrics():
+    """
+    Elasticsearch requests made by this API process, grouped by endpoint:
+    request and error counts, mean and max latency in seconds.
+    """
+    return elasticsearch_metrics.summary()
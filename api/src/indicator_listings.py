@@ -0,0 +1,208 @@
+"""
+Materialized indicator listings served by `/indicators/latest` and
+`/indicators/ncfiles`.
+
+Both endpoints list every published indicator (raster files only for ncfiles).
+Instead of querying up to 10,000 documents on every call, each listing is kept
+in Redis, shared by all API replicas:
+- `<namespace>:<listing>:items` hash of indicator id to its serialized entry
+- `<namespace>:<listing>:order` sorted set of indicator ids, in the order
+  Elasticsearch lists them (index order: last written last)
+- `<namespace>:<listing>:position` last position given in that order
+- `<namespace>:version` counter bumped on every change, used as ETag
+
+Listings are built from Elasticsearch, then updated one indicator at a time by
+`refresh_indicator` whenever an indicator is written. As a safety net against
+missed updates, they are rebuilt at least every `INDICATOR_LISTING_TTL`
+seconds, and expire when not read for twice as long.
+"""
+from __future__ import annotations
+
+import logging
+from typing import Dict, Optional
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from src.settings import settings
+from validation import IndicatorSchema
+
+logger = logging.getLogger(__name__)
+
+RASTER_EXTENSIONS = ["nc", "tif", "tiff"]
+
+LISTING_SOURCE = [
+    "description",
+    "name",
+    "id",
+    "created_at",
+    "deprecated",
+    "maintainer.name",
+    "maintainer.email",
+]
+
+LISTINGS = {
+    "latest": LISTING_SOURCE,
+    "ncfiles": LISTING_SOURCE + ["fileData.raw.url", "fileData.raw.rawFileName"],
+}
+
+
+def file_extension(indicator: Dict) -> Optional[str]:
+    """
+    Extension of the indicator raw file, from its url or its original file
+    name. Raster extensions take precedence.
+    """
+    raw = (indicator.get("fileData") or {}).get("raw") or {}
+    extensions = [
+        name.rsplit(".", 1)[1]
+        for name in [raw.get("url"), raw.get("rawFileName")]
+        if name and "." in name
+    ]
+    for extension in extensions:
+        if extension in RASTER_EXTENSIONS:
+            return extension
+    return extensions[0] if extensions else None
+
+
+def listing_query(listing: str) -> Dict:
+    filters = [{"term": {"published": True}}]
+    if listing == "ncfiles":
+        filters.append({"bool": {
+            "should": [
+                {"terms": {"file_extension": RASTER_EXTENSIONS}},
+                # Indicators written before file_extension was indexed
+                {"bool": {
+                    "must_not": [{"exists": {"field": "file_extension"}}],
+                    "should": [
+                        {"regexp": {"fileData.raw.url": ".*\\.(nc|tif|tiff)"}},
+                        {"regexp": {"fileData.raw.rawFileName": ".*\\.(nc|tif|tiff)"}},
+                    ],
+                    "minimum_should_match": 1,
+                }},
+            ],
+            "minimum_should_match": 1,
+        }})
+    return {
+        "_source": LISTINGS[listing],
+        "query": {"bool": {"must": [{"match_all": {}}], "filter": filters}},
+    }
+
+
+def in_listing(listing: str, indicator: Dict) -> bool:
+    if not indicator.get("published"):
+        return False
+    if listing == "ncfiles":
+        return (indicator.get("file_extension") or file_extension(indicator)) in RASTER_EXTENSIONS
+    return True
+
+
+def serialize(listing: str, indicator: Dict) -> str:
+    """Listing entry, as the endpoints' response model serializes it."""
+    source = {}
+    for field in LISTINGS[listing]:
+        *parents, name = field.split(".")
+        value, target = indicator, source
+        for parent in parents:
+            value = (value or {}).get(parent)
+            target = target.setdefault(parent, {})
+        if value is not None and name in value:
+            target[name] = value[name]
+    return IndicatorSchema.IndicatorsSearchSchema.parse_obj(source).json()
+
+
+class IndicatorListings:
+    def __init__(self, es, redis: Redis, namespace: str = "indicator-listings"):
+        self.es = es
+        self.redis = redis
+        self.namespace = namespace
+        self._bodies: Dict[tuple, tuple] = {}
+
+    def version(self) -> int:
+        """Current listings version, building the listings if needed."""
+        version = self.redis.get(f"{self.namespace}:version")
+        if version is None or not self.redis.exists(f"{self.namespace}:built"):
+            self.rebuild()
+            version = self.redis.get(f"{self.namespace}:version")
+        return int(version or 0)
+
+    def etag(self, version: int) -> str:
+        return f'"{self.namespace}-{version}"'
+
+    def body(self, listing: str, size: int, version: int) -> bytes:
+        """JSON array of the first `size` entries of `listing`."""
+        # Listings hold at most INDICATOR_LISTING_MAX_SIZE entries, so that
+        # sizes from clients don't grow the memo past a few keys
+        size = max(0, min(size, settings.INDICATOR_LISTING_MAX_SIZE))
+        cached = self._bodies.get((listing, size))
+        if cached and cached[0] == version:
+            return cached[1]
+
+        ids = self.redis.zrange(f"{self.namespace}:{listing}:order", 0, size - 1) if size else []
+        entries = self.redis.hmget(f"{self.namespace}:{listing}:items", ids) if ids else []
+        body = b"[" + b",".join(entry for entry in entries if entry) + b"]"
+        # Bodies of previous versions are never served again
+        self._bodies = {
+            key: value for key, value in self._bodies.items() if value[0] == version
+        }
+        self._bodies[(listing, size)] = (version, body)
+        return body
+
+    def rebuild(self):
+        """Rebuilds every listing from elasticsearch."""
+        lock = self.redis.lock(f"{self.namespace}:lock", timeout=120)
+        with lock:
+            if self.redis.exists(f"{self.namespace}:built"):
+                return
+            pipeline = self.redis.pipeline()
+            for listing in LISTINGS:
+                hits = self.es.search(
+                    index="indicators", body=listing_query(listing), size=settings.INDICATOR_LISTING_MAX_SIZE
+                )["hits"]["hits"]
+                keys = [
+                    f"{self.namespace}:{listing}:{name}" for name in ["items", "order", "position"]
+                ]
+                pipeline.delete(*keys)
+                for position, hit in enumerate(hits):
+                    self._add(pipeline, listing, hit["_id"], hit["_source"], position)
+                pipeline.set(f"{self.namespace}:{listing}:position", len(hits))
+                for key in keys:
+                    pipeline.expire(key, 2 * settings.INDICATOR_LISTING_TTL)
+            pipeline.set(f"{self.namespace}:built", 1, ex=settings.INDICATOR_LISTING_TTL)
+            pipeline.incr(f"{self.namespace}:version")
+            pipeline.execute()
+            logger.info("Rebuilt indicator listings")
+
+    def refresh_indicator(self, indicator_id: str):
+        """Updates every listing after `indicator_id` was written."""
+        try:
+            if not self.redis.exists(f"{self.namespace}:built"):
+                return
+            try:
+                indicator = self.es.get(index="indicators", id=indicator_id)["_source"]
+            except Exception:
+                indicator = {}
+            pipeline = self.redis.pipeline()
+            for listing in LISTINGS:
+                if in_listing(listing, indicator):
+                    # Written documents move to the end of the index order
+                    position = self.redis.incr(f"{self.namespace}:{listing}:position")
+                    self._add(pipeline, listing, indicator_id, indicator, position)
+                else:
+                    pipeline.hdel(f"{self.namespace}:{listing}:items", indicator_id)
+                    pipeline.zrem(f"{self.namespace}:{listing}:order", indicator_id)
+            pipeline.incr(f"{self.namespace}:version")
+            pipeline.execute()
+        except RedisError as error:
+            # Listings can't be trusted anymore, they are rebuilt on next read
+            logger.warning(f"Failed to refresh indicator listings: {error}")
+            self.invalidate()
+
+    def invalidate(self):
+        try:
+            self.redis.delete(f"{self.namespace}:built")
+        except RedisError:
+            pass
+
+    def _add(self, pipeline, listing: str, indicator_id: str, indicator: Dict, position: int):
+        pipeline.hset(f"{self.namespace}:{listing}:items", indicator_id, serialize(listing, indicator))
+        pipeline.zadd(f"{self.namespace}:{listing}:order", {indicator_id: position})
@@ -0,0 +1,158 @@
+import json
+
+from src.indicator_listings import IndicatorListings, file_extension, in_listing, serialize
+from src.settings import settings
+
+
+def test_file_extension_prefers_raster_files():
+    indicator = {"fileData": {"raw": {"url": "raw_data.csv", "rawFileName": "rain.tiff"}}}
+    assert file_extension(indicator) == "tiff"
+    assert file_extension({"fileData": {"raw": {"url": "data.csv"}}}) == "csv"
+    assert file_extension({}) is None
+
+
+def test_ncfiles_listing_entries():
+    indicator = {
+        "id": "a",
+        "name": "Rain",
+        "description": "Rainfall",
+        "published": True,
+        "outputs": [{"name": "rain"}],
+        "maintainer": {"name": "Jane", "email": "jane@example.com", "organization": "Org"},
+        "fileData": {"raw": {"url": "data.nc", "rawFileName": "rain.nc", "uploaded": True}},
+    }
+    assert in_listing("ncfiles", indicator)
+    assert not in_listing("ncfiles", {**indicator, "fileData": {"raw": {"url": "data.csv"}}})
+    assert not in_listing("latest", {**indicator, "published": False})
+
+    entry = json.loads(serialize("ncfiles", indicator))
+    assert "outputs" not in entry
+    assert entry["fileData"] == {"raw": {"url": "data.nc", "rawFileName": "rain.nc"}}
+    assert entry["maintainer"]["email"] == "jane@example.com"
+
+
+class FakeRedis:
+    def __init__(self, ids):
+        self.ids = ids
+        self.ranges = []
+
+    def zrange(self, key, start, end):
+        self.ranges.append((start, end))
+        return self.ids[start:end + 1]
+
+    def hmget(self, key, ids):
+        return [json.dumps({"id": i}).encode("utf-8") for i in ids]
+
+
+def test_listing_bodies_memo_is_bounded(monkeypatch):
+    monkeypatch.setattr(settings, "INDICATOR_LISTING_MAX_SIZE", 3)
+    redis = FakeRedis(["a", "b", "c"])
+    listings = IndicatorListings(es=None, redis=redis)
+
+    assert json.loads(listings.body("latest", 2, version=1)) == [{"id": "a"}, {"id": "b"}]
+    for size in [3, 10, 1000]:
+        assert len(json.loads(listings.body("latest", size, version=1))) == 3
+    assert json.loads(listings.body("latest", 0, version=1)) == []
+    assert len(listings._bodies) == 3
+    assert redis.ranges == [(0, 1), (0, 2)]
+
+    listings.body("latest", 2, version=2)
+    assert list(listings._bodies) == [("latest", 2)]
+
+
+class InMemoryRedis:
+    """Just the Redis commands used by IndicatorListings, pipelines run eagerly."""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+
+    def lock(self, name, timeout=None):
+        from contextlib import nullcontext
+        return nullcontext()
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        return []
+
+    def exists(self, key):
+        return int(key in self.values)
+
+    def get(self, key):
+        value = self.values.get(key)
+        return None if value is None else str(value).encode("utf-8")
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.expires[key] = ex
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+    def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def hset(self, key, field, value):
+        self.values.setdefault(key, {})[field] = value.encode("utf-8")
+
+    def hdel(self, key, field):
+        self.values.get(key, {}).pop(field, None)
+
+    def hmget(self, key, fields):
+        return [self.values.get(key, {}).get(field) for field in fields]
+
+    def zadd(self, key, mapping):
+        self.values.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.values.get(key, {}).pop(member, None)
+
+    def zrange(self, key, start, end):
+        members = sorted(self.values.get(key, {}).items(), key=lambda item: item[1])
+        return [member for member, _ in members][start:end + 1]
+
+
+class FakeElasticsearch:
+    def __init__(self, indicators):
+        self.indicators = indicators
+
+    def search(self, index, body, size):
+        return {"hits": {"hits": [
+            {"_id": indicator["id"], "_source": indicator} for indicator in self.indicators
+        ]}}
+
+    def get(self, index, id):
+        return {"_source": next(i for i in self.indicators if i["id"] == id)}
+
+
+def test_listings_keep_index_order_and_expire():
+    indicators = [
+        {
+            "id": id,
+            "name": id,
+            "description": id,
+            "maintainer": {"name": "Jane", "email": "jane@example.com"},
+            "published": True,
+            "created_at": created_at,
+        }
+        for id, created_at in [("b", 2), ("a", 1), ("c", 3)]
+    ]
+    redis = InMemoryRedis()
+    listings = IndicatorListings(FakeElasticsearch(indicators), redis)
+
+    version = listings.version()
+    assert [i["id"] for i in json.loads(listings.body("latest", 10, version))] == ["b", "a", "c"]
+    assert redis.expires["indicator-listings:built"] == settings.INDICATOR_LISTING_TTL
+    assert redis.expires["indicator-listings:latest:items"] == 2 * settings.INDICATOR_LISTING_TTL
+
+    # Written indicators are listed last, as elasticsearch lists them
+    listings.refresh_indicator("b")
+    version = listings.version()
+    assert [i["id"] for i in json.loads(listings.body("latest", 10, version))] == ["a", "c", "b"]
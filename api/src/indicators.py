@@ -13,36 +13,37 @@ from typing import List, Optional
 from urllib.parse import urlparse
 
 import openpyxl
-import pandas as pd
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
+from src.pagination import cursor_params, search_page
 from fastapi import APIRouter, File, HTTPException, Query, Response, UploadFile, status, Request
 from fastapi.logger import logger
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse
 from openpyxl.styles import Font
 from openpyxl.workbook import Workbook
 from openpyxl.worksheet.datavalidation import DataValidation
 from pydantic import ValidationError
 from redis import Redis
+from redis.exceptions import RedisError
 from rq import Queue
 from src.causemos import deprecate_dataset
 from src.csv_annotation_parser import format_annotations, xls_to_annotations
 from src.data import get_context, job
 from src.dojo import search_and_scroll
+from src.indicator_listings import IndicatorListings, file_extension, listing_query
 from src.feature_queries import keyword_query_v1, hybrid_query_v2
+from src.vector_search import knn_enabled, knn_search
 from src.plugins import plugin_action
+from src.previews import processed_preview, raw_preview
 from src.settings import settings
 from src.utils import (
-    add_date_to_dataset, get_rawfile, list_files,
-    put_rawfile, format_hybrid_results
+    add_date_to_dataset, list_files,
+    put_rawfile, format_hybrid_results, stream_rawfile
 )
 from pydantic import BaseModel
 from validation import DojoSchema, IndicatorSchema, MetadataSchema
 
 router = APIRouter()
-es = Elasticsearch(
-    [settings.ELASTICSEARCH_URL],
-    port=settings.ELASTICSEARCH_PORT
-)
+es = get_es()
 
 # REDIS CONNECTION AND QUEUE OBJECTS
 redis = Redis(
@@ -51,6 +52,8 @@ redis = Redis(
 )
 q = Queue(connection=redis, default_timeout=-1)
 
+indicator_listings = IndicatorListings(es, redis)
+
 
 # For created_at times in epoch milliseconds
 def current_milli_time():
@@ -83,17 +86,26 @@ def enqueue_indicator_feature(indicator_id, indicator_dict):
     q.enqueue_call(func=job_string, args=[context], kwargs={}, job_id=job_id)
 
 
+def set_file_extension(payload: IndicatorSchema.IndicatorMetadataSchema):
+    """Indexes the raw file extension, so listings filter it by term."""
+    extension = file_extension(payload.dict())
+    if extension:
+        payload.file_extension = extension
+
+
 @router.post("/indicators")
 def create_indicator(payload: IndicatorSchema.IndicatorMetadataSchema):
     indicator_id = str(uuid.uuid4())
     payload.id = indicator_id
     payload.created_at = current_milli_time()
+    set_file_extension(payload)
     body = payload.json()
     payload.published = False
 
     plugin_action("before_create", data=body, type="indicator")
     es.index(index="indicators", body=body, id=indicator_id)
     plugin_action("post_create", data=body, type="indicator")
+    indicator_listings.refresh_indicator(indicator_id)
 
     empty_annotations_payload = MetadataSchema.MetaModel(metadata={}).json()
     # (?): SHOULD WE HAVE PLUGINS AROUND THE ANNOTATION CREATION?
@@ -119,11 +131,13 @@ def create_indicator(payload: IndicatorSchema.IndicatorMetadataSchema):
 def update_indicator(payload: IndicatorSchema.IndicatorMetadataSchema):
     indicator_id = payload.id
     payload.created_at = current_milli_time()
+    set_file_extension(payload)
     body = payload.json()
 
     plugin_action("before_update", data=body, type="indicator")
     es.index(index="indicators", body=body, id=indicator_id)
     plugin_action("post_update", data=body, type="indicator")
+    indicator_listings.refresh_indicator(indicator_id)
 
     if payload.outputs:
         enqueue_indicator_feature(indicator_id, json.loads(payload.json()))
@@ -141,7 +155,10 @@ def patch_indicator(
 ):
     payload.created_at = current_milli_time()
     body = json.loads(payload.json(exclude_unset=True))
+    if "fileData" in body:
+        body["file_extension"] = file_extension(body)
     es.update(index="indicators", body={"doc": body}, id=indicator_id)
+    indicator_listings.refresh_indicator(indicator_id)
 
     updated = es.get_source(
         index="indicators", id=indicator_id, params={"_source": "name,outputs"}
@@ -160,7 +177,7 @@ def format_one_result(r):
     r["_source"]["metadata"] = {}
     r["_source"]["metadata"]["match_score"] = r["_score"]
     r["_source"]["id"] = r["_id"]
-    r["_source"]["metadata"]["matched_queries"] = r["matched_queries"]
+    r["_source"]["metadata"]["matched_queries"] = r.get("matched_queries", [])
     return r["_source"]
 
 
@@ -177,24 +194,20 @@ def semantic_search_features(
     'number of people who have been vaccinated'
     """
 
-    if scroll_id:
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
-    else:
-        # Retrieve first item in output, since it returns an array output
-        # that matches its input, and we provide only one- query.
-        features_query = hybrid_query_v2(query)
-
-        results = es.search(
-            index="features", body=features_query, scroll="2m", size=size
+    results = None
+    if knn_enabled() and not scroll_id:
+        # Approximate nearest neighbors are a single page of results
+        results = knn_search(
+            es, "features", hybrid_query_v2(query, knn_k=int(size)), cosine_scores=False
+        )
+        scroll_id = None
+    if results is None:
+        results, scroll_id = search_page(
+            es, "features", size, scroll_id, hybrid_query_v2, {"term": query}
         )
 
     items_in_page = len(results["hits"]["hits"])
 
-    if items_in_page < int(size):
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
-
     max_score = results["hits"]["max_score"]
 
     first = results["hits"]["hits"][0]
@@ -210,6 +223,12 @@ def semantic_search_features(
     }
 
 
+def list_features_query(term=None):
+    if term:
+        return keyword_query_v1(term)
+    return {"query": {"match_all": {}}, "_source": {"excludes": "embeddings"}}
+
+
 @router.get("/features", response_model=IndicatorSchema.FeaturesSearchSchema)
 def list_features(
     term: Optional[str] = None, size: int = 10, scroll_id: Optional[str] = None
@@ -220,26 +239,14 @@ def list_features(
     to feature `name`, `display_name`, or `description`.
     """
 
-    if term:
-        q = keyword_query_v1(term)
-
-    else:
-        q = {"query": {"match_all": {}}, "_source": {"excludes": "embeddings"}}
-
-    if not scroll_id:
-        results = es.search(index="features", body=q, scroll="2m", size=size)
-    else:
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
+    term = cursor_params(scroll_id, "features", term=term)["term"]
+    results, scroll_id = search_page(
+        es, "features", size, scroll_id, list_features_query, {"term": term}
+    )
 
     es_hits = results["hits"]["hits"]
     hits_count = len(es_hits)
 
-    # if hits are less than the page size (10) don't return a scroll_id
-    if hits_count < size:
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
-
     max_score = results["hits"]["max_score"]
 
     def formatOneResult(r):
@@ -265,67 +272,54 @@ def list_features(
 @router.get(
     "/indicators/latest", response_model=List[IndicatorSchema.IndicatorsSearchSchema]
 )
-def get_latest_indicators(size=10000):
-    q = {
-        "_source": [
-            "description",
-            "name",
-            "id",
-            "created_at",
-            "deprecated",
-            "maintainer.name",
-            "maintainer.email",
-        ],
-        "query": {
-            "bool": {
-                "must": [{"match_all": {}}],
-                "filter": [{"term": {"published": True}}],
-            }
-        },
-    }
-    results = es.search(index="indicators", body=q, size=size)["hits"]["hits"]
-    IndicatorsSchemaArray = []
-    for res in results:
-        IndicatorsSchemaArray.append(res.get("_source"))
-    return IndicatorsSchemaArray
+def get_latest_indicators(request: Request, size=10000):
+    return listing_response(request, "latest", int(size))
 
 @router.get("/indicators/ncfiles", response_model=List[IndicatorSchema.IndicatorsSearchSchema])
-def get_nc_file_indicators(size=10000):
-    # match just .nc files
-    query = {
-        "_source": [
-            "description",
-            "name",
-            "id",
-            "created_at",
-            "deprecated",
-            "maintainer.name",
-            "maintainer.email",
-            "fileData.raw.url",
-            "fileData.raw.rawFileName",
-        ],
-        "query": {
-            "bool": {
-                "must": [
-                    {"bool": {
-                        "should": [
-                            {"regexp": {"fileData.raw.url": ".*\\.(nc|tif|tiff)"}},
-                            {"regexp": {"fileData.raw.rawFileName": ".*\\.(nc|tif|tiff)"}},
-                        ],
-                        "minimum_should_match": 1,
-                    }},
-                ],
-                "filter": [{"term": {"published": True}}],
-            }
-        }
-    }
+def get_nc_file_indicators(request: Request, size=10000):
+    # match just .nc (and raster) files
+    return listing_response(request, "ncfiles", int(size))
+
 
-    results = es.search(index="indicators", body=query, size=size)["hits"]["hits"]
-    IndicatorsSchemaArray = []
-    for res in results:
-        IndicatorsSchemaArray.append(res.get("_source"))
+def listing_response(request: Request, listing: str, size: int):
+    """
+    Serves a materialized indicator listing, or 304 Not Modified when the
+    client already holds its current version.
+    """
+    try:
+        version = indicator_listings.version()
+        etag = indicator_listings.etag(version)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        body = indicator_listings.body(listing, size, version)
+    except RedisError as error:
+        logger.warning(f"Indicator listings unavailable, querying elasticsearch: {error}")
+        results = es.search(index="indicators", body=listing_query(listing), size=size)["hits"]["hits"]
+        return [res.get("_source") for res in results]
 
-    return IndicatorsSchemaArray
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+EMPTY_ONTOLOGIES = {"concepts": None, "processes": None, "properties": None}
+GEOGRAPHY_LEVELS = ["country", "admin1", "admin2", "admin3"]
+
+
+def indicator_source_filter(fields: Optional[str], include_ontologies=True, include_geo=True):
+    """
+    `_source` filter of indicator searches, so that fields that are not
+    requested are not read and sent by elasticsearch.
+    """
+    source = {}
+    if fields:
+        source["includes"] = [field.strip() for field in fields.split(",") if field.strip()]
+    excludes = []
+    if not include_ontologies:
+        excludes += ["outputs.ontologies", "qualifier_outputs.ontologies"]
+    if not include_geo:
+        excludes += [f"geography.{level}" for level in GEOGRAPHY_LEVELS]
+    if excludes:
+        source["excludes"] = excludes
+    return source or None
 
 
 @router.get("/indicators", response_model=DojoSchema.IndicatorSearchResult)
@@ -335,43 +329,37 @@ def search_indicators(
     scroll_id: str = Query(None),
     include_ontologies: bool = True,
     include_geo: bool = True,
+    fields: Optional[str] = Query(
+        None,
+        description="Comma separated indicator fields to return, such as `id,name,outputs.name`. "
+        "Results then only contain these fields.",
+    ),
 ) -> DojoSchema.IndicatorSearchResult:
     indicator_data = search_and_scroll(
-        index="indicators", size=size, query=query, scroll_id=scroll_id
+        index="indicators",
+        size=size,
+        query=query,
+        scroll_id=scroll_id,
+        source=indicator_source_filter(fields, include_ontologies, include_geo),
     )
-    # if request wants ontologies and geo data return all
-    if include_ontologies and include_geo:
-        return indicator_data
-    else:
-        for indicator in indicator_data["results"]:
-            if not include_ontologies:
-                for q_output in indicator["qualifier_outputs"]:
-                    try:
-                        q_output["ontologies"] = {
-                            "concepts": None,
-                            "processes": None,
-                            "properties": None,
-                        }
-                    except Exception as e:
-                        print(e)
-                        logger.exception(e)
-                for outputs in indicator["outputs"]:
-                    try:
-                        outputs["ontologies"] = {
-                            "concepts": None,
-                            "processes": None,
-                            "properties": None,
-                        }
-                    except Exception as e:
-                        print(e)
-                        logger.exception(e)
-            if not include_geo:
-                indicator["geography"]["country"] = []
-                indicator["geography"]["admin1"] = []
-                indicator["geography"]["admin2"] = []
-                indicator["geography"]["admin3"] = []
-
-        return indicator_data
+
+    # Excluded fields are not fetched from elasticsearch, but results still
+    # hold them emptied out
+    for indicator in indicator_data["results"]:
+        if not include_ontologies:
+            for output in indicator.get("qualifier_outputs") or []:
+                output["ontologies"] = dict(EMPTY_ONTOLOGIES)
+            for output in indicator.get("outputs") or []:
+                output["ontologies"] = dict(EMPTY_ONTOLOGIES)
+        if not include_geo and (not fields or "geography" in indicator):
+            geography = indicator["geography"] = indicator.get("geography") or {}
+            for level in GEOGRAPHY_LEVELS:
+                geography[level] = []
+
+    if fields:
+        # Partial documents don't match the response model
+        return JSONResponse(content=indicator_data)
+    return indicator_data
 
 
 class CompositeDatasetHelpResponse(BaseModel):
@@ -399,7 +387,7 @@ def full_dataset_register_help(request: Request):
 
 
 @router.get("/indicators/{indicator_id}/download")
-def download_raw_file(indicator_id: str):
+def download_raw_file(indicator_id: str, request: Request):
     """
     Downloads Raw/Original dataset file, opposite of /indicators/{uuid}/upload.
     """
@@ -443,11 +431,15 @@ def download_raw_file(indicator_id: str):
     headers = {
         "Content-Disposition": f"attachment; filename={uploaded_filename}"
     }
-    return StreamingResponse(
-        get_rawfile(rawfile_path),
-        media_type=media_type,
-        headers=headers
-    )
+    try:
+        return stream_rawfile(
+            rawfile_path,
+            range_header=request.headers.get("range"),
+            media_type=media_type,
+            headers=headers,
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
 @router.get(
@@ -501,6 +493,7 @@ def deprecate_indicator(indicator_id: str):
         indicator = es.get(index="indicators", id=indicator_id)["_source"]
         indicator["deprecated"] = True
         es.index(index="indicators", id=indicator_id, body=indicator)
+        indicator_listings.refresh_indicator(indicator_id)
 
         # Tell Causemos to deprecate the dataset on their end
         deprecate_dataset(indicator_id)
@@ -663,7 +656,10 @@ def upload_file(
                 [
                     f
                     for f in list_files(dir_path)
-                    if os.path.basename(f).startswith("raw_data") and f.endswith(ext)
+                    if os.path.basename(f).startswith("raw_data")
+                    and f.endswith(ext)
+                    # Not the parquet sidecars of csv files, raw_data*.csv.parquet
+                    and not f.endswith(f".csv{ext}")
                 ]
             )
             filename = f"raw_data_{filenum}{ext}"
@@ -750,19 +746,12 @@ async def create_preview(
                     indicator_id,
                     f"{indicator_id}{file_suffix}.parquet.gzip",
                 )
-            file = get_rawfile(rawfile_path)
-            df = pd.read_parquet(file)
-            try:
-                strparquet_path = os.path.join(
-                    settings.DATASET_STORAGE_BASE_URL,
-                    indicator_id,
-                    f"{indicator_id}_str{file_suffix}.parquet.gzip",
-                )
-                file = get_rawfile(strparquet_path)
-                df_str = pd.read_parquet(file)
-                df = pd.concat([df, df_str])
-            except FileNotFoundError:
-                pass
+            strparquet_path = os.path.join(
+                settings.DATASET_STORAGE_BASE_URL,
+                indicator_id,
+                f"{indicator_id}_str{file_suffix}.parquet.gzip",
+            )
+            indexed_rows = processed_preview(rawfile_path, strparquet_path)
 
         else:
             if filepath:
@@ -771,13 +760,7 @@ async def create_preview(
                 rawfile_path = os.path.join(
                     settings.DATASET_STORAGE_BASE_URL, indicator_id, "raw_data.csv"
                 )
-            file = get_rawfile(rawfile_path)
-            df = pd.read_csv(file, delimiter=",")
-
-        obj = json.loads(
-            df.sort_index().reset_index(drop=True).head(100).to_json(orient="index")
-        )
-        indexed_rows = [{"__id": key, **value} for key, value in obj.items()]
+            indexed_rows = raw_preview(rawfile_path)
 
         return indexed_rows
     except FileNotFoundError as e:
@@ -3,7 +3,7 @@ from __future__ import annotations
 
 import time
 from typing import Optional, Literal
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
 # from elasticsearch.exceptions import RequestError, NotFoundError
 from fastapi import (
     APIRouter,
@@ -24,17 +24,17 @@ import json
 # from enum import Enum
 
 # from validation import DocumentSchema
-from src.settings import settings
 
 from rq import Queue
 from redis import Redis
 
 from sse_starlette.sse import EventSourceResponse, ServerSentEvent
 from src.causal_recommender import CausalRecommender
-from jatarag.agent import OpenAIAgent
 from jatarag.librarian import synthesize_answer, MultihopRagAgent
 from jatarag.db import Database, ParagraphResult, MetadataResult
-from jatarag.embedder import Embedder, AdaEmbedder
+from jatarag.embedder import Embedder
+from src.registry import registry
+from src.vector_search import cosine_script_score, knn_clause, vector_search
 from pydantic import BaseModel
 from pathlib import Path
 from os.path import join as path_join
@@ -48,7 +48,7 @@ from validation.KnowledgeSchema import (
 class ElasticSearchDB(Database):
     def __init__(self, embedder: Embedder):
         self.embedder = embedder
-        self.es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+        self.es = get_es()
         self.PARAGRAPHS_INDEX = "document_paragraphs"
         self.DOCUMENTS_INDEX = "documents"
 
@@ -59,28 +59,22 @@ class ElasticSearchDB(Database):
 
         # elasticsearch cosine similarity over all online documents
         p_query = {
-            "query": {
-                "script_score": {
-                    "query": {"match_all": {}},
-                    "script": {
-                        # ES doesnt allow negative numbers. We can either:
-                        # - a) clamp at 0, and not allow negatives, or
-                        # - b) Add 1 to the result to compare score
-                        # We use option (a): it has better score % for top results
-                        "source": "Math.max(cosineSimilarity(params.query_vector, 'embeddings'), 0)",
-                        "params": {
-                            "query_vector": query_embedding
-                        }
-                    }
-                }
-            },
+            "query": cosine_script_score(query_embedding),
             "_source": {
                 "excludes": ["embeddings"]
             }
         }
-        results = self.es.search(
-            index=self.PARAGRAPHS_INDEX,
-            body=p_query,
+        knn_query = {
+            "knn": knn_clause(query_embedding, max_results),
+            "_source": {
+                "excludes": ["embeddings"]
+            }
+        }
+        results = vector_search(
+            self.es,
+            self.PARAGRAPHS_INDEX,
+            p_query,
+            knn_query,
             size=max_results
         )
         hits = results["hits"]["hits"]
@@ -94,22 +88,13 @@ class ElasticSearchDB(Database):
         query_embedding = self.embedder.embed_paragraphs([query])[0]
 
         # elasticsearch cosine similarity over the specified document
+        document_filter = [{"match": {"document_id": document_id}}]
         p_query = {
             "query": {
                 "bool": {
                     "must": [
-                        {"match": {"document_id": document_id}},
-                        {
-                            "script_score": {
-                                "query": {"match_all": {}},
-                                "script": {
-                                    "source": "Math.max(cosineSimilarity(params.query_vector, 'embeddings'), 0)",
-                                    "params": {
-                                        "query_vector": query_embedding
-                                    }
-                                }
-                            }
-                        }
+                        *document_filter,
+                        cosine_script_score(query_embedding)
                     ]
                 }
             },
@@ -117,9 +102,17 @@ class ElasticSearchDB(Database):
                 "excludes": ["embeddings"]
             }
         }
-        results = self.es.search(
-            index=self.PARAGRAPHS_INDEX,
-            body=p_query,
+        knn_query = {
+            "knn": knn_clause(query_embedding, max_results, filter=document_filter),
+            "_source": {
+                "excludes": ["embeddings"]
+            }
+        }
+        results = vector_search(
+            self.es,
+            self.PARAGRAPHS_INDEX,
+            p_query,
+            knn_query,
             size=max_results
         )
         hits = results["hits"]["hits"]
@@ -231,10 +224,8 @@ redis = Redis(
 q = Queue(connection=redis, default_timeout=-1)
 
 
-embedder = AdaEmbedder()
-db = ElasticSearchDB(embedder)
-agent = OpenAIAgent(model='gpt-4o')
-causal_agent = CausalRecommender(agent)
+db = registry.register("knowledge_db", lambda: ElasticSearchDB(registry.get("embedder")))
+causal_agent = registry.register("causal_agent", lambda: CausalRecommender(registry.get("agent")))
 
 
 def load_file_as_json(file_path: str) -> dict:
@@ -283,7 +274,9 @@ def chat(query: str, chat_user_token: str):
         messages = json.loads(serialized_messages)
 
     # initialize librarian with messages (if present)
-    librarian = MultihopRagAgent(db, agent, messages=messages)
+    librarian = MultihopRagAgent(
+        registry.get("knowledge_db"), registry.get("agent"), messages=messages
+    )
 
     def data_streamer():
         results, answer_gen = librarian.ask(query, stream=True)
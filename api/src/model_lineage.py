@@ -0,0 +1,28 @@
+"""
+Model lineages: every version of a model shares the `lineage_id` of its
+first version, the model reached by following `prev_version` links until
+there are none.
+"""
+from __future__ import annotations
+
+from typing import Dict, Optional
+
+
+def lineages(models: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """Lineage id of every model, given {id: prev_version} of all models."""
+    found = {}
+    for model_id in models:
+        chain = []
+        while model_id not in found:
+            chain.append(model_id)
+            prev_version = models.get(model_id)
+            # First version, or a broken / cyclic chain of versions
+            if not prev_version or prev_version not in models or prev_version in chain:
+                root = model_id
+                break
+            model_id = prev_version
+        else:
+            root = found[model_id]
+        for version_id in chain:
+            found[version_id] = root
+    return found
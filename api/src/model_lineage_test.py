@@ -0,0 +1,10 @@
+from src.model_lineage import lineages
+
+
+def test_lineages():
+    models = {"a": None, "b": "a", "c": "b", "d": None, "e": "missing"}
+    assert lineages(models) == {"a": "a", "b": "a", "c": "a", "d": "d", "e": "e"}
+
+
+def test_lineages_cycle():
+    assert lineages({"a": "b", "b": "a"}) == {"a": "b", "b": "b"}
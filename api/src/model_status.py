@@ -0,0 +1,133 @@
+"""
+Model status, taken from the latest default run of each model.
+
+Statuses of any number of models are looked up with a single search: a
+`terms` aggregation on the model id with a `top_hits` sub-aggregation
+returning the newest default run of each model. Runs indices created before
+`created_at` was mapped as `long` hold it as text, which can't be sorted on:
+the search is then retried sorting on its `created_at.keyword` subfield
+(epoch milliseconds, with as many digits, sort the same as strings). Results can be cached in
+process for a few seconds (`MODEL_STATUS_CACHE_TTL`), as dashboards poll the
+same models over and over.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from elasticsearch.exceptions import RequestError
+
+from src.settings import settings
+
+ABSENT = "absent"
+
+
+def latest_default_runs_query(model_ids: List[str], sort_field: str = "created_at") -> Dict:
+    return {
+        "size": 0,
+        "query": {
+            "bool": {
+                "filter": [
+                    {"terms": {"model_id.keyword": model_ids}},
+                    {"match": {"is_default_run": True}},
+                ]
+            }
+        },
+        "aggs": {
+            "models": {
+                "terms": {"field": "model_id.keyword", "size": len(model_ids)},
+                "aggs": {
+                    "latest": {
+                        "top_hits": {
+                            "size": 1,
+                            "sort": [{sort_field: {"order": "desc"}}],
+                            "_source": ["id", "created_at", "attributes.status"],
+                        }
+                    }
+                },
+            }
+        },
+    }
+
+
+def latest_default_runs(es, model_ids: Iterable[str]) -> Dict[str, Optional[Dict]]:
+    """Newest default run of each model, None for models without one."""
+    model_ids = list(dict.fromkeys(model_ids))
+    runs = {model_id: None for model_id in model_ids}
+    if not model_ids:
+        return runs
+
+    try:
+        result = es.search(index="runs", body=latest_default_runs_query(model_ids))
+    except RequestError:
+        # created_at mapped as text on indices created before it was a long
+        result = es.search(
+            index="runs", body=latest_default_runs_query(model_ids, "created_at.keyword")
+        )
+    for bucket in result["aggregations"]["models"]["buckets"]:
+        hits = bucket["latest"]["hits"]["hits"]
+        if hits:
+            runs[bucket["key"]] = hits[0]["_source"]
+    return runs
+
+
+def run_status(run: Optional[Dict]) -> str:
+    if run is None:
+        return ABSENT
+    return (run.get("attributes") or {}).get("status", ABSENT).lower()
+
+
+class StatusCache:
+    """In-process model status cache, entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float = settings.MODEL_STATUS_CACHE_TTL):
+        self.ttl = ttl
+        self._entries: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, model_ids: Iterable[str]) -> Dict[str, str]:
+        if self.ttl <= 0:
+            return {}
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for model_id in model_ids:
+                entry = self._entries.get(model_id)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self._entries[model_id]
+                else:
+                    found[model_id] = entry[1]
+        return found
+
+    def set_many(self, statuses: Dict[str, str]):
+        if self.ttl <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for model_id, status in statuses.items():
+                self._entries[model_id] = (expires_at, status)
+
+    def invalidate(self, model_id: str):
+        with self._lock:
+            self._entries.pop(model_id, None)
+
+
+status_cache = StatusCache()
+
+
+def model_statuses(es, model_ids: Iterable[str], cache: StatusCache = status_cache) -> Dict[str, str]:
+    """Status of each model, from the cache or a single search."""
+    model_ids = list(model_ids)
+    statuses = cache.get_many(model_ids)
+    missing = [model_id for model_id in model_ids if model_id not in statuses]
+    if missing:
+        fetched = {
+            model_id: run_status(run)
+            for model_id, run in latest_default_runs(es, missing).items()
+        }
+        cache.set_many(fetched)
+        statuses.update(fetched)
+    return {model_id: statuses[model_id] for model_id in model_ids}
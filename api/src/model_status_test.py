@@ -0,0 +1,48 @@
+from elasticsearch.exceptions import RequestError
+
+from src.model_status import StatusCache, model_statuses
+
+
+class FakeES:
+    def __init__(self, runs, sortable="created_at"):
+        self.runs = runs
+        self.sortable = sortable
+        self.searches = 0
+
+    def search(self, index, body):
+        self.searches += 1
+        sort = body["aggs"]["models"]["aggs"]["latest"]["top_hits"]["sort"]
+        if list(sort[0]) != [self.sortable]:
+            raise RequestError(400, "search_phase_execution_exception", "fielddata is disabled")
+        model_ids = body["query"]["bool"]["filter"][0]["terms"]["model_id.keyword"]
+        buckets = [
+            {"key": model_id, "latest": {"hits": {"hits": [{"_source": self.runs[model_id]}]}}}
+            for model_id in model_ids
+            if model_id in self.runs
+        ]
+        return {"aggregations": {"models": {"buckets": buckets}}}
+
+
+def test_model_statuses_single_search():
+    es = FakeES({"a": {"attributes": {"status": "Success"}}, "b": {"attributes": {}}})
+    statuses = model_statuses(es, ["a", "b", "c"], cache=StatusCache(ttl=0))
+    assert statuses == {"a": "success", "b": "absent", "c": "absent"}
+    assert es.searches == 1
+
+
+def test_model_statuses_cache():
+    es = FakeES({"a": {"attributes": {"status": "running"}}})
+    cache = StatusCache(ttl=60)
+    model_statuses(es, ["a"], cache=cache)
+    assert model_statuses(es, ["a"], cache=cache) == {"a": "running"}
+    assert es.searches == 1
+
+    cache.invalidate("a")
+    model_statuses(es, ["a"], cache=cache)
+    assert es.searches == 2
+
+
+def test_model_statuses_legacy_created_at_mapping():
+    es = FakeES({"a": {"attributes": {"status": "Failed"}}}, sortable="created_at.keyword")
+    assert model_statuses(es, ["a"], cache=StatusCache(ttl=0)) == {"a": "failed"}
+    assert es.searches == 2
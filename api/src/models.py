@@ -7,23 +7,21 @@ from copy import deepcopy
 import json
 from typing import Dict, List, Union
 
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
 
 from fastapi import APIRouter, HTTPException, Query, Response, status
 from fastapi.logger import logger
 from validation import ModelSchema, DojoSchema
 
-from src.settings import settings
-from src.dojo import search_and_scroll, copy_configs, copy_outputfiles, copy_directive, copy_accessory_files
+from src.pagination import search_page
+from src.dojo import search_and_scroll, clone_model_artifacts, delete_model_artifacts
+from src.model_status import latest_default_runs, model_statuses, run_status, status_cache
 from src.plugins import plugin_action
 from src.utils import run_model_with_defaults
 
 router = APIRouter()
 
-es = Elasticsearch(
-    [settings.ELASTICSEARCH_URL],
-    port=settings.ELASTICSEARCH_PORT
-)
+es = get_es()
 logger = logging.getLogger(__name__)
 
 
@@ -59,6 +57,8 @@ def create_model_family(family: ModelSchema.ModelFamilySchema):
 def create_model(payload: ModelSchema.ModelMetadataSchema):
     model_id = payload.id
     payload.created_at = current_milli_time()
+    if not payload.lineage_id:
+        payload.lineage_id = model_id
     body = payload.json()
 
     # Create a new model family if it doesn't already exist
@@ -85,9 +85,8 @@ def create_model(payload: ModelSchema.ModelMetadataSchema):
     )
 
 
-@router.get("/models/latest", response_model=DojoSchema.ModelSearchResult)
-def get_latest_models(size=100, scroll_id=None) -> DojoSchema.ModelSearchResult:
-    q = {
+def latest_models_body():
+    return {
         'query': {
             'bool':{
             'must_not': {
@@ -95,26 +94,18 @@ def get_latest_models(size=100, scroll_id=None) -> DojoSchema.ModelSearchResult:
             }}
         }
     }
-    if not scroll_id:
-        # we need to kick off the query
-        results = es.search(index='models', body=q, scroll="2m", size=size)
-    else:
-        # otherwise, we can use the scroll
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
 
-    # get count
-    count = es.count(index='models', body=q)
 
-    # if results are less than the page size (10) don't return a scroll_id
-    if len(results["hits"]["hits"]) < int(size):
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
-    results = [i["_source"] for i in results["hits"]["hits"]]
+@router.get("/models/latest", response_model=DojoSchema.ModelSearchResult)
+def get_latest_models(size=100, scroll_id=None) -> DojoSchema.ModelSearchResult:
+    results, scroll_id = search_page(
+        es, "models", size, scroll_id, latest_models_body, {}
+    )
+
     return {
-        "hits": count["count"],
+        "hits": results["hits"]["total"]["value"],
         "scroll_id": scroll_id,
-        "results": results,
+        "results": [i["_source"] for i in results["hits"]["hits"]],
     }
 
 
@@ -227,6 +218,7 @@ def version_model(model_id : str, exclude_files: bool = False):
     new_id = str(uuid.uuid4())
 
     # Update required fields from the original definition
+    original_model_definition['lineage_id'] = model_lineage_id(original_model_definition)
     original_model_definition['id'] = new_id
     original_model_definition['prev_version'] = model_id
     if original_model_definition.get('next_version', False):
@@ -247,10 +239,7 @@ def version_model(model_id : str, exclude_files: bool = False):
             new_model.qualifier_outputs = []
         else:
             # Make copies of related items
-            outputfile_uuid_mapping = copy_outputfiles(model_id, new_id)
-            copy_configs(model_id, new_id)
-            copy_directive(model_id, new_id)
-            copy_accessory_files(model_id, new_id)
+            outputfile_uuid_mapping = clone_model_artifacts(model_id, new_id)
 
             # Update the created model with the changes related to copying
             if new_model.outputs:
@@ -266,9 +255,10 @@ def version_model(model_id : str, exclude_files: bool = False):
 
     except Exception as e:
         # Delete partially created model
-        # TODO: Clean up copies configs, directives, accessories, and output file data which may exist even if the
-        # TODO: model was never actually created due to error
+        # TODO: Clean up copied config files on S3, which may exist even if the model was never created due to error
         delete_model(new_id)
+        if not exclude_files:
+            delete_model_artifacts(new_id)
         raise
 
     return Response(
@@ -278,6 +268,30 @@ def version_model(model_id : str, exclude_files: bool = False):
     )
 
 
+def lineage_models(lineage_id: str) -> Dict[str, Dict]:
+    """Version pointers of every model of a lineage, by model id."""
+    results = es.search(
+        index="models",
+        body={
+            "query": {"term": {"lineage_id.keyword": lineage_id}},
+            "sort": [{"created_at": {"order": "asc", "unmapped_type": "long"}}],
+            "_source": ["id", "prev_version", "next_version"],
+        },
+        size=10000,
+    )
+    return {hit["_id"]: hit["_source"] for hit in results["hits"]["hits"]}
+
+
+def model_lineage_id(model: Dict) -> str:
+    """
+    Lineage of a model, the id of its first version. Walks the previous
+    versions of models created before lineages were stored.
+    """
+    while not model.get("lineage_id") and model.get("prev_version"):
+        model = get_model(model["prev_version"])
+    return model.get("lineage_id") or model["id"]
+
+
 @router.get("/models/{model_id}/versions", response_model=ModelSchema.VersionSchema)
 def model_versions(model_id : str) -> ModelSchema.VersionSchema:
     """
@@ -285,6 +299,12 @@ def model_versions(model_id : str) -> ModelSchema.VersionSchema:
     """
 
     model_definition = get_model(model_id)
+    lineage = lineage_models(model_definition["lineage_id"]) if model_definition.get("lineage_id") else {}
+
+    def version(version_id):
+        # Versions missing from the lineage were not backfilled yet
+        return lineage.get(version_id) or get_model(version_id)
+
     prev_versions = []
     later_versions = []
     prev_leaf = model_definition.get("prev_version", None)
@@ -292,13 +312,11 @@ def model_versions(model_id : str) -> ModelSchema.VersionSchema:
 
     while prev_leaf:
         prev_versions.append(prev_leaf)
-        prev_model = get_model(prev_leaf)
-        prev_leaf = prev_model.get("prev_version", None)
+        prev_leaf = version(prev_leaf).get("prev_version", None)
 
     while next_leaf:
         later_versions.append(next_leaf)
-        next_model = get_model(next_leaf)
-        next_leaf = next_model.get("next_version", None)
+        next_leaf = version(next_leaf).get("next_version", None)
 
     prev_versions.reverse()
 
@@ -355,33 +373,7 @@ def generate_model_status(model_ids: List[str]):
     """
     Searches the current model status for the given models.
     """
-    def status(model_id):
-        query = {
-          "query": {
-            "bool": {
-              "filter": [
-                {"term": {"model_id.keyword":  model_id}},
-                {"match": {"is_default_run": True}}
-              ]
-            }
-          },
-        }
-
-        result = es.search(index='runs', body=query)
-        no_default_run = result["hits"]["total"]['value'] == 0
-
-        if not no_default_run:
-            # Grab fields of run with highest unix epoch timestamp
-            run = max(
-              result["hits"]["hits"],
-              key=lambda hit: hit["_source"]["created_at"]
-            )["_source"]
-            run_status = run.get("attributes", {}).get("status", "absent")
-            return run_status.lower()
-        else:
-            return "absent"
-
-    return {model_id: status(model_id) for model_id in model_ids}
+    return model_statuses(es, model_ids)
 
 
 @router.post("/models/test")
@@ -390,20 +382,13 @@ def test_models(payload: DojoSchema.TestBatch):
     Generates the model status for each model ID given using the results of the
     last default run.
     """
-    def status(model_id):
-        query = {
-          "query": {
-            "bool": {
-              "filter": [
-                {"term": {"model_id.keyword":  model_id}},
-                {"match": {"is_default_run": True}}
-              ]
-            }
-          },
-        }
+    if payload.action == DojoSchema.StatusAction.force:
+        runs = {}
+    else:
+        runs = latest_default_runs(es, payload.model_ids)
 
-        result = es.search(index='runs', body=query)
-        no_default_run = result["hits"]["total"]['value'] == 0
+    def status(model_id):
+        no_default_run = runs.get(model_id) is None
         should_create_new_run = (
           payload.action == DojoSchema.StatusAction.force or
           (
@@ -413,21 +398,13 @@ def test_models(payload: DojoSchema.TestBatch):
         )
 
         if should_create_new_run:
+            status_cache.invalidate(model_id)
             try:
                 test_model(model_id)
                 return "running"
             except Exception as e:
                 logger.info(f'Failed to test {model_id} with error: {e}')
                 return "failed"
-        elif not no_default_run:
-            # Grab fields of run with highest unix epoch timestamp
-            run = max(
-              result["hits"]["hits"],
-              key=lambda hit: hit["_source"]["created_at"]
-            )["_source"]
-            run_status = run.get("attributes", {}).get("status", "absent")
-            return run_status.lower()
-        else:
-            return "absent"
+        return run_status(runs.get(model_id))
 
     return {model_id: status(model_id) for model_id in payload.model_ids}
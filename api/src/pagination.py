@@ -0,0 +1,158 @@
+"""
+Stateless-first pagination of Elasticsearch searches.
+
+First pages are plain searches: no scroll context or point in time (PIT) is
+kept open for them, since most requests never ask for a second page. The
+returned cursor is an opaque token holding the search parameters, the
+offset already served and the hit count of the first page, so continuations
+don't count hits again. The first continuation opens a PIT snapshot, later
+ones page through it with `search_after`.
+
+Cursors are returned and accepted through the existing `scroll_id` fields, so
+clients don't change. Scroll ids issued before this change are recognized and
+still continued with the scroll API.
+"""
+from __future__ import annotations
+
+import base64
+import json
+import logging
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from elasticsearch.exceptions import NotFoundError
+from fastapi import HTTPException, status
+
+from src.settings import settings
+
+logger = logging.getLogger(__name__)
+
+CURSOR_PREFIX = "c1."
+
+
+def is_cursor(token: Optional[str]) -> bool:
+    return bool(token) and token.startswith(CURSOR_PREFIX)
+
+
+def encode_cursor(state: Dict[str, Any]) -> str:
+    payload = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+    return CURSOR_PREFIX + base64.urlsafe_b64encode(payload).decode("ascii")
+
+
+def decode_cursor(token: str) -> Dict[str, Any]:
+    try:
+        payload = base64.urlsafe_b64decode(token[len(CURSOR_PREFIX):].encode("ascii"))
+        return json.loads(zlib.decompress(payload))
+    except (ValueError, zlib.error):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor"
+        )
+
+
+def cursor_params(token: Optional[str], index: str, **params) -> Dict[str, Any]:
+    """
+    Search parameters of a request: the ones stored in its cursor when
+    continuing one, `params` otherwise.
+    """
+    if not is_cursor(token):
+        return params
+    return decode_index_cursor(token, index)["p"]
+
+
+def decode_index_cursor(token: str, index: str) -> Dict[str, Any]:
+    """Decodes a cursor, which has to be one of a search on `index`."""
+    state = decode_cursor(token)
+    if state.get("i") != index:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Pagination cursor is not for {index}",
+        )
+    return state
+
+
+def search_page(
+    es,
+    index: str,
+    size: int,
+    token: Optional[str],
+    build_body: Callable[..., Dict],
+    params: Dict[str, Any],
+) -> Tuple[Dict, Optional[str]]:
+    """
+    Runs one page of the search `build_body(**params)` on `index`.
+    `token` is the cursor (or legacy scroll id) of the previous page, if any.
+    Returns the ES response and the token for the next page, which is None
+    when there are no more results. The response total is exact: it is
+    counted by the first page and reused by its continuations.
+    """
+    size = int(size)
+
+    if token and not is_cursor(token):
+        results = es.scroll(scroll_id=token, scroll="2m")
+        hits = results["hits"]["hits"]
+        return results, results.get("_scroll_id") if len(hits) >= size else None
+
+    state = decode_index_cursor(token, index) if token else {"i": index, "p": params, "f": 0}
+
+    body = dict(build_body(**state["p"]))
+    # search_after needs a total order: ties are broken by index order
+    body["sort"] = list(body.get("sort", ["_score"])) + [{"_doc": "asc"}]
+    body["track_scores"] = True
+    # Only first pages count hits, the total is then carried by the cursor
+    body["track_total_hits"] = "t" not in state
+
+    if not token:
+        results = es.search(index=index, body=body, size=size)
+    else:
+        results = _search_snapshot(es, index, body, size, state)
+
+    if "t" in state:
+        results["hits"]["total"] = {"value": state["t"], "relation": "eq"}
+    else:
+        state["t"] = results["hits"]["total"]["value"]
+
+    hits = results["hits"]["hits"]
+    pit_id = results.get("pit_id", state.get("pit"))
+
+    if len(hits) < size:
+        if pit_id:
+            _close_pit(es, pit_id)
+        return results, None
+
+    next_state = {"i": index, "p": state["p"], "f": state["f"] + len(hits), "t": state["t"]}
+    if token:
+        next_state.update({"pit": pit_id, "sa": hits[-1]["sort"]})
+    return results, encode_cursor(next_state)
+
+
+def _search_snapshot(es, index: str, body: Dict, size: int, state: Dict) -> Dict:
+    """Continuation page, read from the cursor's PIT (opened if needed)."""
+    keep_alive = settings.PAGINATION_KEEP_ALIVE
+
+    if state.get("pit"):
+        pit_body = {**body, "pit": {"id": state["pit"], "keep_alive": keep_alive}}
+        try:
+            return es.search(body={**pit_body, "search_after": state["sa"]}, size=size)
+        except NotFoundError:
+            # The PIT expired: resume after the last hit in a new snapshot.
+            # Not from the offset, which can exceed index.max_result_window.
+            logger.info(f"Pagination PIT on {index} expired, reopening")
+
+    pit_id = es.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+    pit_body = {**body, "pit": {"id": pit_id, "keep_alive": keep_alive}}
+    try:
+        if state.get("sa"):
+            return es.search(body={**pit_body, "search_after": state["sa"]}, size=size)
+        # Second page: the first one wasn't read from a PIT, there is no last hit
+        return es.search(body={**pit_body, "from": state["f"]}, size=size)
+    except Exception:
+        # Nobody else knows about this PIT
+        _close_pit(es, pit_id)
+        raise
+
+
+def _close_pit(es, pit_id: str):
+    try:
+        es.close_point_in_time(body={"id": pit_id})
+    except NotFoundError:
+        pass
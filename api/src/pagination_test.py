@@ -0,0 +1,95 @@
+from unittest.mock import MagicMock
+
+import pytest
+from elasticsearch.exceptions import NotFoundError, RequestError
+from fastapi import HTTPException
+
+from src.pagination import decode_cursor, encode_cursor, is_cursor, search_page
+
+
+def page(ids, pit_id=None, total=5):
+    results = {
+        "hits": {
+            "total": {"value": total},
+            "hits": [{"_id": i, "_source": {"id": i}, "sort": [1.0, i]} for i in ids],
+        }
+    }
+    if pit_id:
+        results["pit_id"] = pit_id
+    return results
+
+
+def build_body(term=None):
+    return {"query": {"match": {"name": term}}}
+
+
+def test_first_page_keeps_no_state_and_continues_in_a_snapshot():
+    es = MagicMock()
+    es.search.side_effect = [page([0, 1]), page([2, 3], "pit-1", 0), page([4], "pit-2", 0)]
+    es.open_point_in_time.return_value = {"id": "pit-1"}
+
+    results, cursor = search_page(es, "features", 2, None, build_body, {"term": "rain"})
+    assert is_cursor(cursor)
+    assert decode_cursor(cursor)["p"] == {"term": "rain"}
+    assert es.search.call_args.kwargs["index"] == "features"
+    es.open_point_in_time.assert_not_called()
+    es.scroll.assert_not_called()
+
+    results, cursor = search_page(es, "features", 2, cursor, build_body, {})
+    body = es.search.call_args.kwargs["body"]
+    assert body["pit"]["id"] == "pit-1"
+    assert body["from"] == 2
+    assert body["query"] == {"match": {"name": "rain"}}
+    # the total counted by the first page is reused
+    assert body["track_total_hits"] is False
+    assert results["hits"]["total"]["value"] == 5
+
+    results, cursor = search_page(es, "features", 2, cursor, build_body, {})
+    body = es.search.call_args.kwargs["body"]
+    assert body["search_after"] == [1.0, 3]
+    assert cursor is None
+    es.close_point_in_time.assert_called_once_with(body={"id": "pit-2"})
+
+
+def test_legacy_scroll_ids_are_scrolled():
+    es = MagicMock()
+    es.scroll.return_value = {**page([0, 1]), "_scroll_id": "DXF1ZXJ5"}
+
+    results, scroll_id = search_page(es, "features", 2, "DXF1ZXJ5", build_body, {})
+
+    es.scroll.assert_called_once_with(scroll_id="DXF1ZXJ5", scroll="2m")
+    assert scroll_id == "DXF1ZXJ5"
+
+
+def test_expired_snapshot_resumes_after_the_last_hit():
+    es = MagicMock()
+    es.search.side_effect = [NotFoundError(404, "search_context_missing_exception"), page([12000, 12001], "pit-2")]
+    es.open_point_in_time.return_value = {"id": "pit-2"}
+    cursor = encode_cursor({"i": "features", "p": {}, "f": 12000, "t": 20000, "pit": "pit-1", "sa": [1.0, 11999]})
+
+    search_page(es, "features", 2, cursor, build_body, {})
+    body = es.search.call_args.kwargs["body"]
+    assert body["pit"]["id"] == "pit-2"
+    assert body["search_after"] == [1.0, 11999]
+    assert "from" not in body
+
+
+def test_snapshot_opened_for_a_failing_search_is_closed():
+    es = MagicMock()
+    es.search.side_effect = RequestError(400, "search_phase_execution_exception", {})
+    es.open_point_in_time.return_value = {"id": "pit-1"}
+    cursor = encode_cursor({"i": "runs", "p": {}, "f": 2, "t": 5})
+
+    with pytest.raises(RequestError):
+        search_page(es, "runs", 2, cursor, build_body, {})
+    es.close_point_in_time.assert_called_once_with(body={"id": "pit-1"})
+
+
+def test_cursors_of_other_indices_are_rejected():
+    es = MagicMock()
+    cursor = encode_cursor({"i": "documents", "p": {"term": "rain"}, "f": 2, "t": 5})
+
+    with pytest.raises(HTTPException) as error:
+        search_page(es, "runs", 2, cursor, build_body, {})
+    assert error.value.status_code == 400
+    es.search.assert_not_called()
@@ -0,0 +1,143 @@
+"""
+Dataset previews, the first rows of a dataset file.
+
+Only the beginning of a file is read: the first row groups of processed
+parquet files, a bounded byte range of raw CSV files. Previews are cached in
+Redis by the S3 ETags of the files they were read from, so a new version of a
+file gets a new preview.
+
+Registration also writes a preview artifact next to the processed files
+(`<file>.preview.json`, see tasks/elwood_processors.py), holding the preview
+rows and the ETags of the files they were computed from. It is used as long
+as those files are unchanged.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import logging
+import os
+from typing import Callable, Dict, List
+
+import botocore
+import pandas as pd
+import pyarrow as pa
+from redis.exceptions import RedisError
+
+from src.data import redis
+from src.settings import settings
+from src.utils import file_etag, get_rawfile, normalize_file_info, open_parquet_file, s3
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_ROWS = 100
+
+
+def preview_rows(df: pd.DataFrame, rows: int = PREVIEW_ROWS) -> List[Dict]:
+    obj = json.loads(df.sort_index().reset_index(drop=True).head(rows).to_json(orient="index"))
+    return [{"__id": key, **value} for key, value in obj.items()]
+
+
+def parquet_head(path: str, rows: int = PREVIEW_ROWS) -> pd.DataFrame:
+    """First `rows` rows of a parquet file, reading as few row groups as possible."""
+    parquet_file = open_parquet_file(path)
+    tables = []
+    for row_group in range(parquet_file.num_row_groups):
+        tables.append(parquet_file.read_row_group(row_group))
+        if sum(table.num_rows for table in tables) >= rows:
+            break
+    if not tables:
+        return parquet_file.schema_arrow.empty_table().to_pandas()
+    return pa.concat_tables(tables).to_pandas().head(rows)
+
+
+def csv_head(path: str, rows: int = PREVIEW_ROWS, max_bytes: int = settings.PREVIEW_CSV_MAX_BYTES) -> pd.DataFrame:
+    """
+    First `rows` rows of a CSV file, from its first `max_bytes` bytes. The
+    whole file is read when they don't hold enough complete rows.
+    """
+    file_info = normalize_file_info(path)
+    try:
+        response = s3.get_object(Bucket=file_info.bucket, Key=file_info.path, Range=f"bytes=0-{max_bytes - 1}")
+    except botocore.exceptions.ClientError as error:
+        raise FileNotFoundError() from error
+
+    data = response["Body"].read()
+    total = int(response.get("ContentRange", "").rpartition("/")[2] or len(data))
+    if total <= len(data):
+        return pd.read_csv(io.BytesIO(data), delimiter=",", nrows=rows)
+
+    # Drop the last, partial line
+    data = data[:data.rfind(b"\n") + 1]
+    try:
+        df = pd.read_csv(io.BytesIO(data), delimiter=",", nrows=rows)
+        if len(df) >= rows:
+            return df
+    except (pd.errors.ParserError, pd.errors.EmptyDataError):
+        pass
+    return pd.read_csv(get_rawfile(path), delimiter=",", nrows=rows)
+
+
+def artifact_path(path: str) -> str:
+    return path.replace(".parquet.gzip", ".preview.json")
+
+
+def read_artifact(path: str, sources: Dict[str, str]):
+    """Rows of the preview artifact of `path`, if computed from `sources`."""
+    try:
+        artifact = json.load(get_rawfile(artifact_path(path)))
+    except (FileNotFoundError, ValueError):
+        return None
+    etags = {os.path.basename(source): etag for source, etag in sources.items()}
+    if artifact.get("sources") != etags:
+        return None
+    return artifact["rows"]
+
+
+def cached(sources: Dict[str, str], build: Callable[[], List[Dict]]) -> List[Dict]:
+    """Preview of the files `sources` (path to ETag), built once per version."""
+    key = "dataset-preview:" + hashlib.sha256(
+        json.dumps(sorted(sources.items())).encode("utf-8")
+    ).hexdigest()
+    try:
+        preview = redis.get(key)
+        if preview is not None:
+            return json.loads(preview)
+    except RedisError as error:
+        logger.warning(f"Preview cache unavailable: {error}")
+
+    rows = build()
+    try:
+        redis.set(key, json.dumps(rows), ex=settings.PREVIEW_CACHE_TTL)
+    except RedisError:
+        pass
+    return rows
+
+
+def processed_preview(data_path: str, str_path: str) -> List[Dict]:
+    """
+    Preview of a processed dataset file, its numeric parquet and, when there
+    is one, its string parquet.
+    """
+    sources = {path: file_etag(path) for path in [data_path, str_path]}
+    if sources[data_path] is None:
+        raise FileNotFoundError(data_path)
+    sources = {path: etag for path, etag in sources.items() if etag}
+
+    def build():
+        rows = read_artifact(data_path, sources)
+        if rows is not None:
+            return rows
+        # Indices are sorted within each file, so the first rows of the
+        # combined preview are among the first rows of each file.
+        return preview_rows(pd.concat([parquet_head(path) for path in sources]))
+
+    return cached(sources, build)
+
+
+def raw_preview(path: str) -> List[Dict]:
+    etag = file_etag(path)
+    if etag is None:
+        raise FileNotFoundError(path)
+    return cached({path: etag}, lambda: preview_rows(csv_head(path)))
@@ -0,0 +1,54 @@
+import io
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src import previews
+
+
+def test_parquet_head_reads_first_row_groups(tmp_path, monkeypatch):
+    path = tmp_path / "data.parquet.gzip"
+    df = pd.DataFrame({"value": range(1000)})
+    pq.write_table(pa.Table.from_pandas(df), path, row_group_size=60, compression="gzip")
+
+    read = []
+    parquet_file = pq.ParquetFile(path)
+    original = parquet_file.read_row_group
+    monkeypatch.setattr(parquet_file, "read_row_group", lambda i: read.append(i) or original(i))
+    monkeypatch.setattr(previews, "open_parquet_file", lambda _: parquet_file)
+
+    head = previews.parquet_head(str(path))
+    assert head["value"].tolist() == list(range(100))
+    assert read == [0, 1]
+
+
+def test_preview_rows():
+    rows = previews.preview_rows(pd.DataFrame({"a": [2, 1]}, index=[1, 0]))
+    assert rows == [{"__id": "0", "a": 1}, {"__id": "1", "a": 2}]
+
+
+class FakeS3:
+    def __init__(self, content):
+        self.content = content
+
+    def get_object(self, Bucket, Key, Range):
+        end = int(Range.split("-")[1])
+        data = self.content[:end + 1]
+        return {
+            "Body": io.BytesIO(data),
+            "ContentRange": f"bytes 0-{len(data) - 1}/{len(self.content)}",
+        }
+
+
+def test_csv_head_reads_a_byte_range(monkeypatch):
+    content = b"a,b\n" + b"".join(f"{i},x{i}\n".encode() for i in range(10000))
+    monkeypatch.setattr(previews, "s3", FakeS3(content))
+
+    def get_rawfile(path):
+        raise AssertionError("The whole file was read")
+
+    monkeypatch.setattr(previews, "get_rawfile", get_rawfile)
+
+    head = previews.csv_head("s3://datasets/raw_data.csv", rows=100, max_bytes=2048)
+    assert head["a"].tolist() == list(range(100))
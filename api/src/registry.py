@@ -0,0 +1,95 @@
+"""
+Registry of the heavy, process-wide objects used by the API routers (language
+models, embedders, LLM agents).
+
+Importing a router no longer builds them: each one is created the first time
+it is used and then shared by every module, so replicas that never highlight
+or chat don't pay for loading BERT or creating LLM clients.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._load_seconds: Dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> LazyObject:
+        """Registers `factory` to build `name`, returns a lazy proxy to it."""
+        self._factories[name] = factory
+        return LazyObject(self, name)
+
+    def get(self, name: str) -> Any:
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self._lock:
+            if name not in self._instances:
+                started = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                self._load_seconds[name] = time.perf_counter() - started
+                logger.info(f"Loaded {name} in {self._load_seconds[name]:.2f}s")
+            return self._instances[name]
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """Which registered objects are loaded, and how long loading them took."""
+        return {
+            name: {
+                "loaded": name in self._instances,
+                "load_seconds": self._load_seconds.get(name),
+            }
+            for name in self._factories
+        }
+
+
+class LazyObject:
+    """
+    Proxy that builds the registry object on first attribute access. It only
+    forwards attribute access: code that needs the object itself (type
+    checks, dunder methods, pickling), such as third party libraries, is
+    given `registry.get(name)` instead.
+    """
+
+    def __init__(self, registry: Registry, name: str):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(self._registry.get(self._name), attribute)
+
+    def __repr__(self):
+        return f"<LazyObject {self._name}>"
+
+
+def _highlighter():
+    from src.semantic_highlighter import Highlighter
+    return Highlighter()
+
+
+def _embedder():
+    from jatarag.embedder import AdaEmbedder
+    from src.data import embedding_cache
+    from src.embedding_cache import CachedEmbedder
+    return CachedEmbedder(AdaEmbedder(), embedding_cache)
+
+
+def _agent():
+    from jatarag.agent import OpenAIAgent
+    return OpenAIAgent(model='gpt-4o')
+
+
+registry = Registry()
+
+highlighter = registry.register("highlighter", _highlighter)
+embedder = registry.register("embedder", _embedder)
+agent = registry.register("agent", _agent)
@@ -0,0 +1,33 @@
+from src.registry import Registry
+
+
+def test_registry_builds_objects_once_on_first_use():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return {"name": "model"}
+
+    registry = Registry()
+    model = registry.register("model", factory)
+
+    assert calls == []
+    assert registry.status()["model"]["loaded"] is False
+
+    assert model.get("name") == "model"
+    assert model.keys() == {"name"}
+    assert calls == [1]
+    assert registry.status()["model"]["loaded"] is True
+
+
+def test_registry_get_returns_the_instance_behind_the_proxy():
+    class Model:
+        pass
+
+    registry = Registry()
+    model = registry.register("model", Model)
+
+    instance = registry.get("model")
+    assert isinstance(instance, Model)
+    assert registry.get("model") is instance
+    assert model.__class__ is not Model
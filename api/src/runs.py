@@ -11,7 +11,8 @@ from operator import itemgetter
 from threading import Thread, current_thread
 from typing import Any, Dict, Generator, List, Optional
 
-from elasticsearch import Elasticsearch
+from src.elasticsearch_client import get_es
+from src.pagination import search_page
 from jinja2 import Template
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Response, status, Request
@@ -35,7 +36,7 @@ from src.settings import settings
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+es = get_es()
 
 
 # For created_at times in epoch milliseconds
@@ -55,58 +56,101 @@ dojo_url = settings.DOJO_URL
 headers = {"Content-Type": "application/json"}
 
 
-@router.get("/runs")
-def search_runs(request: Request, model_name: str = Query(None), model_id: str = Query(None), size=100, scroll_id=None) -> DojoSchema.RunSearchResult:
+def escape_wildcard(value: str) -> str:
+    return re.sub(r"([\\*?])", r"\\\1", value)
+
+
+def parameter_filter(name: str, value: str):
     """
-    Allows users to search for runs. Note that a `model_name` or `model_id` query argument
-    will be used to filter the records in elasticsearch. Any other arbitrary `&key=value` pairs
-    will be used to filter the runs based on parameters and values, in python. Since we can't
-    know ahead of time what all of the possible key/values are that people might search for in
-    the run's parameters, we're accessing the raw FastAPI/Starlette request object's query args.
+    Runs with a `name` parameter matching `value`: case-insensitive substring
+    match of the parameter value, or exact match of its string form. Values
+    are matched on their `wildcard` field, indexed whatever their length and
+    built for substring queries.
     """
+    return {
+        "nested": {
+            "path": "parameters",
+            "query": {
+                "bool": {
+                    "filter": [{"term": {"parameters.name.keyword": name}}],
+                    "should": [
+                        {"term": {"parameters.value.wildcard": value}},
+                        {
+                            "wildcard": {
+                                "parameters.value.wildcard": {
+                                    "value": f"*{escape_wildcard(value)}*",
+                                    "case_insensitive": True,
+                                }
+                            }
+                        },
+                    ],
+                    "minimum_should_match": 1,
+                }
+            },
+        }
+    }
+
 
+def runs_query(model_name=None, model_id=None, parameters=None, sort_field="created_at"):
+    """
+    Runs of a model, newest first. A run matches `parameters` when any of its
+    parameters matches the corresponding filter value, see parameter_filter.
+    """
+    filters = []
     if model_name:
-        q = {"query": {"term": {"model_name.keyword": {"value": model_name, "boost": 1.0}}}}
+        filters.append({"term": {"model_name.keyword": {"value": model_name, "boost": 1.0}}})
     elif model_id:
-        q = {"query": {"term": {"model_id.keyword": {"value": model_id, "boost": 1.0}}}}
-    else:  # no model name specified
-        q = {"query": {"match_all": {}}}
+        filters.append({"term": {"model_id.keyword": {"value": model_id, "boost": 1.0}}})
+    if parameters:
+        filters.append({
+            "bool": {
+                "should": [parameter_filter(name, value) for name, value in parameters.items()],
+                "minimum_should_match": 1,
+            }
+        })
 
-    count = es.count(index='runs', body=q)
+    sort = [{sort_field: {"order": "desc", "unmapped_type": "long"}}]
+    if not filters:  # no model name specified
+        return {"query": {"match_all": {}}, "sort": sort}
+    return {"query": {"bool": {"filter": filters}}, "sort": sort}
 
-    if count["count"] == 0:
-        return {
-            "hits": 0,
-            "scroll_id": None,
-            "results": []
-        }
 
-    if not scroll_id:
-        results = es.search(index='runs', body=q, scroll="2m", size=size)
-    else:
-        results = es.scroll(scroll_id=scroll_id, scroll="2m")
+def legacy_runs_query(model_name=None, model_id=None, parameters=None):
+    """
+    Runs query for indices without nested run parameters, see filter_runs,
+    and with `created_at` mapped as text: its keyword subfield sorts the
+    same, epoch milliseconds having as many digits.
+    """
+    return runs_query(model_name=model_name, model_id=model_id, sort_field="created_at.keyword")
 
-    param_filters = dict(request.query_params)
 
-    # don't use these keys to filter params
-    for reserved_param in ["model_id", "model_name", "size", "scroll_id"]:
-        param_filters.pop(reserved_param, None)
+_runs_index_reindexed = False
 
-    # if results are less than the page size don't return a scroll_id
-    if len(results["hits"]["hits"]) < int(size):
-        scroll_id = None
-    else:
-        scroll_id = results.get("_scroll_id", None)
 
-    results = [i["_source"] for i in results["hits"]["hits"]]
+def legacy_runs_index() -> bool:
+    """
+    Whether the runs index predates nested parameters with wildcard values
+    and a long created_at, and needs legacy_runs_query. Checked on the index
+    mapping until it has been reindexed with scripts/reindex_runs.py.
+    """
+    global _runs_index_reindexed
+    if _runs_index_reindexed:
+        return False
+    mappings = es.indices.get_mapping(index="runs")
+    properties = next(iter(mappings.values()))["mappings"].get("properties", {})
+    parameters = properties.get("parameters", {})
+    value_fields = parameters.get("properties", {}).get("value", {}).get("fields", {})
+    legacy = (
+        parameters.get("type") != "nested"
+        or "wildcard" not in value_fields
+        or properties.get("created_at", {}).get("type") != "long"
+    )
+    _runs_index_reindexed = not legacy
+    return legacy
 
-    if not param_filters:
-        return {
-            "hits": count["count"],
-            "scroll_id": scroll_id,
-            "results": results,
-        }
 
+def filter_runs(results, param_filters):
+    """Filters a page of runs by parameters in python, for legacy indices."""
     to_return = []
 
     for result in results:
@@ -120,14 +164,47 @@ def search_runs(request: Request, model_name: str = Query(None), model_id: str =
                 if type(run_param_value) == str:  # do a "case-insensitive string contains" match
                     if filter_value.lower() in run_param_value.lower():
                         to_return.append(result)
+                        break
                 else:  # not a string (could be int, etc), look for an exact string-ified match
                     if filter_value == str(run_param_value):
                         to_return.append(result)
+                        break
+
+    return to_return
+
+
+@router.get("/runs")
+def search_runs(request: Request, model_name: str = Query(None), model_id: str = Query(None), size=100, scroll_id=None) -> DojoSchema.RunSearchResult:
+    """
+    Allows users to search for runs. Note that a `model_name` or `model_id` query argument
+    will be used to filter the records in elasticsearch. Any other arbitrary `&key=value` pairs
+    will be used to filter the runs based on parameters and values. Since we can't
+    know ahead of time what all of the possible key/values are that people might search for in
+    the run's parameters, we're accessing the raw FastAPI/Starlette request object's query args.
+    """
+
+    param_filters = dict(request.query_params)
+
+    # don't use these keys to filter params
+    for reserved_param in ["model_id", "model_name", "size", "scroll_id"]:
+        param_filters.pop(reserved_param, None)
+
+    params = {"model_name": model_name, "model_id": model_id, "parameters": param_filters}
+    if legacy_runs_index():
+        logger.warning("Filtering runs in python, run scripts/reindex_runs.py")
+        results, scroll_id = search_page(es, "runs", size, scroll_id, legacy_runs_query, params)
+        runs = [i["_source"] for i in results["hits"]["hits"]]
+        return {
+            "hits": results["hits"]["total"]["value"],
+            "scroll_id": scroll_id,
+            "results": filter_runs(runs, param_filters) if param_filters else runs,
+        }
 
+    results, scroll_id = search_page(es, "runs", size, scroll_id, runs_query, params)
     return {
-        "hits": count["count"],
+        "hits": results["hits"]["total"]["value"],
         "scroll_id": scroll_id,
-        "results": to_return,
+        "results": [i["_source"] for i in results["hits"]["hits"]],
     }
 
 
@@ -4,6 +4,8 @@ import torch
 from typing import TypedDict, Any, Dict, Generator, List, Optional, Tuple
 import re
 
+from src.settings import settings
+
 
 class Highlight(TypedDict):
     text: str
@@ -19,7 +21,8 @@ class Highlighter:
         'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', 'her', 'hers', 'herself', 'it', 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', 'should', 'now',
     }
 
-    def __init__(self, model='bert-base-uncased'):
+    def __init__(self, model='bert-base-uncased', max_batch_size: int = settings.HIGHLIGHT_BATCH_SIZE):
+        self.max_batch_size = max_batch_size
         # load BERT tokenizer and model from HuggingFace
         with torch.no_grad():
             logging.set_verbosity_error()
@@ -90,6 +93,38 @@ class Highlighter:
             return tokens, embedding
 
 
+    def embed_batch(self, targets: List[str]) -> List[tuple[BatchEncoding, int, torch.Tensor]]:
+        """
+        Embed many strings with padded forward passes of up to `max_batch_size`
+        strings. Returns, for every string, its batch tokenization, its index in
+        that batch, and its token embeddings (padding removed).
+        """
+        # batch strings of similar length together to reduce padding
+        order = sorted(range(len(targets)), key=lambda i: len(targets[i]))
+        embedded: List[Optional[tuple[BatchEncoding, int, torch.Tensor]]] = [None] * len(targets)
+
+        with torch.no_grad():
+            for start in range(0, len(order), self.max_batch_size):
+                indices = order[start:start + self.max_batch_size]
+                tokens = self.tokenizer([targets[i] for i in indices], return_tensors='pt', padding=True, truncation=True)
+                tokens.to(device=self.device)
+                hidden = self.model(**tokens).last_hidden_state
+                lengths = tokens['attention_mask'].sum(dim=1).tolist()
+
+                for batch_index, (i, length) in enumerate(zip(indices, lengths)):
+                    embedded[i] = (tokens, batch_index, hidden[batch_index, :length])
+
+        return embedded
+
+
+    @staticmethod
+    def similarities(embedding_q: torch.Tensor, embedding_t: torch.Tensor) -> torch.Tensor:
+        """cosine similarity of every query token (rows) with every target token (columns)"""
+        q = torch.nn.functional.normalize(embedding_q, dim=-1)
+        t = torch.nn.functional.normalize(embedding_t, dim=-1)
+        return q @ t.T
+
+
     def highlight_exact(self, query: str, target: str) -> List[Tuple[int,int]]:
         """returns spans for highlighting exact matching words in the target string"""
 
@@ -119,10 +154,16 @@ class Highlighter:
 
         # embed the target string and grab the tokenization
         token_t_obj, embedding_t = self.embed(target)
-        token_t = token_t_obj.tokens()
+
+        return self.llm_spans(token_t_obj, 0, embedding_t, embedding_q, threshold=threshold)
+
+
+    def llm_spans(self, token_t_obj: BatchEncoding, batch_index: int, embedding_t: torch.Tensor, embedding_q: torch.Tensor, *, threshold=0.5) -> List[Tuple[int,int]]:
+        """Character spans of the target tokens (item `batch_index` of `token_t_obj`) that match the query"""
+        token_t = token_t_obj.tokens(batch_index)[:len(embedding_t)]
 
         # find the match score for every token in the target string compared to the query
-        matchings = torch.stack([torch.nn.functional.cosine_similarity(q, embedding_t) for q in embedding_q])
+        matchings = Highlighter.similarities(embedding_q, embedding_t)
 
         # determine which tokens in the target are above the match threshold
         matched_tokens = (matchings > threshold).any(dim=0)
@@ -157,8 +198,8 @@ class Highlighter:
         # 3. convert the token indices to character indices in the original text
         highlight_char_spans = []
         for start, end in merged_spans:
-            start_char = token_t_obj.token_to_chars(start).start
-            end_char = token_t_obj.token_to_chars(end).end
+            start_char = token_t_obj.token_to_chars(batch_index, start).start
+            end_char = token_t_obj.token_to_chars(batch_index, end).end
             highlight_char_spans.append((start_char, end_char))
 
         return highlight_char_spans
@@ -167,6 +208,10 @@ class Highlighter:
     def highlight(self, query: str, target: str, *, threshold=0.5, embedding_q=torch.Tensor) -> List[Highlight]:
         """Highlight a single target string given a query"""
         llm_spans = self.highlight_llm(query, target, threshold=threshold, embedding_q=embedding_q)
+        return self.combine_spans(query, target, llm_spans)
+
+    def combine_spans(self, query: str, target: str, llm_spans: List[Tuple[int,int]]) -> List[Highlight]:
+        """Merge the language model spans with the exact word matches of the query"""
         exact_spans = self.highlight_exact(query, target)
         spans = llm_spans + exact_spans
         spans = Highlighter.merge_char_spans(spans)
@@ -174,9 +219,12 @@ class Highlighter:
         return highlight_list
 
     def highlight_multiple(self, query: str, targets: List[str], *, threshold=0.5) -> List[List[Highlight]]:
-        """highlight multiple target strings given a query"""
+        """highlight multiple target strings given a query, embedding the targets in batches"""
         _, embedding_q = self.embed(query)
-        highlight_lists = [self.highlight(query, target, threshold=threshold, embedding_q=embedding_q) for target in targets]
+        highlight_lists = []
+        for target, (token_t_obj, batch_index, embedding_t) in zip(targets, self.embed_batch(targets)):
+            llm_spans = self.llm_spans(token_t_obj, batch_index, embedding_t, embedding_q, threshold=threshold)
+            highlight_lists.append(self.combine_spans(query, target, llm_spans))
         return highlight_lists
 
 
@@ -235,6 +283,3 @@ def terminal_highlight_print(highlight_list:List[Highlight], background='bright_
             print(chunk, end='')
     print()
 
-
-# This is slow to init, exporting singleton once:
-highlighter = Highlighter()
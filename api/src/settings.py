@@ -9,6 +9,14 @@ class Settings(BaseSettings):
     BIND_PORT: int = 8000
     ELASTICSEARCH_URL: str
     ELASTICSEARCH_PORT: int = 9200
+    # Shared client, see src/elasticsearch_client.py
+    ELASTICSEARCH_POOL_SIZE: int = 25
+    ELASTICSEARCH_TIMEOUT: int = 30
+    ELASTICSEARCH_MAX_RETRIES: int = 3
+    # Timed out requests may still have been applied: retrying them would
+    # apply writes (index without id, delete_by_query, bulk) twice
+    ELASTICSEARCH_RETRY_ON_TIMEOUT: bool = False
+    ELASTICSEARCH_HTTP_COMPRESS: bool = True
     DMC_URL: str
     DMC_PORT: int = 8080
     DMC_USER: str
@@ -20,6 +28,36 @@ class Settings(BaseSettings):
     REDIS_HOST: str
     REDIS_PORT: int = 6379
 
+    # Text embeddings cache, see src/embedding_cache.py. Redis entries take
+    # about 6KB each (float32 ada-002 embeddings): 10000 entries is about 60MB.
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 2048
+    EMBEDDING_CACHE_REDIS_MAX_ENTRIES: int = 10000
+    EMBEDDING_CACHE_TTL: int = 60 * 60 * 24 * 7
+
+    # Max indicators listed by /indicators/latest and /indicators/ncfiles
+    INDICATOR_LISTING_MAX_SIZE: int = 10000
+    # Seconds after which those listings are rebuilt from Elasticsearch, see src/indicator_listings.py
+    INDICATOR_LISTING_TTL: int = 60 * 60
+
+    # Seconds model statuses are cached for, 0 disables it, see src/model_status.py
+    MODEL_STATUS_CACHE_TTL: float = 0
+
+    # Dataset previews, see src/previews.py
+    PREVIEW_CACHE_TTL: int = 60 * 60 * 24
+    PREVIEW_CSV_MAX_BYTES: int = 1024 * 1024
+
+    # Point in time keep alive of paginated searches, see src/pagination.py
+    PAGINATION_KEEP_ALIVE: str = "2m"
+
+    # "exact" (script_score) or "knn" (HNSW). knn is unsupported by Elasticsearch 7.x
+    # and ignored unless the cluster runs >= 8.8, see src/vector_search.py
+    VECTOR_SEARCH_MODE: str = "exact"
+    VECTOR_SEARCH_CANDIDATES_FACTOR: int = 10
+    VECTOR_SEARCH_MAX_CANDIDATES: int = 10000
+
+    # Max paragraphs embedded per forward pass by src/semantic_highlighter.py
+    HIGHLIGHT_BATCH_SIZE: int = 32
+
     DOCKERHUB_URL: str = ""
     DOCKERHUB_USER: str = ""
     DOCKERHUB_PWD: str = ""
@@ -31,6 +69,15 @@ class Settings(BaseSettings):
 
     CONFIG_STORAGE_BASE: str = "s3://dojo/configs/"
 
+    # Bytes per chunk when streaming files from S3 to clients
+    RAWFILE_STREAM_CHUNK_SIZE: int = 1024 * 1024
+
+    # Rows per parquet batch read and CSV-encoded at once by /dojo/download/csv
+    CSV_STREAM_BATCH_SIZE: int = 50000
+    # Long format rows pivoted at once when streaming wide format CSVs
+    WIDE_FORMAT_PARTITION_SIZE: int = 1000000
+    WIDE_FORMAT_CACHE_BASE: str = "s3://dojo/wide-format-cache/"
+
     OCR_URL: str = ""
 
     UVICORN_RELOAD: bool = False
@@ -1,6 +1,10 @@
 import csv
+import hashlib
+import json
 import os
+import pickle
 import re
+import shutil
 import tempfile
 import time
 from collections import namedtuple
@@ -8,17 +12,24 @@ from datetime import date
 from io import BytesIO, StringIO
 from typing import Optional
 from urllib.parse import urlparse
+from urllib.request import urlopen
 from zlib import compressobj
 
 import boto3
 import botocore
+import fsspec
+import numpy as np
 import pandas as pd
-from elasticsearch import Elasticsearch
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.elasticsearch_client import get_es
+from fastapi import Response
 from fastapi.logger import logger
+from fastapi.responses import StreamingResponse
 from src.settings import settings
 from validation import ModelSchema
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+es = get_es()
 s3 = boto3.client(
     "s3",
     endpoint_url=os.getenv("STORAGE_HOST") or None,
@@ -178,6 +189,65 @@ def get_rawfile(path):
     return raw_file
 
 
+RANGE_PATTERN = re.compile(r"^bytes=(\d+-\d*|-\d+)$")
+
+
+def stream_rawfile(path, range_header=None, media_type=None, headers=None):
+    """Streams a file from S3 to the client without spooling it.
+
+    Args:
+        path (str): URI to file
+        range_header (str): The request `Range` header, a single byte range
+        is honoured, anything else is answered with the whole file.
+        media_type (str): Content type of the response.
+        headers (dict): Additional response headers.
+
+    Raises:
+        FileNotFoundError: If the file cannnot be found on S3.
+
+    Returns:
+        StreamingResponse: 206 with the requested range, 416 when it is
+        not satisfiable, 200 with the whole file otherwise.
+    """
+    file_info = normalize_file_info(path)
+    options = {"Bucket": file_info.bucket, "Key": file_info.path}
+    if range_header and RANGE_PATTERN.match(range_header.strip()):
+        options["Range"] = range_header.strip()
+
+    try:
+        s3_object = s3.get_object(**options)
+    except botocore.exceptions.ClientError as error:
+        if error.response.get("Error", {}).get("Code") == "InvalidRange":
+            size = s3.head_object(Bucket=file_info.bucket, Key=file_info.path)["ContentLength"]
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{size}"}
+            )
+        raise FileNotFoundError() from error
+
+    headers = {
+        **(headers or {}),
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(s3_object["ContentLength"]),
+    }
+    if s3_object.get("ETag"):
+        headers["ETag"] = s3_object["ETag"]
+    if s3_object.get("ContentRange"):
+        headers["Content-Range"] = s3_object["ContentRange"]
+
+    def chunks():
+        try:
+            yield from s3_object["Body"].iter_chunks(settings.RAWFILE_STREAM_CHUNK_SIZE)
+        finally:
+            s3_object["Body"].close()
+
+    return StreamingResponse(
+        chunks(),
+        status_code=206 if "Content-Range" in headers else 200,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
 def put_rawfile(path, fileobj):
     """Puts/uploads a file at URI specified
     Args:
@@ -205,56 +275,398 @@ def list_files(path):
     return final_file_list
 
 
-async def stream_csv_from_data_paths(data_paths, wide_format="false"):
-
-    storage_options = {
+def get_storage_options():
+    return {
         "key": os.getenv("AWS_ACCESS_KEY_ID"),
         "secret": os.getenv("AWS_SECRET_ACCESS_KEY"),
         "token": None,
         "client_kwargs": {"endpoint_url": os.getenv("STORAGE_HOST") or None},
     }
 
-    # Build single dataframe
-    df = pd.concat(
-        pd.read_parquet(
-            file, storage_options=None if file.startswith("http") else storage_options
+
+def open_parquet_file(path):
+    """Opens a parquet file for incremental, row-group by row-group reads.
+
+    Args:
+        path (str): s3://, http(s):// or local path to a parquet file.
+
+    Returns:
+        pyarrow.parquet.ParquetFile
+    """
+    if path.startswith("http"):
+        # Remote files are spooled to disk so that the parquet footer can be
+        # seeked to without holding the whole file in memory.
+        spool = tempfile.TemporaryFile()
+        with urlopen(path) as remote:
+            shutil.copyfileobj(remote, spool)
+        spool.seek(0)
+        return pq.ParquetFile(spool)
+    if urlparse(path).scheme == "s3":
+        return pq.ParquetFile(fsspec.open(path, mode="rb", **get_storage_options()).open())
+    return pq.ParquetFile(path)
+
+
+def _columns_with_nulls(parquet_file, column_names):
+    """
+    Returns which of `column_names` hold at least one null in the file, using
+    the row group statistics when present and reading the column otherwise.
+    """
+    metadata = parquet_file.metadata
+    schema_names = parquet_file.schema_arrow.names
+    nullable = set()
+    for name in column_names:
+        position = schema_names.index(name)
+        for row_group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(row_group).column(position).statistics
+            if statistics is None or not statistics.has_null_count:
+                if parquet_file.read(columns=[name]).column(0).null_count:
+                    nullable.add(name)
+                break
+            if statistics.null_count:
+                nullable.add(name)
+                break
+    return nullable
+
+
+def _pandas_dtypes(parquet_file):
+    """
+    Pandas dtypes `pd.read_parquet` would give this file's columns, derived
+    from the schema and footer statistics without reading any data.
+    """
+    dtypes = parquet_file.schema_arrow.empty_table().to_pandas().dtypes.to_dict()
+    promotable = [
+        name for name, dtype in dtypes.items() if dtype.kind in "iub"
+    ]
+    for name in _columns_with_nulls(parquet_file, promotable):
+        # Arrow gives nullable ints as floats and nullable bools as objects
+        dtypes[name] = (
+            pd.api.types.pandas_dtype("object")
+            if dtypes[name].kind == "b"
+            else pd.api.types.pandas_dtype("float64")
         )
-        for file in data_paths
-    )
+    return dtypes
+
 
-    # Ensure pandas floats are used because vanilla python ones are problematic
-    df = df.fillna("").astype(
+def plan_csv_columns(parquet_files):
+    """
+    Works out the output columns and numeric dtypes that concatenating all
+    `parquet_files` with `pd.concat` would produce, so that batches can be
+    streamed one at a time and still be rendered exactly like the full frame.
+
+    Returns:
+        tuple: list of column names, for each file a dict of column name to
+        the numeric dtype its batches have to be cast to before rendering,
+        and the float32 columns holding a null in any file, see
+        `encode_csv_rows`.
+    """
+    file_dtypes = [
+        (parquet_file.metadata.num_rows, _pandas_dtypes(parquet_file))
+        for parquet_file in parquet_files
+    ]
+    nullable = set()
+    for parquet_file, (_, dtypes) in zip(parquet_files, file_dtypes):
+        floats = [name for name, dtype in dtypes.items() if dtype == "float32"]
+        nullable |= _columns_with_nulls(parquet_file, floats)
+
+    columns = []
+    for _, dtypes in file_dtypes:
+        columns.extend(name for name in dtypes if name not in columns)
+
+    numeric_targets = {}
+    for name in columns:
+        present = [dtypes[name] for _, dtypes in file_dtypes if name in dtypes]
+        if not all(dtype.kind in "iuf" for dtype in present):
+            continue
+        target = np.result_type(*present)
+        missing_somewhere = any(
+            num_rows and name not in dtypes for num_rows, dtypes in file_dtypes
+        )
+        if missing_somewhere and target.kind in "iu":
+            # Filling the gaps with NaN promotes the whole column to float
+            target = np.dtype("float64")
+        if missing_somewhere:
+            nullable.add(name)
+        numeric_targets[name] = target
+
+    casts = [
         {
-            col: "str"
-            for col in df.select_dtypes(include=["float32", "float64"]).columns
-        },
-        # Note: This links it to the previous `df` so not a full copy
-        copy=False,
+            name: numeric_targets.get(name, dtype)
+            for name, dtype in dtypes.items()
+            if dtype.kind in "iuf"
+        }
+        for _, dtypes in file_dtypes
+    ]
+    widened = {name for name in nullable if numeric_targets.get(name) == "float32"}
+    return columns, casts, widened
+
+
+def csv_cells(series):
+    """
+    Returns the column as python objects that the csv module renders exactly
+    like `str()` would. The csv module stringifies ints, bools and objects with
+    str() and float64s with repr(), which is the same text; float32 are
+    formatted by pandas as they would otherwise be widened to doubles first.
+    """
+    if series.dtype == "float32":
+        return series.astype(str)
+    return series.astype(object)
+
+
+def encode_csv_rows(df, writer, widened=()):
+    """
+    Writes every row of `df` through the csv `writer` in one call, producing
+    exactly what writing `str()` of each cell row by row would.
+
+    `widened` float32 columns hold nulls somewhere in the whole dataset.
+    Filling those nulls turns the whole column into doubles, so they are
+    rendered as doubles in every batch, with or without nulls.
+    """
+    df = df.astype({col: "float64" for col in widened if col in df}).fillna("")
+    cells = [csv_cells(df[col]).tolist() for col in df.columns]
+    writer.writerows(zip(*cells))
+
+
+def drain_buffer(buffer):
+    content = buffer.getvalue()
+    buffer.seek(0)  # To clear the buffer we need to seek back to the start and truncate
+    buffer.truncate()
+    return content
+
+
+def iter_parquet_batches(parquet_file, batch_size, columns=None):
+    """
+    Yields the file as pandas dataframes of at most `batch_size` rows, keeping
+    the pandas metadata so columns come back as `pd.read_parquet` builds them.
+    """
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        if columns:
+            yield batch.to_pandas()
+        else:
+            yield pa.Table.from_batches([batch], schema=parquet_file.schema_arrow).to_pandas()
+
+
+def iter_aligned_batches(parquet_files, columns, casts, batch_size):
+    """
+    Yields batches of all `parquet_files` with the columns and dtypes the
+    concatenation of the whole files would have, see `plan_csv_columns`.
+    """
+    for parquet_file, cast in zip(parquet_files, casts):
+        for df in iter_parquet_batches(parquet_file, batch_size):
+            yield df.astype(
+                {col: dtype for col, dtype in cast.items() if df[col].dtype != dtype}
+            ).reindex(columns=columns)
+
+
+def plan_wide_partitions(parquet_files, batch_size, partition_size):
+    """
+    Scans only the `timestamp` and `feature` columns to find every feature
+    name and to split the sorted timestamps into ranges of roughly
+    `partition_size` long rows each.
+
+    Returns:
+        tuple: sorted feature names and the timestamp upper bounds of each
+        partition but the last, suitable for `np.searchsorted`.
+    """
+    features = set()
+    timestamp_counts = None
+    for parquet_file in parquet_files:
+        names = parquet_file.schema_arrow.names
+        projection = [col for col in ("timestamp", "feature") if col in names]
+        for df in iter_parquet_batches(parquet_file, batch_size, columns=projection):
+            features.update(df["feature"].dropna().unique())
+            if "timestamp" not in df:
+                continue
+            counts = df["timestamp"].value_counts()
+            timestamp_counts = (
+                counts
+                if timestamp_counts is None
+                else timestamp_counts.add(counts, fill_value=0)
+            )
+
+    boundaries = []
+    if timestamp_counts is not None:
+        rows = 0
+        for timestamp, count in timestamp_counts.sort_index().items():
+            if rows and rows + count > partition_size:
+                boundaries.append(timestamp)
+                rows = 0
+            rows += count
+
+    return sorted(features), boundaries
+
+
+def pivot_wide(df, keys, features):
+    """
+    Pivots a long frame to one row per distinct `keys` combination (timestamp
+    and geography) with one column per feature, sorted by the keys.
+    """
+    df = df.assign(value=csv_cells(df["value"]))
+    wide = (
+        df.groupby(keys + ["feature"], sort=False, dropna=False)["value"]
+        .first()
+        .unstack("feature")
+        .reindex(columns=features)
+        .reset_index()
     )
-    if wide_format == "true":
-        df_wide = pd.pivot(
-            df, index=None, columns="feature", values="value"
-        )  # Reshape from long to wide
-        df = df.drop(["feature", "value"], axis=1)
-        df = pd.merge(df, df_wide, left_index=True, right_index=True)
+    wide.columns.name = None
+    try:
+        return wide.sort_values(keys, kind="stable", na_position="last")
+    except TypeError:
+        # Geography columns mixing strings and numbers can't be ordered
+        return wide.sort_values(keys[:1], kind="stable", na_position="last")
+
+
+def iter_wide_frames(parquet_files, batch_size, partition_size):
+    """
+    Pivots long format parquet files to wide format without holding the
+    whole dataset in memory.
+
+    Rows are spilled to local disk partitioned by timestamp range, then each
+    partition is pivoted and yielded in timestamp order as soon as it is
+    complete, so memory is bounded by `partition_size` long rows.
+
+    Yields:
+        list of output columns first, then the wide dataframe of each
+        partition with every cell already rendered as a string.
+    """
+    columns, casts, _ = plan_csv_columns(parquet_files)
+    keys = [col for col in columns if col not in ("feature", "value")]
+    features, boundaries = plan_wide_partitions(parquet_files, batch_size, partition_size)
+    output_columns = keys + features
+    yield output_columns
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        spill_path = lambda partition: os.path.join(spill_dir, f"{partition}.pickle")
+        for df in iter_aligned_batches(parquet_files, columns, casts, batch_size):
+            if boundaries:
+                partitions = np.searchsorted(boundaries, df["timestamp"], side="right")
+            else:
+                partitions = np.zeros(len(df), dtype=int)
+            for partition in np.unique(partitions):
+                with open(spill_path(partition), "ab") as spill:
+                    pickle.dump(df[partitions == partition], spill)
+
+        for partition in range(len(boundaries) + 1):
+            if not os.path.exists(spill_path(partition)):
+                continue
+            frames = []
+            with open(spill_path(partition), "rb") as spill:
+                while True:
+                    try:
+                        frames.append(pickle.load(spill))
+                    except EOFError:
+                        break
+            os.remove(spill_path(partition))
+
+            wide = pivot_wide(pd.concat(frames), keys, features).fillna("")
+            yield pd.DataFrame(
+                {col: csv_cells(wide[col]).map(str).tolist() for col in output_columns},
+                columns=output_columns,
+            )
+
+
+def file_etag(path):
+    """S3 ETag of the file at `path`, None if it is missing or not on S3."""
+    file_info = normalize_file_info(path)
+    if not path.startswith("s3") or file_info is None:
+        return None
+    try:
+        return s3.head_object(Bucket=file_info.bucket, Key=file_info.path)["ETag"]
+    except botocore.exceptions.ClientError:
+        return None
+
+
+def wide_format_cache_path(index, obj_id, data_paths):
+    """
+    Location of the cached wide format parquet for a dataset or run version.
+
+    The version is derived from the S3 ETags of `data_paths`, so appending or
+    rescaling files yields a new cache entry. Returns None when any of the
+    files is not on S3 and the version can't be determined.
+    """
+    fingerprint = []
+    for path in data_paths:
+        etag = file_etag(path)
+        if etag is None:
+            return None
+        fingerprint.append([path, etag])
+
+    version = hashlib.sha256(json.dumps(fingerprint).encode()).hexdigest()
+    return f"{settings.WIDE_FORMAT_CACHE_BASE}{index}/{obj_id}/{version}.parquet"
+
 
-    # Prepare for writing CSV to a temporary buffer
+def rawfile_exists(path):
+    file_info = normalize_file_info(path)
+    try:
+        s3.head_object(Bucket=file_info.bucket, Key=file_info.path)
+    except botocore.exceptions.ClientError:
+        return False
+    return True
+
+
+async def stream_csv_from_data_paths(
+    data_paths,
+    wide_format="false",
+    batch_size=settings.CSV_STREAM_BATCH_SIZE,
+    cache_path=None,
+):
+    """
+    Streams the parquet files in `data_paths` out as a single CSV.
+
+    Long format output is read and encoded one parquet batch at a time, so
+    memory is bounded by `batch_size` rows rather than by the dataset.
+
+    Wide format output is pivoted incrementally, see `iter_wide_frames`. When
+    `cache_path` is given the pivoted table is stored there once complete,
+    and served from there as is on subsequent downloads.
+    """
     buffer = StringIO()
     writer = csv.writer(buffer)
 
-    # Write out the header row
-    writer.writerow(df.columns)
+    if wide_format == "true" and cache_path and rawfile_exists(cache_path):
+        data_paths, wide_format = [cache_path], "false"
 
-    yield buffer.getvalue()
-    buffer.seek(0)  # To clear the buffer we need to seek back to the start and truncate
-    buffer.truncate()
+    if wide_format == "true":
+        frames = iter_wide_frames(
+            [open_parquet_file(file) for file in data_paths],
+            batch_size,
+            settings.WIDE_FORMAT_PARTITION_SIZE,
+        )
+        columns = next(frames)
+        schema = pa.schema([(col, pa.string()) for col in columns])
+        spool = tempfile.TemporaryFile() if cache_path else None
+        cache_writer = pq.ParquetWriter(spool, schema) if spool else None
+
+        writer.writerow(columns)
+        yield drain_buffer(buffer)
+        for df in frames:
+            if cache_writer:
+                cache_writer.write_table(
+                    pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                )
+            for start in range(0, len(df), batch_size):
+                encode_csv_rows(df.iloc[start:start + batch_size], writer)
+                yield drain_buffer(buffer)
+
+        if cache_writer:
+            cache_writer.close()
+            spool.seek(0)
+            try:
+                put_rawfile(cache_path, spool)
+            except botocore.exceptions.ClientError as error:
+                logger.warning(f"Could not cache wide format table at {cache_path}: {error}")
+        return
+
+    parquet_files = [open_parquet_file(file) for file in data_paths]
+    columns, casts, widened = plan_csv_columns(parquet_files)
+
+    # Write out the header row
+    writer.writerow(columns)
+    yield drain_buffer(buffer)
 
-    # Iterate over dataframe tuples, writing each one out as a CSV line one at a time
-    for record in df.itertuples(index=False, name=None):
-        writer.writerow(str(i) for i in record)
-        yield buffer.getvalue()
-        buffer.seek(0)
-        buffer.truncate()
+    for df in iter_aligned_batches(parquet_files, columns, casts, batch_size):
+        encode_csv_rows(df, writer, widened)
+        yield drain_buffer(buffer)
 
 
 async def compress_stream(content):
@@ -354,7 +766,7 @@ def group_by_query(data_list):
     }
     for item in data_list:
         # at least one matched_queries contains keyword element/aspect
-        if any(i in keyword_query_names for i in item.get("matched_queries")):
+        if any(i in keyword_query_names for i in item.get("matched_queries", [])):
             grouped_dict["keyword"].append(item)
         else:
             grouped_dict["semantic"].append(item)
@@ -48,3 +48,200 @@ def test_format_hybrid_results__simple():
         {"_id": 8,"_source": {"name": "item8"}, "matched_queries": ["keyword_display_name"]},
         {"_id": 7,"_source": {"name": "item7"}, "matched_queries": ["semantic_search"]},
     ]
+
+
+def legacy_csv_export(paths):
+    """
+    Reference rendering: the whole-frame, row at a time export that the
+    streaming download has to reproduce byte for byte.
+    """
+    import csv
+    from io import StringIO
+    import pandas as pd
+
+    df = pd.concat(pd.read_parquet(path) for path in paths)
+    df = df.fillna("").astype(
+        {col: "str" for col in df.select_dtypes(include=["float32", "float64"]).columns}
+    )
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(df.columns)
+    for record in df.itertuples(index=False, name=None):
+        writer.writerow(str(i) for i in record)
+    return buffer.getvalue()
+
+
+def collect_stream(generator):
+    import asyncio
+
+    async def collect():
+        return "".join([chunk async for chunk in generator])
+
+    return asyncio.run(collect())
+
+
+def test_stream_csv_from_data_paths__matches_whole_frame_export(tmp_path):
+    import pandas as pd
+    from src.utils import stream_csv_from_data_paths
+
+    numeric = pd.DataFrame({
+        "timestamp": [1, 2, 3, 4, 5],
+        "country": ["Ethiopia", "Kenya, East", None, "Sudan", 'say "hi"'],
+        "feature": ["rain"] * 5,
+        "value": [0.1, 2.0, None, 3.5, 1e-7],
+        "count": [1, 2, 3, 4, 5],
+    })
+    strings = pd.DataFrame({
+        "timestamp": [6, 7],
+        "country": ["Chad", "Niger"],
+        "feature": ["crop", "crop"],
+        "value": ["high", "low"],
+        "flag": [True, None],
+    })
+    numeric_path = tmp_path / "output.parquet.gzip"
+    strings_path = tmp_path / "output_str.parquet.gzip"
+    numeric.to_parquet(numeric_path, row_group_size=2)
+    strings.to_parquet(strings_path)
+    paths = [str(numeric_path), str(strings_path)]
+
+    streamed = collect_stream(stream_csv_from_data_paths(paths, batch_size=2))
+
+    assert streamed == legacy_csv_export(paths)
+
+
+def test_stream_csv_from_data_paths__float32_with_nulls_in_one_batch(tmp_path):
+    import numpy as np
+    import pandas as pd
+    from src.utils import stream_csv_from_data_paths
+
+    df = pd.DataFrame({
+        "timestamp": [1, 2, 3, 4],
+        "value": np.array([0.3, 0.7, np.nan, 0.1], dtype="float32"),
+        "weight": np.array([0.3, 0.7, 0.2, 0.1], dtype="float32"),
+    })
+    path = tmp_path / "output.parquet.gzip"
+    df.to_parquet(path, row_group_size=2)
+
+    streamed = collect_stream(stream_csv_from_data_paths([str(path)], batch_size=2))
+
+    assert streamed == legacy_csv_export([str(path)])
+    assert "0.30000001192092896,0.3" in streamed
+
+
+def test_stream_csv_from_data_paths__wide_format_pivots_per_timestamp_and_geo(tmp_path, monkeypatch):
+    import pandas as pd
+    from src import utils
+
+    monkeypatch.setattr(utils.settings, "WIDE_FORMAT_PARTITION_SIZE", 3)
+    rain = pd.DataFrame({
+        "timestamp": [2, 1, 1, 2],
+        "country": ["Kenya", "Kenya", "Chad", None],
+        "feature": ["rain"] * 4,
+        "value": [0.5, 1.0, 2.5, 3.0],
+    })
+    crops = pd.DataFrame({
+        "timestamp": [1, 2, 3],
+        "country": ["Kenya", "Kenya", "Chad"],
+        "feature": ["crop"] * 3,
+        "value": ["high", "low", "none"],
+    })
+    paths = [str(tmp_path / "rain.parquet"), str(tmp_path / "crops.parquet")]
+    rain.to_parquet(paths[0])
+    crops.to_parquet(paths[1])
+
+    streamed = collect_stream(
+        utils.stream_csv_from_data_paths(paths, wide_format="true", batch_size=2)
+    )
+
+    assert streamed.splitlines() == [
+        "timestamp,country,crop,rain",
+        "1,Chad,,2.5",
+        "1,Kenya,high,1.0",
+        "2,Kenya,low,0.5",
+        "2,,,3.0",
+        "3,Chad,none,",
+    ]
+
+
+def test_stream_csv_from_data_paths__wide_format_served_from_cache(tmp_path, monkeypatch):
+    import os
+    import shutil
+    import pandas as pd
+    from src import utils
+
+    def put_local_file(path, fileobj):
+        with open(path, "wb") as cached:
+            shutil.copyfileobj(fileobj, cached)
+
+    monkeypatch.setattr(utils, "put_rawfile", put_local_file)
+    monkeypatch.setattr(utils, "rawfile_exists", os.path.exists)
+
+    path = str(tmp_path / "long.parquet")
+    cache_path = str(tmp_path / "wide.parquet")
+    pd.DataFrame({
+        "timestamp": [1, 1, 2],
+        "country": ["Chad", "Chad", "Mali"],
+        "feature": ["rain", "count", "count"],
+        "value": [0.25, 3, 4],
+    }).to_parquet(path)
+
+    pivoted = collect_stream(
+        utils.stream_csv_from_data_paths([path], wide_format="true", cache_path=cache_path)
+    )
+    os.remove(path)
+    cached = collect_stream(
+        utils.stream_csv_from_data_paths([path], wide_format="true", cache_path=cache_path)
+    )
+
+    assert cached == pivoted
+    assert pivoted.splitlines() == ["timestamp,country,count,rain", "1,Chad,3.0,0.25", "2,Mali,4.0,"]
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+        self.closed = False
+
+    def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeS3:
+    def __init__(self, data):
+        self.data = data
+        self.requests = []
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.requests.append(Range)
+        if Range is None:
+            return {"Body": FakeBody(self.data), "ContentLength": len(self.data), "ETag": '"v1"'}
+        start, end = Range[len("bytes="):].split("-")
+        body = self.data[int(start):int(end) + 1]
+        return {
+            "Body": FakeBody(body),
+            "ContentLength": len(body),
+            "ContentRange": f"bytes {start}-{end}/{len(self.data)}",
+            "ETag": '"v1"',
+        }
+
+
+def test_stream_rawfile_range(monkeypatch):
+    from src import utils
+
+    s3 = FakeS3(b"%PDF-1.4 0123456789")
+    monkeypatch.setattr(utils, "s3", s3)
+
+    response = utils.stream_rawfile("s3://documents/a.pdf", range_header="bytes=0-3")
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 0-3/19"
+    assert response.headers["content-length"] == "4"
+    assert response.headers["etag"] == '"v1"'
+
+    response = utils.stream_rawfile("s3://documents/a.pdf", range_header="bytes=0-1,4-5")
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "bytes"
+    assert s3.requests == ["bytes=0-3", None]
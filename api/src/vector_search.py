@@ -0,0 +1,145 @@
+"""
+Vector (embedding) search clauses for the `features` and
+`document_paragraphs` indices.
+
+Two modes are supported, selected with `settings.VECTOR_SEARCH_MODE`:
+- "exact": brute force `script_score` cosine similarity over every document.
+  Works on any Elasticsearch 7.x cluster, scores are the clamped cosine.
+- "knn": approximate nearest neighbors using the HNSW graph of an indexed
+  `dense_vector` field. Unsupported by the Elasticsearch 7.x cluster: it
+  needs Elasticsearch >= 8.8 (indexed vectors of 1536 dimensions) and the
+  indices reindexed into the es-mappings/*_knn.json mappings, see
+  scripts/reindex_es_index. On older clusters the setting is ignored (logged
+  once), and if the cluster rejects a knn search the exact query is run.
+"""
+from __future__ import annotations
+
+import logging
+from typing import Dict, List, Optional
+
+from elasticsearch.exceptions import RequestError, TransportError
+
+from src.elasticsearch_client import get_es
+from src.settings import settings
+
+logger = logging.getLogger(__name__)
+
+EXACT = "exact"
+KNN = "knn"
+
+EMBEDDINGS_FIELD = "embeddings"
+EMBEDDINGS_DIMS = 1536
+
+# First Elasticsearch version with knn search on indexed 1536 dims vectors
+KNN_MIN_VERSION = (8, 8)
+
+_knn_supported: Optional[bool] = None
+
+
+def cluster_supports_knn() -> bool:
+    """Whether the cluster runs Elasticsearch >= 8.8, checked once per process."""
+    global _knn_supported
+    if _knn_supported is None:
+        try:
+            version = get_es().info()["version"]["number"]
+        except TransportError as error:
+            logger.warning(f"Elasticsearch version unknown, using exact search: {error}")
+            return False
+        _knn_supported = tuple(int(part) for part in version.split(".")[:2]) >= KNN_MIN_VERSION
+        if not _knn_supported:
+            logger.error(
+                f"VECTOR_SEARCH_MODE={KNN} is unsupported on Elasticsearch {version}, "
+                "using exact search"
+            )
+    return _knn_supported
+
+
+def knn_enabled() -> bool:
+    return settings.VECTOR_SEARCH_MODE == KNN and cluster_supports_knn()
+
+
+def dense_vector_mapping(dims: int = EMBEDDINGS_DIMS) -> Dict:
+    """Embeddings mapping, HNSW indexed when running in knn mode."""
+    mapping = {"type": "dense_vector", "dims": dims}
+    if knn_enabled():
+        mapping.update({"index": True, "similarity": "cosine"})
+    return mapping
+
+
+def cosine_script_score(query_vector, query: Optional[Dict] = None, name: Optional[str] = None) -> Dict:
+    """Exact cosine similarity of every document matching `query`."""
+    clause = {
+        "query": query or {"match_all": {}},
+        "script": {
+            # ES doesnt allow negative numbers. We can either:
+            # - a) clamp at 0, and not allow negatives, or
+            # - b) Add 1 to the result to compare score
+            # We use option (a): it has better score % for top results
+            "source": f"Math.max(cosineSimilarity(params.query_vector, '{EMBEDDINGS_FIELD}'), 0)",
+            "params": {"query_vector": query_vector},
+        },
+    }
+    if name:
+        clause["_name"] = name
+    return {"script_score": clause}
+
+
+def knn_clause(query_vector, k: int, filter: Optional[List[Dict]] = None) -> Dict:
+    """Top level `knn` search section returning the `k` nearest neighbors."""
+    k = max(int(k), 1)
+    clause = {
+        "field": EMBEDDINGS_FIELD,
+        "query_vector": [float(value) for value in query_vector],
+        "k": k,
+        "num_candidates": min(
+            max(k * settings.VECTOR_SEARCH_CANDIDATES_FACTOR, k),
+            settings.VECTOR_SEARCH_MAX_CANDIDATES
+        ),
+    }
+    if filter:
+        clause["filter"] = filter
+    return clause
+
+
+def knn_score_to_cosine(score: Optional[float]) -> Optional[float]:
+    """
+    ES scores cosine knn hits as (1 + cosine) / 2. Converts them back to the
+    clamped cosine similarity the exact mode returns.
+    """
+    if score is None:
+        return None
+    return max(2 * score - 1, 0)
+
+
+def knn_search(es, index: str, knn_body: Dict, cosine_scores=True) -> Optional[Dict]:
+    """
+    Runs the single page knn search `knn_body`, or returns None when the
+    cluster rejects it. When `cosine_scores` is set, hit scores are converted
+    to the cosine similarity so they compare with the exact mode.
+    """
+    try:
+        results = es.search(index=index, body=knn_body, size=knn_body["knn"]["k"])
+    except RequestError as error:
+        logger.warning(f"knn search on {index} failed, using exact search: {error}")
+        return None
+
+    if cosine_scores:
+        for hit in results["hits"]["hits"]:
+            hit["_score"] = knn_score_to_cosine(hit["_score"])
+        results["hits"]["max_score"] = knn_score_to_cosine(results["hits"]["max_score"])
+    return results
+
+
+def vector_search(es, index: str, exact_body: Dict, knn_body: Dict, cosine_scores=True, **kwargs):
+    """
+    Runs `knn_body` when knn mode is enabled and `exact_body` otherwise, or
+    when the cluster rejects the knn search. `kwargs` (size, scroll...) are
+    passed to the exact search only, knn results are a single page of
+    nearest neighbors.
+    """
+    if knn_enabled():
+        results = knn_search(es, index, knn_body, cosine_scores)
+        if results is not None:
+            return results
+
+    return es.search(index=index, body=exact_body, **kwargs)
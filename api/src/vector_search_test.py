@@ -0,0 +1,59 @@
+from unittest.mock import MagicMock
+
+from elasticsearch.exceptions import RequestError
+
+from src import vector_search
+from src.settings import settings
+
+
+def test_knn_clause_bounds_candidates():
+    clause = vector_search.knn_clause([0.5, 1], 10, filter=[{"match": {"document_id": "a"}}])
+
+    assert clause["field"] == "embeddings"
+    assert clause["query_vector"] == [0.5, 1.0]
+    assert clause["k"] == 10
+    assert 10 <= clause["num_candidates"] <= settings.VECTOR_SEARCH_MAX_CANDIDATES
+    assert clause["filter"] == [{"match": {"document_id": "a"}}]
+
+
+def test_vector_search_falls_back_to_exact(monkeypatch):
+    monkeypatch.setattr(settings, "VECTOR_SEARCH_MODE", vector_search.KNN)
+    monkeypatch.setattr(vector_search, "_knn_supported", True)
+    exact_results = {"hits": {"hits": [], "max_score": None}}
+    es = MagicMock()
+    es.search.side_effect = [RequestError(400, "parsing_exception", {}), exact_results]
+
+    knn_body = {"knn": vector_search.knn_clause([1, 0], 5)}
+    results = vector_search.vector_search(es, "features", {"query": {}}, knn_body, size=5)
+
+    assert results is exact_results
+    assert es.search.call_args.kwargs == {"index": "features", "body": {"query": {}}, "size": 5}
+
+
+def test_vector_search_knn_scores_are_cosine(monkeypatch):
+    monkeypatch.setattr(settings, "VECTOR_SEARCH_MODE", vector_search.KNN)
+    monkeypatch.setattr(vector_search, "_knn_supported", True)
+    es = MagicMock()
+    es.search.return_value = {"hits": {"hits": [{"_score": 0.9}, {"_score": 0.25}], "max_score": 0.9}}
+
+    knn_body = {"knn": vector_search.knn_clause([1, 0], 2)}
+    results = vector_search.vector_search(es, "document_paragraphs", {}, knn_body)
+
+    assert [hit["_score"] for hit in results["hits"]["hits"]] == [0.8, 0]
+    assert results["hits"]["max_score"] == 0.8
+
+
+def test_knn_mode_is_ignored_before_elasticsearch_8_8(monkeypatch):
+    monkeypatch.setattr(settings, "VECTOR_SEARCH_MODE", vector_search.KNN)
+    monkeypatch.setattr(vector_search, "_knn_supported", None)
+    es = MagicMock()
+    es.info.return_value = {"version": {"number": "7.11.2"}}
+    es.search.return_value = {"hits": {"hits": [], "max_score": None}}
+    monkeypatch.setattr(vector_search, "get_es", lambda: es)
+
+    results = vector_search.vector_search(es, "features", {"query": {}}, {"knn": {}}, size=5)
+
+    assert results is es.search.return_value
+    assert es.search.call_args.kwargs["body"] == {"query": {}}
+    assert vector_search.dense_vector_mapping() == {"type": "dense_vector", "dims": 1536}
+    assert es.info.call_count == 1
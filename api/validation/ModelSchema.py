@@ -372,6 +372,12 @@ class ModelMetadataSchema(BaseModel):
         None, description="UUID of the pervious version", title="previous model version"
     )
 
+    lineage_id: Optional[str] = Field(
+        None,
+        description="UUID of the first version of the model, shared by all of its versions",
+        title="model lineage",
+    )
+
     is_published: bool = Field(
         description="Indicates whether the model has been published or is in a finalized state",
         title="Is the model published/finalized",
@@ -0,0 +1,18 @@
+import os
+import sys
+
+# Task modules import each other as top level modules (`from utils import ...`),
+# as the rq workers run them from this directory.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Modules shared with the API (`src.<module>`), /api is on the workers' PYTHONPATH
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "api"))
+
+# Required settings, for modules creating clients at import time
+for name, value in {
+    "DATASET_STORAGE_BASE_URL": "s3://test-datasets/",
+    "DOCUMENT_STORAGE_BASE_URL": "s3://test-documents/",
+    "DOJO_URL": "http://dojo.test",
+    "OCR_URL": "http://ocr.test",
+    "TERMINAL_ENDPOINT": "http://terminal.test",
+}.items():
+    os.environ.setdefault(name, value)
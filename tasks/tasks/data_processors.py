@@ -8,7 +8,7 @@ import shutil
 import pandas as pd
 import numpy as np
 
-from utils import get_rawfile
+from utils import read_csv_dataframe
 from settings import settings
 
 logging.basicConfig()
@@ -24,8 +24,7 @@ def describe_data(context, filename=None):
     rawfile_path = os.path.join(
         settings.DATASET_STORAGE_BASE_URL, context["uuid"], filename
     )
-    file = get_rawfile(rawfile_path)
-    df = pd.read_csv(file, delimiter=",")
+    df = read_csv_dataframe(rawfile_path)
     return describe_df(df)
 
 
@@ -49,6 +49,8 @@ def finish_dataset_registration(context, filename=None, **kwargs):
     }
     del update_body["data_files"]
     del update_body["preview"]
+    # Job stats, not dataset metadata
+    update_body.pop("timings", None)
 
     updated_dataset = {**context["dataset"], **update_body}
 
@@ -8,16 +8,19 @@ import requests
 import shutil
 from urllib.parse import urlparse
 import pandas as pd
-import numpy as np
 
 import sys
+import time
+from multiprocessing import get_context
 
-from utils import get_rawfile, put_rawfile, download_rawfile
+import pyarrow.parquet as pq
+
+from utils import get_parquet_metadata, get_rawfile, put_rawfile
 from elwood import elwood as mix
 from elwood import feature_normalization as scaler
 from resolution_processors import (
-    calculate_geographical_resolution,
-    calculate_temporal_resolution,
+    geographical_resolution_result,
+    temporal_resolution_result,
 )
 from base_annotation import BaseProcessor
 from settings import settings
@@ -25,6 +28,23 @@ from settings import settings
 logging.basicConfig()
 logging.getLogger().setLevel(logging.DEBUG)
 
+# Rows of the preview artifact written at registration, as previewed by the API
+PREVIEW_ROWS = 100
+
+# Parquet metadata key of the per feature statistics of a processed file
+FEATURE_STATS_KEY = b"dojo.feature_stats"
+
+# Appended to the path of processed files registered before statistics were
+# stored in their footer: the statistics are stored next to them instead
+FEATURE_STATS_SIDECAR_SUFFIX = ".stats.json"
+
+# Normalizations computed by scale_features: scaling method, dataset key of
+# the normalized files and their file ending
+NORMALIZATIONS = [
+    (scaler.zero_to_one_normalization, "data_paths_normalized", "_normalized.parquet.gzip"),
+    (scaler.robust_normalization, "data_paths_normalized_robust", "_normalized_robust.parquet.gzip"),
+]
+
 def build_elwood_meta_from_context(context, filename=None):
     metadata = context["annotations"]["metadata"]
     if "files" in metadata:
@@ -122,6 +142,52 @@ class ElwoodProcessor(BaseProcessor):
         return ret
 
 
+def write_preview_artifact(path, sources, rows=PREVIEW_ROWS):
+    """
+    Stores the preview of the processed files at `path`, so that the API can
+    serve it without reading them. `sources` maps each uploaded file name to
+    its local path and ETag; the ETags are stored with the preview rows so the
+    API only uses them while the files are unchanged (see api/src/previews.py).
+    """
+    if not sources or any(etag is None for _, etag in sources.values()):
+        return
+    try:
+        # Numeric parquet first, then the string one, as previewed by the API
+        names = sorted(sources)
+        df = pd.concat([pd.read_parquet(sources[name][0]) for name in names])
+        obj = json.loads(
+            df.sort_index().reset_index(drop=True).head(rows).to_json(orient="index")
+        )
+        artifact = {
+            "sources": {name: sources[name][1] for name in names},
+            "rows": [{"__id": key, **value} for key, value in obj.items()],
+        }
+        put_rawfile(path=path, fileobj=io.BytesIO(json.dumps(artifact).encode("utf-8")))
+    except Exception as e:
+        logging.warning(f"Failed to write preview artifact {path}: {e}")
+
+
+def primary_date_column(annotations):
+    """Name and time format of the primary date annotation, empty when missing."""
+    for date in annotations["date"]:
+        if date.get("primary_date", None):
+            return date["name"], date["time_format"]
+    return "", ""
+
+
+def primary_latlon_columns(annotations):
+    """Latitude and longitude columns of the primary geo pair, empty when missing."""
+    lat_col = ""
+    lon_col = ""
+    for geo in annotations["geo"]:
+        if geo.get("primary_geo", None) and geo.get("is_geo_pair", None):
+            if geo["geo_type"] == "latitude":
+                return geo["name"], geo["is_geo_pair"]
+            lat_col = geo["is_geo_pair"]
+            lon_col = geo["name"]
+    return lat_col, lon_col
+
+
 def run_elwood(context, filename=None, on_success_endpoint=None):
     """
     Initializes an elwood processor, which normalizes the dataset. Supports
@@ -135,6 +201,9 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
     """
     processor = ElwoodProcessor()
     uuid = context["uuid"]
+    # Seconds spent in each stage, reported in the result
+    timings = {}
+    stage_start = time.perf_counter()
     # Creating folder for temp file storage on the rq worker since following functions are dependent on file paths
     datapath = f"./{uuid}"
     if not os.path.isdir(datapath):
@@ -159,6 +228,7 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
     raw_file_obj = get_rawfile(rawfile_path)
     with open(f"{datapath}/{filename}", "wb") as f:
         f.write(raw_file_obj.read())
+    timings["download"] = time.perf_counter() - stage_start
 
     # Writing out the annotations because elwood needs a filepath to this data.
     # Should probably change elwood down the road to accept filepath AND annotations objects.
@@ -169,8 +239,30 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
         f.write(json.dumps(mm_ready_annotations))
     f.close()
 
+    # Resolution detection columns, read from the local copy of the raw file
+    # instead of downloading and parsing it again from storage.
+    stage_start = time.perf_counter()
+    datetime_column, time_format = primary_date_column(mm_ready_annotations)
+    lat_col, lon_col = primary_latlon_columns(mm_ready_annotations)
+    resolution_columns = [
+        column for column in [datetime_column, lat_col, lon_col] if column
+    ]
+    resolution_df = (
+        pd.read_csv(
+            f"{datapath}/{filename}",
+            delimiter=",",
+            usecols=lambda column: column in resolution_columns,
+        )
+        if resolution_columns
+        else None
+    )
+    timings["load"] = time.perf_counter() - stage_start
+
     # Main Call
+    stage_start = time.perf_counter()
     elwood_result_df = processor.run(context, datapath, filename)
+    timings["elwood"] = time.perf_counter() - stage_start
+    stage_start = time.perf_counter()
 
     file_suffix_match = re.search(r"raw_data(_\d+)?\.", filename)
     if file_suffix_match:
@@ -179,6 +271,7 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
         file_suffix = ""
 
     data_files = []
+    preview_sources = {}
     # Takes all parquet files and puts them into the DATASET_STORAGE_BASE_URL which will be S3 in Production
     dest_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, uuid)
     for local_file in os.listdir(datapath):
@@ -189,8 +282,13 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
             dest_file_path = os.path.join(
                 dest_path, f"{file_root}{file_suffix}.parquet.gzip"
             )
+            if not local_file_match or not local_file_match.group(2):
+                write_feature_statistics(os.path.join(datapath, local_file))
             with open(os.path.join(datapath, local_file), "rb") as fileobj:
-                put_rawfile(path=dest_file_path, fileobj=fileobj)
+                etag = put_rawfile(path=dest_file_path, fileobj=fileobj)
+            preview_sources[os.path.basename(dest_file_path)] = (
+                os.path.join(datapath, local_file), etag
+            )
             if dest_file_path.startswith("s3:") and not settings.STORAGE_HOST:
                 # "https://jataware-world-modelers.s3.amazonaws.com/dev/indicators/6c9c996b-a175-4fa6-803c-e39b24e38b6e/6c9c996b-a175-4fa6-803c-e39b24e38b6e.parquet.gzip"
                 location_info = urlparse(dest_file_path)
@@ -200,8 +298,14 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
             else:
                 data_files.append(dest_file_path)
 
+    write_preview_artifact(
+        os.path.join(dest_path, f"{uuid}{file_suffix}.preview.json"), preview_sources
+    )
+
     # Final cleanup of temp directory
     shutil.rmtree(datapath)
+    timings["upload"] = time.perf_counter() - stage_start
+    stage_start = time.perf_counter()
 
     dataset = context.get("dataset")
     if dataset.get("period", None):
@@ -228,11 +332,12 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
     for geog_type in ["admin1", "admin2", "admin3", "country"]:
         if geog_type not in geography_dict:
             geography_dict[geog_type] = []
-        for value in elwood_result_df[elwood_result_df[geog_type].notna()][
-            geog_type
-        ].unique():
-            if value == "nan" or value in geography_dict[geog_type]:
+        known = set(geography_dict[geog_type])
+        known.add("nan")
+        for value in elwood_result_df[geog_type].dropna().unique():
+            if value in known:
                 continue
+            known.add(value)
             geography_dict[geog_type].append(value)
 
     # Outputs
@@ -327,38 +432,9 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
         qualifier_outputs.append(qualifier_output)
 
     # Resolution Detection
-
-    datetime_column = ""
-    time_format = ""
-    lat_col = ""
-    lon_col = ""
     temporal_resolution_value = None
     geographical_resolution_value = None
 
-    # Loops through annotations looking for primary fields to detect resoltuion on.
-    for date in mm_ready_annotations["date"]:
-        if date.get("primary_date", None):
-            datetime_column = date["name"]
-            time_format = date["time_format"]
-            break
-
-    for geo in mm_ready_annotations["geo"]:
-        if geo.get("primary_geo", None) and geo.get("is_geo_pair", None):
-            if geo["geo_type"] == "latitude":
-                lat_col = geo["name"]
-                lon_col = geo["is_geo_pair"]
-                break
-            lat_col = geo["is_geo_pair"]
-            lon_col = geo["name"]
-
-    # Tries to combine all primaries found for detection.
-    kwargs = {
-        "datetime_column": datetime_column,
-        "time_format": time_format,
-        "lat_column": lat_col,
-        "lon_column": lon_col,
-    }
-
     # Maps cartwright output units to dojo indicator metadata resolution schema.
     temporal_resolution_mapping = {
         "day": "daily",
@@ -375,8 +451,8 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
 
     # Calculates temporal resolution
     if datetime_column and time_format:
-        temporal_resolution = calculate_temporal_resolution(
-            context=context, filename=filename, **kwargs
+        temporal_resolution = temporal_resolution_result(
+            resolution_df, datetime_column, time_format
         )
         if temporal_resolution and temporal_resolution["resolution_result"] != "None":
             temporal_resolution_value = temporal_resolution_mapping[
@@ -384,8 +460,8 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
             ]
     # Calculates geographical resolution (Note: Cartwright can only detect on lat/lon geo)
     if lat_col and lon_col:
-        geographical_resolution = calculate_geographical_resolution(
-            context=context, filename=filename, **kwargs
+        geographical_resolution = geographical_resolution_result(
+            resolution_df, lat_col, lon_col
         )
         if (
             geographical_resolution
@@ -394,6 +470,7 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
             geographical_resolution_value = geographical_resolution[
                 "resolution_result"
             ]["resolution"]
+    timings["metadata"] = time.perf_counter() - stage_start
 
     # Constructs final elwood response to update metadata in dojo
     response = {
@@ -404,7 +481,9 @@ def run_elwood(context, filename=None, on_success_endpoint=None):
         "outputs": outputs,
         "qualifier_outputs": qualifier_outputs,
         "feature_names": feature_names,
+        "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
     }
+    logging.info(f"Elwood stage timings for {uuid}: {response['timings']}")
 
     # Appends resolutions if they exist
     if temporal_resolution_value:
@@ -470,6 +549,65 @@ def run_model_elwood(context, *args, **kwargs):
     return response
 
 
+def feature_statistics(dataframe):
+    """
+    Min, max and count of the values of each feature of a processed (long
+    format) dataframe.
+    """
+    values = pd.to_numeric(dataframe["value"], errors="coerce").groupby(dataframe["feature"])
+    summary = values.agg(["min", "max", "count"])
+
+    def number(value):
+        return None if pd.isna(value) else float(value)
+
+    return {
+        str(feature): {
+            "min": number(row["min"]),
+            "max": number(row["max"]),
+            "count": int(row["count"]),
+        }
+        for feature, row in summary.iterrows()
+    }
+
+
+def write_feature_statistics(local_path):
+    """
+    Stores the feature statistics of a processed parquet file in its footer
+    metadata, so rescaling reads them without downloading the file.
+    """
+    table = pq.read_table(local_path)
+    stats = feature_statistics(table.to_pandas())
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), FEATURE_STATS_KEY: json.dumps(stats).encode("utf-8")}
+    )
+    pq.write_table(table, local_path, compression="gzip")
+
+
+def file_feature_statistics(path):
+    """
+    Feature statistics of a processed parquet file, from its footer metadata.
+    Files registered before statistics were stored are left untouched: they
+    are summarized once and their statistics stored in a sidecar object.
+    """
+    stats = get_parquet_metadata(path).get(FEATURE_STATS_KEY)
+    if stats is not None:
+        return json.loads(stats)
+
+    sidecar_path = f"{path}{FEATURE_STATS_SIDECAR_SUFFIX}"
+    try:
+        return json.load(get_rawfile(sidecar_path))
+    except FileNotFoundError:
+        pass
+
+    logging.info(f"No feature statistics for {path}, storing them in {sidecar_path}")
+    stats = feature_statistics(pd.read_parquet(get_rawfile(path)))
+    try:
+        put_rawfile(path=sidecar_path, fileobj=io.BytesIO(json.dumps(stats).encode("utf-8")))
+    except Exception as e:
+        logging.warning(f"Failed to store feature statistics of {path}: {e}")
+    return stats
+
+
 def scale_features(context, filename=None):
     # 0 to 1 scaled dataframe
 
@@ -477,15 +615,8 @@ def scale_features(context, filename=None):
     # All datapaths need to be collapsed into one key-dict pair, but doing it this
     # way preserves backwards compatibility for downstream tools.
     data_paths = context["dataset"]["data_paths"]
-    data_paths_normalized = context["dataset"].get("data_paths_normalized", [])
-    data_paths_normalized_robust = context["dataset"].get(
-        "data_paths_normalized_robust", []
-    )
     api_url = settings.DOJO_URL
 
-    if not data_paths_normalized:
-        data_paths_normalized = []
-
     if not data_paths:
         request_response = requests.get(f"{api_url}/indicators/{context['uuid']}")
         data_paths = request_response.json().get("data_paths")
@@ -493,142 +624,137 @@ def scale_features(context, filename=None):
     # determine which files have a normalized equivalent
     data_paths_not_str = [path for path in data_paths if "_str" not in path]
 
-    # figure out which files paths are have been normalized
-    # and which are new files that are not yet normalized
-    old_files_normed = generate_files_list(
-        data_paths_not_str=data_paths_not_str,
-        normalized_paths_list=data_paths_normalized,
-        target_suffix="_normalized.parquet.gzip",
-    )
+    # Read once, for both normalizations
+    try:
+        feature_stats = {
+            path: file_feature_statistics(path) for path in data_paths_not_str
+        }
+    except FileNotFoundError:
+        feature_stats = None
+
+    results_dictionary = {}
+    files_to_process = {}
+    for scaling_method, paths_key, file_ending in NORMALIZATIONS:
+        # figure out which files paths are have been normalized
+        # and which are new files that are not yet normalized
+        old_files_normed = generate_files_list(
+            data_paths_not_str=data_paths_not_str,
+            normalized_paths_list=context["dataset"].get(paths_key) or [],
+            target_suffix=file_ending,
+        )
 
-    new_files_not_normed = [
-        path for path in data_paths_not_str if path not in old_files_normed
-    ]
+        new_files_not_normed = [
+            path for path in data_paths_not_str if path not in old_files_normed
+        ]
 
-    data_paths_normalized = scaling_core(
-        uuid=uuid,
-        new_files_not_normed=new_files_not_normed,
-        old_files_normed=old_files_normed,
-        scaling_method=scaler.zero_to_one_normalization,
-    )
-
-    # figure out which files paths are have been normalized_robust
-    # and which are new files that are not yet normalized_robust
-    old_files_normed = generate_files_list(
-        data_paths_not_str=data_paths_not_str,
-        normalized_paths_list=data_paths_normalized_robust,
-        target_suffix="_normalized_robust.parquet.gzip",
-    )
+        for path in scaling_core(
+            new_files_not_normed=new_files_not_normed,
+            old_files_normed=old_files_normed,
+            feature_stats=feature_stats,
+        ):
+            files_to_process.setdefault(path, []).append((scaling_method, file_ending))
 
-    new_files_not_normed = [
-        path for path in data_paths_not_str if path not in old_files_normed
-    ]
+        results_dictionary[paths_key] = [
+            normalized_path(uuid, path, file_ending)
+            for path in new_files_not_normed + old_files_normed
+        ]
 
-    data_paths_normalized_robust = scaling_core(
-        uuid=uuid,
-        new_files_not_normed=new_files_not_normed,
-        old_files_normed=old_files_normed,
-        scaling_method=scaler.robust_normalization,
-        file_ending="_normalized_robust.parquet.gzip",
-    )
-
-    results_dictionary = {
-        "data_paths_normalized": data_paths_normalized,
-        "data_paths_normalized_robust": data_paths_normalized_robust,
-    }
+    rescale_files(uuid, files_to_process)
 
     return results_dictionary
 
 
-def scaling_core(
-    uuid,
-    new_files_not_normed,
-    old_files_normed,
-    scaling_method,
-    scaling_method_options=None,
-    file_ending="_normalized.parquet.gzip",
-):
+def scaling_core(new_files_not_normed, old_files_normed, feature_stats=None):
+    """
+    Files to (re)scale: the new files, and the previously scaled files too
+    when the new files extend the range of a feature.
+    """
     # generate mapping from the old and new files
-    old_mapping = generate_min_max_mapping(old_files_normed)
+    old_mapping = generate_min_max_mapping(old_files_normed, feature_stats)
 
-    new_mapping = generate_min_max_mapping(new_files_not_normed)
+    new_mapping = generate_min_max_mapping(new_files_not_normed, feature_stats)
 
     if new_min_max_values_found(old_mapping=old_mapping, new_mapping=new_mapping):
-        files_to_process = new_files_not_normed + old_files_normed
-    else:
-        files_to_process = new_files_not_normed
+        return new_files_not_normed + old_files_normed
+    return new_files_not_normed
 
-    # rescale files that need processing
-    for path in files_to_process:
-        logging.warn(path)
-        filename = path.split("/")[-1]
-        file_name = path.split("/")[-1].split(".parquet")[0]
-        file_out_name = file_name + file_ending
 
-        # Creating folder for temp file storage on the rq worker since following functions are dependent on file paths
-        localpath = f"/datasets/processing/{uuid}"
-        localfile = os.path.join(localpath, filename)
-        local_outfile = os.path.join(localpath, file_out_name)
-
-        if not os.path.isdir(localpath):
-            os.makedirs(localpath)
-
-        # Copy raw data file into rq-worker
-        # Could change elwood to accept file-like objects as well as filepaths.
-        raw_file_obj = get_rawfile(path)
+def normalized_path(uuid, path, file_ending):
+    file_name = path.split("/")[-1].split(".parquet")[0]
+    return os.path.join(
+        settings.DATASET_STORAGE_BASE_URL, "normalized", uuid, file_name + file_ending
+    )
 
-        dataframe = pd.read_parquet(raw_file_obj)
 
-        if scaling_method_options:
-            dataframe_scaled = scaling_method(dataframe, **scaling_method_options)
-        else:
-            dataframe_scaled = scaling_method(dataframe)
+def rescale_file(uuid, path, normalizations):
+    """
+    Scales a file with each of `normalizations` (scaling method, file ending)
+    from a single read, and uploads the results. Returns the seconds taken.
+    """
+    start = time.perf_counter()
+    dataframe = pd.read_parquet(get_rawfile(path))
 
-        s3_filepath = os.path.join(
-            settings.DATASET_STORAGE_BASE_URL, "normalized", uuid, file_out_name
-        )
+    for scaling_method, file_ending in normalizations:
+        dataframe_scaled = scaling_method(dataframe.copy())
 
         file_buffer = io.BytesIO()
-
         dataframe_scaled.to_parquet(file_buffer)
         file_buffer.seek(0)
 
-        put_rawfile(path=s3_filepath, fileobj=file_buffer)
+        put_rawfile(path=normalized_path(uuid, path, file_ending), fileobj=file_buffer)
 
-    data_paths_normalized = []
-    for path in new_files_not_normed + old_files_normed:
-        file_name = path.split("/")[-1].split(".parquet")[0]
-        file_out_name = file_name + file_ending
-        s3_filepath = os.path.join(
-            settings.DATASET_STORAGE_BASE_URL, "normalized", uuid, file_out_name
-        )
-        data_paths_normalized.append(s3_filepath)
+    return time.perf_counter() - start
 
-    return data_paths_normalized
 
+def rescale_files(uuid, files_to_process):
+    """
+    Rescales files, given as {path: normalizations}, over a pool of up to
+    `RESCALE_WORKERS` processes. Files are rescaled in this process with a
+    single worker.
+    """
+    if not files_to_process:
+        return
+
+    start = time.perf_counter()
+    tasks = [
+        (uuid, path, normalizations)
+        for path, normalizations in files_to_process.items()
+    ]
+    workers = max(1, min(settings.RESCALE_WORKERS, len(tasks)))
+    if workers == 1:
+        timings = [rescale_file(*task) for task in tasks]
+    else:
+        # Spawned, not forked: forked workers would share the S3 client's
+        # open connections with this process.
+        with get_context("spawn").Pool(processes=workers) as pool:
+            timings = pool.starmap(rescale_file, tasks, chunksize=1)
+
+    for (_, path, normalizations), seconds in zip(tasks, timings):
+        logging.info(f"Rescaled {path} ({len(normalizations)} normalizations) in {seconds:.2f}s")
+    logging.info(
+        f"Rescaled {len(tasks)} files with {workers} workers in {time.perf_counter() - start:.2f}s"
+    )
 
-def generate_min_max_mapping(array_of_paths):
-    current_min = None
-    current_max = None
+
+def generate_min_max_mapping(array_of_paths, feature_stats=None):
+    """
+    Min and max of each feature across files, from their stored statistics.
+    `feature_stats` holds statistics already read, by path.
+    """
+    feature_stats = feature_stats or {}
     mapper = {}
     for path in array_of_paths:
-        filename = path.split("/")[-1]
         try:
-            print(path)
-            download_rawfile(path, f"processing/{filename}")
+            stats = feature_stats.get(path) or file_feature_statistics(path)
         except FileNotFoundError as e:
             return {"success": False, "message": "File not found"}
 
-        current_df = pd.read_parquet(f"processing/{filename}")
-
-        features = current_df.feature.unique()
-        for f in features:
-            feat = current_df[current_df["feature"] == f]
-            current_min = np.min(feat["value"])
-            current_max = np.max(feat["value"])
+        for f, feature in stats.items():
+            if feature["min"] is None:
+                continue
             mapper[f] = {
-                "min": min(current_min, mapper.get(f, {}).get("min", current_min)),
-                "max": max(current_max, mapper.get(f, {}).get("max", current_max)),
+                "min": min(feature["min"], mapper.get(f, {}).get("min", feature["min"])),
+                "max": max(feature["max"], mapper.get(f, {}).get("max", feature["max"])),
             }
     return mapper
 
@@ -640,6 +766,8 @@ def new_min_max_values_found(old_mapping, new_mapping):
         return True
 
     for f in new_mapping:
+        if f not in old_mapping:
+            return True
         if new_mapping[f].get("min") < old_mapping[f].get("min"):
             return True
         if new_mapping[f].get("max") > old_mapping[f].get("max"):
@@ -1,10 +1,17 @@
+import hashlib
 import logging
 from base_annotation import BaseProcessor
 from elasticsearch import Elasticsearch
 # import os
 from settings import settings
+from utils import bulk_index
 from jatarag.embedder import AdaEmbedder
-embedder = AdaEmbedder()
+from redis import Redis
+from src.embedding_cache import CachedEmbedder, EmbeddingCache
+embedding_cache = EmbeddingCache.from_settings(
+    settings, Redis(settings.REDIS_HOST, settings.REDIS_PORT)
+)
+embedder = CachedEmbedder(AdaEmbedder(), embedding_cache)
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.DEBUG)
@@ -13,46 +20,109 @@ es_url = settings.ELASTICSEARCH_URL
 es = Elasticsearch(es_url)
 
 
-def calcOutputEmbeddings(output):
+def outputDescription(output):
     """
     Embeddings are created from a subset of the output properties:
     - name, display_name, description, unit, unit_description.
     """
-    description = \
+    return \
         f"""name: {output['name']};
         display name: {output['display_name']};
         description: {output['description']};
         unit: {output['unit']};
         unit description: {output['unit_description']};"""
 
-    # Embedder can embed list of strings. We only pass one,
-    # so we retrieve the one entry on the output array
-    return embedder.embed_paragraphs([description])[0]
+
+def descriptionHash(description):
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
 
 
 def saveAllOutputEmbeddings(indicatorDictionary, indicator_id):
     """
     Saves all outputs within an indicator to elasticsearch,
     including the LLM embeddings to use in search.
+
+    Features are keyed by a hash of the text they are embedded from. On
+    re-publish, outputs whose stored feature is unchanged are skipped
+    entirely, and outputs whose description text is unchanged reuse the
+    stored embeddings. All remaining descriptions are embedded in one
+    batched call and all changed features written with one bulk request.
     """
 
     logging.info("Save all output embeddings called.")
     logging.info(f"Input dictionary: {indicatorDictionary}")
 
-    for index, output in enumerate(indicatorDictionary["outputs"]):
-
-        feature = {
+    features = {}
+    for output in indicatorDictionary["outputs"]:
+        description = outputDescription(output)
+        feature_id = f"{indicator_id}-{output['name']}"
+        features[feature_id] = {
             **output,
-            "embeddings": calcOutputEmbeddings(output),
+            "description_hash": descriptionHash(description),
             "owner_dataset": {
                 "id": indicator_id,
                 "name": indicatorDictionary["name"]
             }
         }
 
-        feature_id = f"{indicator_id}-{output['name']}"
-
-        es.index(index="features", body=feature, id=feature_id)
+    if not features:
+        return True
+
+    stored = {
+        doc["_id"]: doc["_source"]
+        for doc in es.mget(
+            index="features",
+            body={"ids": list(features)},
+            _source_excludes=["embeddings"],
+        )["docs"]
+        if doc.get("found")
+    }
+
+    changed = {
+        feature_id: feature
+        for feature_id, feature in features.items()
+        if stored.get(feature_id) != feature
+    }
+    reusable = [
+        feature_id
+        for feature_id, feature in changed.items()
+        if stored.get(feature_id, {}).get("description_hash") == feature["description_hash"]
+    ]
+
+    embeddings = {}
+    if reusable:
+        for doc in es.mget(
+            index="features",
+            body={"ids": reusable},
+            _source_includes=["embeddings"],
+        )["docs"]:
+            embeddings[stored[doc["_id"]]["description_hash"]] = doc["_source"]["embeddings"]
+
+    descriptions = {}
+    for feature_id, feature in changed.items():
+        if feature["description_hash"] not in embeddings:
+            descriptions[feature["description_hash"]] = outputDescription(feature)
+    if descriptions:
+        embeddings.update(
+            zip(descriptions, embedder.embed_paragraphs(list(descriptions.values())))
+        )
+
+    logging.info(
+        f"{len(features) - len(changed)} of {len(features)} features unchanged, "
+        f"{len(descriptions)} description(s) embedded."
+    )
+
+    bulk_index(es, [
+        {
+            "_index": "features",
+            "_id": feature_id,
+            "_source": {
+                **feature,
+                "embeddings": embeddings[feature["description_hash"]],
+            },
+        }
+        for feature_id, feature in changed.items()
+    ])
 
     return True
 
@@ -7,7 +7,7 @@ import pandas as pd
 
 from elwood import file_processor
 from base_annotation import BaseProcessor
-from utils import DATASET_STORAGE_BASE_URL, get_rawfile, put_rawfile
+from utils import DATASET_STORAGE_BASE_URL, get_rawfile, put_csv_sidecar, put_rawfile
 
 from settings import settings
 
@@ -138,7 +138,10 @@ def file_conversion(context, filename=None):
         csv_file_path = os.path.join(DATASET_STORAGE_BASE_URL, uuid, f"{basename}.csv")
         df.to_csv(temp_output_file, index=False)
         with open(temp_output_file, "rb") as csv_file:
-            put_rawfile(csv_file_path, csv_file)
+            etag = put_rawfile(csv_file_path, csv_file)
+        put_csv_sidecar(
+            csv_file_path, pd.read_csv(temp_output_file, delimiter=","), etag
+        )
 
     return csv_file_path
 
@@ -1,9 +1,8 @@
 import json
 import logging
 
-import pandas as pd
 from elwood import elwood
-from utils import job_setup
+from utils import job_dataframe
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.DEBUG)
@@ -13,8 +12,7 @@ def resolution_alternatives(context, filename=None, **kwargs):
     logging.info("Called GADM resolution alternatives processor.")
 
     # Pre bake
-    file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
+    original_dataframe, filename, rawfile_path = job_dataframe(context=context, filename=filename)
 
     admin_level = kwargs.get("admin_level", "country")
 
@@ -13,7 +13,7 @@ from cartwright import categorize
 
 from base_annotation import BaseProcessor
 from data_processors import describe_df
-from utils import get_rawfile
+from utils import get_rawfile, read_csv_dataframe
 from settings import settings
 
 logging.basicConfig()
@@ -87,8 +87,7 @@ def geotime_classify(context, filename=None):
     rawfile_path = os.path.join(
         settings.DATASET_STORAGE_BASE_URL, context["uuid"], filename
     )
-    file = get_rawfile(rawfile_path)
-    df = pd.read_csv(file, delimiter=",")
+    df = read_csv_dataframe(rawfile_path)
     gc = GeotimeProcessor()
     datapath = f"./data/{context['uuid']}"
 
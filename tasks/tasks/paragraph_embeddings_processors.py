@@ -4,14 +4,16 @@ import time
 import os
 from typing import List, Tuple
 import numpy as np
-from utils import get_rawfile
+from utils import bulk_index, get_rawfile
 from jatarag.embedder import AdaEmbedder
+from redis import Redis
+from src.embedding_cache import CachedEmbedder, EmbeddingCache
 from jatarag.extractor import NougatExtractor
 from settings import settings
 from pypdf import PdfReader
 import ocrmypdf
 
-# import logging
+import logging
 # logging.basicConfig()
 # logging.getLogger().setLevel(logging.INFO)
 es_url = settings.ELASTICSEARCH_URL
@@ -27,7 +29,64 @@ def current_milli_time():
 
 # extractor is only used to convert text to paragraphs. actual extraction is done elsewhere
 extractor = NougatExtractor()
-embedder = AdaEmbedder()
+embedder = CachedEmbedder(
+    AdaEmbedder(),
+    EmbeddingCache.from_settings(
+        settings,
+        Redis(settings.REDIS_HOST, settings.REDIS_PORT)
+        if settings.EMBEDDING_CACHE_PARAGRAPHS_IN_REDIS
+        else None,
+    ),
+)
+
+
+def embed_and_index_paragraphs(document_id, paragraphs):
+    """
+    Embeds paragraphs in batches of `EMBEDDING_BATCH_SIZE` and stores them
+    with bulk requests.
+
+    Args:
+        document_id (str): document the paragraphs belong to.
+        paragraphs (list): (text, page_no) tuples, in document order.
+
+    Returns:
+        dict: per document throughput stats, also logged.
+    """
+    started_at = time.perf_counter()
+    actions = []
+    for batch_start in range(0, len(paragraphs), settings.EMBEDDING_BATCH_SIZE):
+        batch = paragraphs[batch_start:batch_start + settings.EMBEDDING_BATCH_SIZE]
+        embeddings = embedder.embed_paragraphs([text for text, _ in batch])
+        for offset, ((text, page_no), embedding) in enumerate(zip(batch, embeddings)):
+            p_no = batch_start + offset
+            actions.append({
+                "_index": PARAGRAPHS_INDEX,
+                "_id": f"{document_id}-{p_no}",
+                "_source": {
+                    "text": text,
+                    "embeddings": embedding,
+                    "document_id": document_id,
+                    "length": len(text),
+                    "index": p_no,
+                    "page_no": page_no,
+                },
+            })
+    embedded_at = time.perf_counter()
+
+    indexed = bulk_index(es, actions)
+    finished_at = time.perf_counter()
+
+    stats = {
+        "document_id": document_id,
+        "paragraphs": indexed,
+        "embedding_seconds": round(embedded_at - started_at, 3),
+        "indexing_seconds": round(finished_at - embedded_at, 3),
+        "paragraphs_per_second": round(
+            indexed / max(finished_at - started_at, 1e-9), 2
+        ),
+    }
+    logging.info(f"Paragraph ingest throughput: {stats}")
+    return stats
 
 
 class ParagraphProcessor(BaseProcessor):
@@ -49,23 +108,11 @@ class ParagraphProcessor(BaseProcessor):
         text = text.decode()
         paragraphs = extractor.convert_to_paragraphs(text)
 
-        # logging.debug(f"Embedding all Ps. First p: {paragraphs[0]}")
-        embeddings = embedder.embed_paragraphs(paragraphs)
-
-        # logging.debug("Uploading to es.")
-        # 3. For each paragraph, calculate embeddings and index text + embedding
-        for p_no, text in enumerate(paragraphs):
-            p_body = {
-                "text": text,
-                "embeddings": embeddings[p_no],
-                "document_id": document_id,
-                "length": len(text),
-                "index": p_no,
-                "page_no": None  # does external extractor provide page_no?
-            }
-
-            # TODO bulk prepare and bulk upload to speed up processing
-            es.index(index=PARAGRAPHS_INDEX, body=p_body, id=f"{document_id}-{p_no}")
+        # 3. Calculate embeddings and index text + embedding for all paragraphs
+        # page_no: does external extractor provide page_no?
+        stats = embed_and_index_paragraphs(
+            document_id, [(text, None) for text in paragraphs]
+        )
 
         # 4. Updated processed_at time on document
         es.update(index="documents", body={
@@ -75,7 +122,7 @@ class ParagraphProcessor(BaseProcessor):
         }, id=document_id)
 
         # 5. Return result/success
-        return True
+        return stats
 
 
 def calculate_store_embeddings(context):
@@ -167,20 +214,11 @@ def full_document_process(context):
     # 2. Extract text for pdf using local path from download above
     paragraphs = extract_text(new_file_path)
 
-    # 3. For each paragraph, calculate embeddings and index text + embedding
-    for i, (text, p_no) in enumerate(paragraphs):
-        p_body = {
-            "text": text,
-            "embeddings": embedder.embed_paragraphs([text])[0],
-            "document_id": document_id,
-            "length": len(text),
-            "index": i,
-            "page_no": p_no + 1  # indexes at 0, pdf pages make more sense starting from 1
-        }
-
-        # TODO bulk prepare and bulk upload to speed up processing
-
-        es.index(index=PARAGRAPHS_INDEX, body=p_body, id=f"{document_id}-{i}")
+    # 3. Calculate embeddings and index text + embedding for all paragraphs
+    # page_no indexes at 0, pdf pages make more sense starting from 1
+    stats = embed_and_index_paragraphs(
+        document_id, [(text, p_no + 1) for text, p_no in paragraphs]
+    )
 
     # 4. Updated processed_at time on document
     es.update(index="documents", body={
@@ -190,4 +228,4 @@ def full_document_process(context):
     }, id=document_id)
 
     # 5. Return result/success
-    return True
+    return stats
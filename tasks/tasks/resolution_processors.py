@@ -5,21 +5,26 @@ from cartwright.analysis.time_resolution import (
     detect_temporal_resolution,
 )
 from cartwright.analysis.space_resolution import detect_latlon_resolution
-import pandas as pd
 
-from utils import job_setup
+from utils import job_dataframe
 
 temporal_resolutions = ["L", "S", "T", "H", "D", "W" "M", "Q", "Y"]
 
 
 def calculate_temporal_resolution(context, filename=None, **kwargs):
-    # Setup
-    file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    dataframe = pd.read_csv(file, delimiter=",")
-
     datetime_column = kwargs.get("datetime_column")
     time_format = kwargs.get("time_format")
 
+    # Setup
+    dataframe, filename, rawfile_path = job_dataframe(
+        context=context, filename=filename, columns=[datetime_column]
+    )
+
+    return temporal_resolution_result(dataframe, datetime_column, time_format)
+
+
+def temporal_resolution_result(dataframe, datetime_column, time_format):
+    """Temporal resolution of `datetime_column` of an already loaded dataset."""
     timestamps = convert_to_timestamps(
         dataframe[datetime_column].to_list(), time_format
     )
@@ -47,13 +52,19 @@ def calculate_temporal_resolution(context, filename=None, **kwargs):
 
 
 def calculate_geographical_resolution(context, filename=None, **kwargs):
-    # Setup
-    file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    dataframe = pd.read_csv(file, delimiter=",")
-
     latitude = kwargs.get("lat_column")
     longitude = kwargs.get("lon_column")
 
+    # Setup
+    dataframe, filename, rawfile_path = job_dataframe(
+        context=context, filename=filename, columns=[latitude, longitude]
+    )
+
+    return geographical_resolution_result(dataframe, latitude, longitude)
+
+
+def geographical_resolution_result(dataframe, latitude, longitude):
+    """Resolution of the `latitude` and `longitude` columns of an already loaded dataset."""
     lat = dataframe[latitude].to_numpy()
     lon = dataframe[longitude].to_numpy()
 
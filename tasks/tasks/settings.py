@@ -2,6 +2,8 @@ try:
     from pydantic_settings import BaseSettings
 except ImportError:
     from pydantic import BaseSettings
+import os
+import tempfile
 from typing import Optional
 
 class Settings(BaseSettings):
@@ -17,10 +19,43 @@ class Settings(BaseSettings):
 
     TERMINAL_ENDPOINT: str
 
+    REDIS_HOST: str = "redis.dojo-stack"
+    REDIS_PORT: int = 6379
+
     STORAGE_HOST: Optional[str] = ""
     AWS_ACCESS_KEY_ID: str = ""
     AWS_SECRET_ACCESS_KEY: str = ""
 
+    # Texts sent per request to the embeddings API
+    EMBEDDING_BATCH_SIZE: int = 100
+    # Documents per Elasticsearch bulk request, and how many times documents
+    # rejected by a bulk request are retried
+    ES_BULK_CHUNK_SIZE: int = 500
+    ES_BULK_MAX_RETRIES: int = 3
+
+    # Worker-local cache of files downloaded from S3, see FileCache in utils.py.
+    # 0 bytes disables it.
+    FILE_CACHE_DIR: str = os.path.join(tempfile.gettempdir(), "dojo-file-cache")
+    FILE_CACHE_MAX_BYTES: int = 2 * 1024 ** 3
+
+    # Preview runs of transformations on datasets with more rows than this
+    # are run on a sample of about this many rows, see transformation_preview.py
+    TRANSFORMATION_PREVIEW_SAMPLE_ROWS: int = 50000
+    TRANSFORMATION_PREVIEW_REPLICATES: int = 5
+
+    # Processes rescaling the files of a dataset in parallel, see
+    # rescale_files in elwood_processors.py. 1 rescales them in the job process.
+    RESCALE_WORKERS: int = min(4, os.cpu_count() or 1)
+
+    # Text embeddings cache, see api/src/embedding_cache.py. Redis entries take
+    # about 6KB each (float32 ada-002 embeddings): 10000 entries is about 60MB.
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 2048
+    EMBEDDING_CACHE_REDIS_MAX_ENTRIES: int = 10000
+    EMBEDDING_CACHE_TTL: int = 60 * 60 * 24 * 7
+    # Document paragraphs rarely repeat, so by default their embeddings are only
+    # cached in process rather than filling the shared Redis tier.
+    EMBEDDING_CACHE_PARAGRAPHS_IN_REDIS: bool = False
+
     class Config:
         case_sensitive = True
         env_file = ".env"
@@ -0,0 +1,106 @@
+"""
+Sampled previews of dataset transformations.
+
+Preview runs of the clip, scale and regrid transformations only need a
+glimpse of the output and its size. On large datasets the transformation is
+run on a stratified sample instead of the whole dataset, and the output row
+count is estimated from it.
+
+Sampling units are rows, or clusters of rows sharing the values of some
+columns for transformations that aggregate rows (e.g. every row of a
+location when rescaling time), so that sampled units are transformed exactly
+as in the full run. Units are sampled one per stratum of consecutive units,
+and split into a few disjoint replicates. The transformation runs once per
+replicate: the spread of the replicate estimates gives the error of the
+estimate (random groups variance estimator).
+"""
+import numpy as np
+import pandas as pd
+
+from settings import settings
+
+# Two sided 95% confidence interval
+Z_95 = 1.96
+
+
+def sample_replicates(
+    dataframe,
+    columns=None,
+    sample_rows=None,
+    replicates=None,
+    seed=0,
+):
+    """
+    Splits a stratified sample of about `sample_rows` rows of `dataframe`
+    into `replicates` disjoint samples.
+
+    Returns a list of (sample, units in sample) and the number of units in
+    `dataframe`, or None instead of the list when the dataset is small enough
+    to be transformed as a whole.
+    """
+    sample_rows = sample_rows or settings.TRANSFORMATION_PREVIEW_SAMPLE_ROWS
+    replicates = replicates or settings.TRANSFORMATION_PREVIEW_REPLICATES
+
+    if columns:
+        units = dataframe.groupby(columns, sort=False, dropna=False).ngroup().to_numpy()
+    else:
+        units = np.arange(len(dataframe))
+    total_units = int(units.max()) + 1 if len(units) else 0
+
+    sampled_units = max(replicates, round(total_units * sample_rows / max(len(dataframe), 1)))
+    if len(dataframe) <= sample_rows or sampled_units >= total_units:
+        return None, total_units
+
+    # One unit per stratum, strata being runs of consecutive units
+    rng = np.random.default_rng(seed)
+    edges = np.linspace(0, total_units, sampled_units + 1)
+    chosen = np.floor(edges[:-1] + rng.random(sampled_units) * np.diff(edges)).astype(int)
+
+    replicate_of = np.full(total_units, -1)
+    replicate_of[chosen] = np.arange(sampled_units) % replicates
+    row_replicates = replicate_of[units]
+
+    samples = [
+        (dataframe[row_replicates == replicate], int((replicate_of == replicate).sum()))
+        for replicate in range(replicates)
+    ]
+    return samples, total_units
+
+
+def estimate_total(counts, sampled_units, total_units):
+    """
+    Estimate of the total output rows from the output rows of each
+    replicate, and the half width of its 95% confidence interval.
+    """
+    estimates = np.array(
+        [count * total_units / units for count, units in zip(counts, sampled_units)],
+        dtype=float,
+    )
+    error = Z_95 * estimates.std(ddof=1) / np.sqrt(len(estimates)) if len(estimates) > 1 else 0.0
+    return int(round(estimates.mean())), int(round(error))
+
+
+def preview_transformation(transform, dataframe, columns=None):
+    """
+    Runs `transform` on a sample of `dataframe` (see sample_replicates).
+
+    Returns None when the whole dataset should be transformed, otherwise a
+    dict with the sampled output `dataframe`, the `estimate` of the output
+    rows of a full run, its `error` and the number of `sampled_rows`.
+    """
+    samples, total_units = sample_replicates(dataframe, columns=columns)
+    if samples is None:
+        return None
+
+    outputs = [transform(sample) for sample, _ in samples]
+    estimate, error = estimate_total(
+        [len(output.index) for output in outputs],
+        [units for _, units in samples],
+        total_units,
+    )
+    return {
+        "dataframe": pd.concat(outputs),
+        "estimate": estimate,
+        "error": error,
+        "sampled_rows": sum(len(sample.index) for sample, _ in samples),
+    }
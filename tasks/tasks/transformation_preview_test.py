@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+from transformation_preview import preview_transformation, sample_replicates
+
+
+def test_small_datasets_are_not_sampled():
+    dataframe = pd.DataFrame({"value": range(100)})
+    samples, total_units = sample_replicates(dataframe, sample_rows=1000, replicates=3)
+    assert samples is None
+    assert total_units == 100
+
+
+def test_replicates_are_disjoint_and_hold_whole_clusters():
+    dataframe = pd.DataFrame({
+        "geo": np.repeat(np.arange(200), 10),
+        "value": np.arange(2000),
+    })
+    samples, total_units = sample_replicates(
+        dataframe, columns=["geo"], sample_rows=300, replicates=3
+    )
+    assert total_units == 200
+    assert len(samples) == 3
+
+    seen = set()
+    for sample, units in samples:
+        assert not seen & set(sample.index)
+        seen |= set(sample.index)
+        sizes = sample.groupby("geo").size()
+        assert len(sizes) == units
+        assert (sizes == 10).all()
+
+
+def test_estimate_is_within_its_error():
+    rng = np.random.default_rng(1)
+    dataframe = pd.DataFrame({"value": rng.random(200000)})
+
+    def clip(sample):
+        return sample[sample["value"] < 0.3]
+
+    preview = preview_transformation(clip, dataframe)
+    assert preview["sampled_rows"] < len(dataframe)
+    assert abs(preview["estimate"] - len(clip(dataframe))) <= preview["error"]
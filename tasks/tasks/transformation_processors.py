@@ -1,5 +1,5 @@
-import io
 import json
+import logging
 import os
 import re
 import requests
@@ -10,21 +10,24 @@ import pandas as pd
 import numpy as np
 
 from utils import (
+    job_dataframe,
     job_setup,
-    put_rawfile,
+    put_csv,
+    read_csv_dataframe,
     persist_untransformed_file,
     rewrite_file,
     get_primary_time_format,
 )
 from elwood import elwood
 from settings import settings
+from transformation_preview import preview_transformation
 
 
 # Geo clipping transformation job
 def clip_geo(context, filename=None, **kwargs):
     # Setup
     file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
+    original_dataframe = read_csv_dataframe(rawfile_path)
     rows_pre_clip = len(original_dataframe.index)
 
     # Main Call
@@ -37,31 +40,36 @@ def clip_geo(context, filename=None, **kwargs):
         and "lat_column" in geo_columns
         and "lon_column" in geo_columns
     ):
-        clipped_df = elwood.clip_geo(
-            dataframe=original_dataframe,
-            geo_columns=geo_columns,
-            polygons_list=shape_list,
-        )
+        def clip(dataframe):
+            return elwood.clip_geo(
+                dataframe=dataframe,
+                geo_columns=geo_columns,
+                polygons_list=shape_list,
+            )
+
+        preview = kwargs.get("preview_run", False)
+
+        if preview:
+            sampled = preview_transformation(clip, original_dataframe)
+            if sampled:
+                return sampled_preview_response(
+                    "Geography clipped successfully", rows_pre_clip, sampled
+                )
+
+        clipped_df = clip(original_dataframe)
 
         print(f"CLIPPED GEO: {clipped_df}")
 
         json_dataframe_preview = clipped_df.head(100).to_json(default_handler=str)
         rows_post_clip = len(clipped_df.index)
 
-        preview = kwargs.get("preview_run", False)
-
         if not preview:
             # If the run is not a preview run, persist the transformation.
             file.seek(0)
             persist_untransformed_file(context["uuid"], filename, file)
 
             # Put the new clipped file to overwrite the old one.
-            file_buffer = io.BytesIO()
-
-            clipped_df.to_csv(file_buffer, index=False)
-            file_buffer.seek(0)
-
-            put_rawfile(path=rawfile_path, fileobj=file_buffer)
+            put_csv(rawfile_path, clipped_df)
 
             post_transformation_message(
                 context=context,
@@ -91,7 +99,7 @@ def clip_geo(context, filename=None, **kwargs):
 def clip_time(context, filename=None, **kwargs):
     # Setup
     file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
+    original_dataframe = read_csv_dataframe(rawfile_path)
     rows_pre_clip = len(original_dataframe.index)
 
     # Main Call
@@ -99,29 +107,34 @@ def clip_time(context, filename=None, **kwargs):
     time_ranges = kwargs.get("time_ranges", [])
 
     if time_column and time_ranges:
-        clipped_df = elwood.clip_dataframe_time(
-            dataframe=original_dataframe,
-            time_column=time_column,
-            time_ranges=time_ranges,
-        )
+        def clip(dataframe):
+            return elwood.clip_dataframe_time(
+                dataframe=dataframe,
+                time_column=time_column,
+                time_ranges=time_ranges,
+            )
+
+        preview = kwargs.get("preview_run", False)
+
+        if preview:
+            sampled = preview_transformation(clip, original_dataframe)
+            if sampled:
+                return sampled_preview_response(
+                    "Time clipped successfully", rows_pre_clip, sampled
+                )
+
+        clipped_df = clip(original_dataframe)
 
         json_dataframe_preview = clipped_df.head(100).to_json(default_handler=str)
         rows_post_clip = len(clipped_df.index)
 
-        preview = kwargs.get("preview_run", False)
-
         if not preview:
             # If the run is not a preview run, persist the transformation.
             file.seek(0)
             persist_untransformed_file(context["uuid"], filename, file)
 
             # Put the new clipped file to overwrite the old one.
-            file_buffer = io.BytesIO()
-
-            clipped_df.to_csv(file_buffer, index=False)
-            file_buffer.seek(0)
-
-            put_rawfile(path=rawfile_path, fileobj=file_buffer)
+            put_csv(rawfile_path, clipped_df)
 
             post_transformation_message(
                 context=context,
@@ -151,7 +164,7 @@ def clip_time(context, filename=None, **kwargs):
 def scale_time(context, filename=None, **kwargs):
     # Setup
     file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
+    original_dataframe = read_csv_dataframe(rawfile_path)
     rows_pre_clip = len(original_dataframe.index)
 
     time_format = get_primary_time_format(context)
@@ -163,14 +176,39 @@ def scale_time(context, filename=None, **kwargs):
     geo_columns = kwargs.get("geo_columns", None)
 
     if time_column and time_bucket and aggregation_list:
-        try:
+        def scale(dataframe):
             scaled_df = elwood.rescale_dataframe_time(
-                dataframe=original_dataframe,
+                dataframe=dataframe,
                 time_column=time_column,
                 time_bucket=time_bucket,
                 aggregation_functions=aggregation_list,
                 geo_columns=geo_columns,
             )
+
+            logging.debug(f"SCALED DF: {scaled_df}")
+
+            scaled_df[time_column] = pd.to_datetime(scaled_df[time_column])
+            scaled_df[time_column] = scaled_df[time_column].apply(
+                lambda x: x.strftime(time_format)
+            )
+            return scaled_df
+
+        preview = kwargs.get("preview_run", False)
+
+        try:
+            # Rows are aggregated per location, whole locations are sampled.
+            # Without locations every row goes into a time bucket, nothing can be sampled.
+            sampled = None
+            if preview and geo_columns:
+                sampled = preview_transformation(
+                    scale, original_dataframe, columns=list(geo_columns.values())
+                )
+            if sampled:
+                return sampled_preview_response(
+                    "Time rescaled successfully", rows_pre_clip, sampled
+                )
+
+            scaled_df = scale(original_dataframe)
         except ValueError as e:
             response = {
                 "message": f"Time not rescaled due to error: {str(e)}",
@@ -178,32 +216,18 @@ def scale_time(context, filename=None, **kwargs):
             }
             return response
 
-        print(f"SCALED DF: {scaled_df}")
-
-        scaled_df[time_column] = pd.to_datetime(scaled_df[time_column])
-        scaled_df[time_column] = scaled_df[time_column].apply(
-            lambda x: x.strftime(time_format)
-        )
-
         print(f"SCALED DF formatted: {scaled_df}")
 
         json_dataframe_preview = scaled_df.head(100).to_json(default_handler=str)
         rows_post_clip = len(scaled_df.index)
 
-        preview = kwargs.get("preview_run", False)
-
         if not preview:
             # If the run is not a preview run, persist the transformation.
             file.seek(0)
             persist_untransformed_file(context["uuid"], filename, file)
 
             # Put the new clipped file to overwrite the old one.
-            file_buffer = io.BytesIO()
-
-            scaled_df.to_csv(file_buffer, index=False)
-            file_buffer.seek(0)
-
-            put_rawfile(path=rawfile_path, fileobj=file_buffer)
+            put_csv(rawfile_path, scaled_df)
 
             post_transformation_message(
                 context=context,
@@ -232,7 +256,7 @@ def scale_time(context, filename=None, **kwargs):
 def regrid_geo(context, filename=None, **kwargs):
     # Setup
     file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
+    original_dataframe = read_csv_dataframe(rawfile_path)
     print(f"starting frame: {original_dataframe}")
     sys.stdout.flush()
     rows_pre_clip = len(original_dataframe.index)
@@ -247,41 +271,48 @@ def regrid_geo(context, filename=None, **kwargs):
     aggregation_functions = kwargs.get("aggregation_function_list")
 
     if geo_column and time_column and scale_multiplier:
-        regridded_df = elwood.regrid_dataframe_geo(
-            dataframe=original_dataframe,
-            geo_columns=geo_column,
-            time_column=time_column,
-            scale_multi=scale_multiplier,
-            scale=scale,
-            aggregation_functions=aggregation_functions,
-        )
+        def regrid(dataframe):
+            regridded_df = elwood.regrid_dataframe_geo(
+                dataframe=dataframe,
+                geo_columns=geo_column,
+                time_column=time_column,
+                scale_multi=scale_multiplier,
+                scale=scale,
+                aggregation_functions=aggregation_functions,
+            )
 
-        print(f"REGRIDDED DF: {regridded_df}")
+            logging.debug(f"REGRIDDED DF: {regridded_df}")
 
-        regridded_df[time_column] = pd.to_datetime(regridded_df[time_column])
-        regridded_df[time_column] = regridded_df[time_column].apply(
-            lambda x: x.strftime(time_format)
-        )
+            regridded_df[time_column] = pd.to_datetime(regridded_df[time_column])
+            regridded_df[time_column] = regridded_df[time_column].apply(
+                lambda x: x.strftime(time_format)
+            )
+            return regridded_df
+
+        preview = kwargs.get("preview_run", False)
+
+        if preview:
+            # Rows are aggregated per grid cell within each time step, whole time steps are sampled
+            sampled = preview_transformation(regrid, original_dataframe, columns=[time_column])
+            if sampled:
+                return sampled_preview_response(
+                    "Geography rescaled successfully", rows_pre_clip, sampled
+                )
+
+        regridded_df = regrid(original_dataframe)
 
         print(f"REGRIDDED DF formatted: {regridded_df}")
 
         json_dataframe_preview = regridded_df.head(100).to_json(default_handler=str)
         rows_post_clip = len(regridded_df.index)
 
-        preview = kwargs.get("preview_run", False)
-
         if not preview:
             # If the run is not a preview run, persist the transformation.
             file.seek(0)
             persist_untransformed_file(context["uuid"], filename, file)
 
             # Put the new clipped file to overwrite the old one.
-            file_buffer = io.BytesIO()
-
-            regridded_df.to_csv(file_buffer, index=False)
-            file_buffer.seek(0)
-
-            put_rawfile(path=rawfile_path, fileobj=file_buffer)
+            put_csv(rawfile_path, regridded_df)
 
             post_transformation_message(
                 context=context,
@@ -308,14 +339,15 @@ def regrid_geo(context, filename=None, **kwargs):
 
 
 def get_boundary_box(context, filename=None, **kwargs):
-    # Setup
-    file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
-
     # Main Call
     geo_columns = kwargs.get("geo_columns", {})
 
     if geo_columns and "lat_column" in geo_columns and "lon_column" in geo_columns:
+        original_dataframe, filename, rawfile_path = job_dataframe(
+            context=context,
+            filename=filename,
+            columns=[geo_columns["lat_column"], geo_columns["lon_column"]],
+        )
         boundary_dict = elwood.get_boundary_box(
             dataframe=original_dataframe,
             geo_columns=geo_columns,
@@ -335,14 +367,13 @@ def get_boundary_box(context, filename=None, **kwargs):
 
 
 def get_temporal_extent(context, filename=None, **kwargs):
-    # Setup
-    file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
-
     # Main call
     time_column = kwargs.get("datetime_column", "")
 
     if time_column:
+        original_dataframe, filename, rawfile_path = job_dataframe(
+            context=context, filename=filename, columns=[time_column]
+        )
         temporal_extent = elwood.get_temporal_boundary(
             dataframe=original_dataframe, time_column=time_column
         )
@@ -361,13 +392,13 @@ def get_temporal_extent(context, filename=None, **kwargs):
 
 
 def get_unique_dates(context, filename=None, **kwargs):
-    file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
-
     # Main call
     time_column = kwargs.get("datetime_column", "")
 
     if time_column:
+        original_dataframe, filename, rawfile_path = job_dataframe(
+            context=context, filename=filename, columns=[time_column]
+        )
         unique_dates = original_dataframe[time_column].unique()
         unique_dates = np.sort(unique_dates)
 
@@ -405,7 +436,7 @@ def restore_raw_file(context, filename=None, **kwargs):
 
 def get_dataframe_rows(context, filename=None):
     file, filename, rawfile_path = job_setup(context=context, filename=filename)
-    original_dataframe = pd.read_csv(file, delimiter=",")
+    original_dataframe = read_csv_dataframe(rawfile_path)
 
     file_size = os.fstat(file.fileno()).st_size
 
@@ -418,6 +449,20 @@ def get_dataframe_rows(context, filename=None):
     }
 
 
+def sampled_preview_response(message, rows_pre_clip, sampled):
+    """Response of a preview run transformed on a sample of the dataset."""
+    return {
+        "messsage": message,
+        "preview": sampled["dataframe"].head(100).to_json(default_handler=str),
+        "rows_pre_clip": rows_pre_clip,
+        "rows_post_clip": sampled["estimate"],
+        # Half width of the 95% confidence interval of rows_post_clip
+        "rows_post_clip_error": sampled["error"],
+        "sampled_rows": sampled["sampled_rows"],
+        "estimated": True,
+    }
+
+
 def post_transformation_message(context, message, prefix):
     # Get original description
     description = context["dataset"]["description"]
@@ -1,12 +1,22 @@
+import hashlib
+import io
 import os
-from collections import namedtuple
+from collections import Counter, namedtuple
 import re
+import shutil
+import struct
 import tempfile
+import time
 from urllib.parse import urlparse
 from typing import Optional
 
 import botocore
 import boto3
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from elasticsearch.helpers import BulkIndexError, streaming_bulk
 
 import logging
 
@@ -61,9 +71,155 @@ def normalize_file_info(url: str) -> Optional[S3FileInfo]:
         return None
 
 
+class FileCache:
+    """Disk-backed LRU cache of S3 objects, local to a worker host.
+
+    Entries are keyed by bucket, key and ETag: a file overwritten on S3 gets
+    a new ETag and thus a new entry. Entry file names start with a hash of
+    the bucket and key so every version of a key can be dropped at once when
+    it is overwritten. Recency is tracked with the files' modification time,
+    so the cache is shared by all the worker processes of a host.
+
+    Entries are handed out as open files: another process evicting an entry
+    doesn't break a reader that already opened it.
+    """
+
+    def __init__(self, directory, max_bytes, partial_timeout=3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Seconds after which a partial download is considered abandoned,
+        # e.g. by a killed work-horse
+        self.partial_timeout = partial_timeout
+        self.counters = Counter()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _prefix(self, bucket, key):
+        return hashlib.sha256(f"{bucket}\0{key}".encode("utf-8")).hexdigest()[:32]
+
+    def entry_path(self, bucket, key, etag):
+        version = hashlib.sha256(etag.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, f"{self._prefix(bucket, key)}-{version}")
+
+    def get(self, bucket, key, etag):
+        """The cached file opened for reading, None on a miss."""
+        path = self.entry_path(bucket, key, etag)
+        try:
+            os.utime(path)
+            fileobj = open(path, "rb")
+        except FileNotFoundError:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        return fileobj
+
+    def put(self, bucket, key, etag, download):
+        """Stores a file written by `download(fileobj)`, returns it opened
+        for reading."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.entry_path(bucket, key, etag)
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".partial", delete=False) as part:
+            try:
+                download(part)
+            except BaseException:
+                os.remove(part.name)
+                raise
+        # Atomic, so other processes never see a partial entry
+        os.replace(part.name, path)
+        # Opened before evicting, and kept out of this eviction, so it is
+        # readable even when larger than the whole cache
+        fileobj = open(path, "rb")
+        self.evict(keep=path)
+        return fileobj
+
+    def invalidate(self, bucket, key):
+        """Drops every cached version of `key`."""
+        prefix = self._prefix(bucket, key)
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith(prefix):
+                self._remove(name)
+                self.counters["invalidations"] += 1
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until under `max_bytes`, and
+        abandoned partial downloads. The entry at path `keep` is not removed."""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".partial"):
+                if now - stat.st_mtime > self.partial_timeout:
+                    self._remove(name)
+                continue
+            if path == keep:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            try:
+                total += os.path.getsize(keep)
+            except FileNotFoundError:
+                pass
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(name)
+            self.counters["evictions"] += 1
+            total -= size
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+
+file_cache = FileCache(settings.FILE_CACHE_DIR, settings.FILE_CACHE_MAX_BYTES)
+
+
+def cached_rawfile(file_info):
+    """Local copy of the S3 object opened for reading, downloaded if not
+    cached. None when the cache can't store it (e.g. disk full)."""
+    try:
+        etag = s3.head_object(Bucket=file_info.bucket, Key=file_info.path)["ETag"]
+    except botocore.exceptions.ClientError as error:
+        raise FileNotFoundError() from error
+
+    fileobj = file_cache.get(file_info.bucket, file_info.path, etag)
+    if fileobj is None:
+        try:
+            fileobj = file_cache.put(
+                file_info.bucket,
+                file_info.path,
+                etag,
+                lambda fileobj: s3.download_fileobj(
+                    Bucket=file_info.bucket, Key=file_info.path, Fileobj=fileobj
+                ),
+            )
+        except botocore.exceptions.ClientError as error:
+            raise FileNotFoundError() from error
+        except OSError as error:
+            logging.warning(f"File cache unavailable: {error}")
+            return None
+    logging.debug(f"File cache {dict(file_cache.counters)}")
+    return fileobj
+
+
 def get_rawfile(path):
     """Gets a file from a filepath
 
+    Files are served from the worker's file cache when enabled.
+
     Args:
         path (str): URI to file
 
@@ -76,6 +232,10 @@ def get_rawfile(path):
         file: a file-like object
     """
     file_info = normalize_file_info(path)
+    if file_cache.enabled:
+        raw_file = cached_rawfile(file_info)
+        if raw_file is not None:
+            return raw_file
     try:
         raw_file = tempfile.TemporaryFile()
         s3.download_fileobj(
@@ -96,10 +256,44 @@ def put_rawfile(path, fileobj):
     Raises:
         RuntimeError: If the path URI does not begin with 'file' or 's3'
         there is no handler for it yet.
+    Returns:
+        str: The ETag of the uploaded file.
     """
 
     file_info = normalize_file_info(path)
-    s3.put_object(Bucket=file_info.bucket, Key=file_info.path, Body=fileobj)
+    file_cache.invalidate(file_info.bucket, file_info.path)
+    return s3.put_object(Bucket=file_info.bucket, Key=file_info.path, Body=fileobj).get("ETag")
+
+
+def get_parquet_metadata(path):
+    """Reads the key-value metadata of a parquet file on S3 from its footer
+    only, with two range requests.
+
+    Args:
+        path (str): URI to a parquet file
+
+    Raises:
+        FileNotFoundError: If the file cannnot be found on S3.
+
+    Returns:
+        dict: The arrow schema metadata, bytes keys and values.
+    """
+    file_info = normalize_file_info(path)
+    try:
+        # File ends with the footer length (4 bytes, little endian) and "PAR1"
+        tail = s3.get_object(
+            Bucket=file_info.bucket, Key=file_info.path, Range="bytes=-8"
+        )["Body"].read()
+        footer_length = struct.unpack("<I", tail[:4])[0]
+        footer = s3.get_object(
+            Bucket=file_info.bucket, Key=file_info.path, Range=f"bytes=-{footer_length + 8}"
+        )["Body"].read()
+    except botocore.exceptions.ClientError as error:
+        raise FileNotFoundError() from error
+
+    # The footer alone, behind the leading magic bytes, is a readable parquet file schema
+    parquet_file = pq.ParquetFile(pa.BufferReader(b"PAR1" + footer))
+    return parquet_file.schema_arrow.metadata or {}
 
 
 def list_files(path):
@@ -133,6 +327,13 @@ def download_rawfile(path, filename):
     logging.warn(path)
     logging.warn(file_info)
 
+    if file_cache.enabled:
+        raw_file = cached_rawfile(file_info)
+        if raw_file is not None:
+            with raw_file, open(filename, "wb") as local_file:
+                shutil.copyfileobj(raw_file, local_file)
+            return True
+
     try:
         s3.download_file(file_info.bucket, file_info.path, filename)
     except botocore.exceptions.ClientError as error:
@@ -163,15 +364,159 @@ def rewrite_file(origin_file_path, target_file_path):
     try:
         file = get_rawfile(origin_file_path)
 
-        put_rawfile(target_file_path, file)
+        etag = put_rawfile(target_file_path, file)
+        if target_file_path.endswith(".csv"):
+            file.seek(0)
+            put_csv_sidecar(target_file_path, pd.read_csv(file, delimiter=","), etag)
         return "File rewritten", True
     except FileNotFoundError as error:
         return "File not found, nothing was changed", False
 
 
+# CSV SIDECARS
+# Each dataset CSV is stored along with a parquet copy of its parsed content
+# (`raw_data.csv.parquet` for `raw_data.csv`), so jobs load typed columns
+# instead of parsing the CSV again. The sidecar records the ETag of the CSV it
+# was parsed from: a CSV written without updating its sidecar makes the
+# sidecar stale, and it is then rebuilt on the next read.
+
+SIDECAR_ETAG_KEY = b"dojo.source_etag"
+
+
+def sidecar_path(csv_path):
+    return f"{csv_path}.parquet"
+
+
+def put_csv_sidecar(csv_path, dataframe, etag):
+    """Stores the parsed `dataframe` of the CSV at `csv_path` (version `etag`)."""
+    if etag is None:
+        return
+    try:
+        table = pa.Table.from_pandas(dataframe, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), SIDECAR_ETAG_KEY: etag.encode("utf-8")}
+        )
+        buffer = pa.BufferOutputStream()
+        pq.write_table(table, buffer)
+        put_rawfile(sidecar_path(csv_path), io.BytesIO(buffer.getvalue().to_pybytes()))
+    except (pa.ArrowException, ValueError) as error:
+        # e.g. columns mixing numbers and strings, jobs keep reading the CSV
+        logging.warning(f"No parquet sidecar for {csv_path}: {error}")
+
+
+def put_csv(csv_path, dataframe):
+    """Writes `dataframe` as the CSV at `csv_path`, along with its sidecar."""
+    buffer = io.BytesIO()
+    dataframe.to_csv(buffer, index=False)
+    buffer.seek(0)
+    etag = put_rawfile(path=csv_path, fileobj=buffer)
+    # Parsed back so that the sidecar holds the types jobs would read
+    buffer.seek(0)
+    put_csv_sidecar(csv_path, pd.read_csv(buffer, delimiter=","), etag)
+
+
+def read_csv_dataframe(csv_path, columns=None):
+    """Loads a dataset CSV, only `columns` when given.
+
+    Reads the parquet sidecar when it is up to date with the CSV, otherwise
+    parses the CSV and rebuilds the sidecar.
+    """
+    file_info = normalize_file_info(csv_path)
+    try:
+        etag = s3.head_object(Bucket=file_info.bucket, Key=file_info.path)["ETag"]
+    except botocore.exceptions.ClientError as error:
+        raise FileNotFoundError() from error
+
+    try:
+        parquet_file = pq.ParquetFile(get_rawfile(sidecar_path(csv_path)))
+        metadata = parquet_file.schema_arrow.metadata or {}
+        if metadata.get(SIDECAR_ETAG_KEY, b"").decode("utf-8") == etag:
+            dataframe = parquet_file.read(columns=columns).to_pandas()
+            # Missing values of text columns are NaN in read_csv, not None
+            for column in dataframe.columns[dataframe.dtypes == object]:
+                dataframe[column] = dataframe[column].where(dataframe[column].notna(), np.nan)
+            return dataframe
+    except (FileNotFoundError, pa.ArrowException):
+        pass
+
+    dataframe = pd.read_csv(get_rawfile(csv_path), delimiter=",")
+    put_csv_sidecar(csv_path, dataframe, etag)
+    return dataframe[columns] if columns is not None else dataframe
+
+
+# ELASTICSEARCH UTILS
+def retryable_bulk_error(item):
+    """Whether a document that failed to index may succeed when sent again:
+    rejected by a busy cluster (429), server errors, or bulk requests that
+    failed altogether (no HTTP status)."""
+    status = next(iter(item.values()), {}).get("status")
+    return not isinstance(status, int) or status == 429 or status >= 500
+
+
+def bulk_index(es, actions, chunk_size=None, max_retries=None):
+    """Writes documents to elasticsearch with bulk requests.
+
+    Documents rejected by a bulk request (e.g. 429 on a busy cluster) are
+    retried with exponential backoff, without resending the ones that
+    succeeded. Documents elasticsearch refuses (e.g. mapping errors) are not
+    retried.
+
+    Args:
+        es (Elasticsearch): client to write with.
+        actions (list): bulk actions, e.g. {"_index", "_id", "_source"} dicts.
+        chunk_size (int): documents per bulk request.
+        max_retries (int): times failed documents are retried.
+
+    Raises:
+        BulkIndexError: If some documents still fail after all retries.
+
+    Returns:
+        int: number of documents written.
+    """
+    chunk_size = chunk_size or settings.ES_BULK_CHUNK_SIZE
+    max_retries = settings.ES_BULK_MAX_RETRIES if max_retries is None else max_retries
+
+    pending = list(actions)
+    written = 0
+    rejected = []
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        errors = []
+        failed = []
+        results = streaming_bulk(
+            es,
+            pending,
+            chunk_size=chunk_size,
+            max_retries=0,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+        # Without internal retries results come back in the order of actions
+        for action, (ok, item) in zip(pending, results):
+            if ok:
+                written += 1
+            elif retryable_bulk_error(item):
+                failed.append(action)
+                errors.append(item)
+            else:
+                rejected.append(item)
+        if not failed:
+            break
+        logging.warning(
+            f"{len(failed)} of {len(pending)} documents failed to index "
+            f"(attempt {attempt + 1} of {max_retries + 1})"
+        )
+        pending = failed
+
+    errors = rejected + errors
+    if errors:
+        raise BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+    return written
+
+
 # RQ JOB UTILS
-def job_setup(context, filename):
-    # Setup
+def job_rawfile_path(context, filename):
     # If no filename is passed in, default to the converted raw_data file.
     if filename is None:
         filename = "raw_data.csv"
@@ -180,12 +525,25 @@ def job_setup(context, filename):
     if not filename.endswith(".csv"):
         filename = filename.split(".")[0] + ".csv"
 
-    rawfile_path = os.path.join(DATASET_STORAGE_BASE_URL, context["uuid"], filename)
+    return filename, os.path.join(DATASET_STORAGE_BASE_URL, context["uuid"], filename)
+
+
+def job_setup(context, filename):
+    # Setup
+    filename, rawfile_path = job_rawfile_path(context, filename)
     file = get_rawfile(rawfile_path)
 
     return file, filename, rawfile_path
 
 
+def job_dataframe(context, filename, columns=None):
+    """Like job_setup, loading the dataset (only `columns` when given) instead."""
+    filename, rawfile_path = job_rawfile_path(context, filename)
+    dataframe = read_csv_dataframe(rawfile_path, columns=columns)
+
+    return dataframe, filename, rawfile_path
+
+
 def get_primary_time_format(context):
     annotations = context.get("annotations").get("annotations")
 
@@ -0,0 +1,209 @@
+import hashlib
+import io
+import os
+
+import botocore
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from elasticsearch.helpers import BulkIndexError
+
+import utils
+from utils import FileCache
+
+
+def write(data):
+    return lambda fileobj: fileobj.write(data)
+
+
+def test_file_cache_miss_then_hit(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1024)
+    assert cache.get("bucket", "key", '"v1"') is None
+
+    with cache.put("bucket", "key", '"v1"', write(b"data")) as fileobj:
+        assert fileobj.read() == b"data"
+    with cache.get("bucket", "key", '"v1"') as fileobj:
+        assert fileobj.read() == b"data"
+    assert cache.counters["misses"] == 1
+    assert cache.counters["hits"] == 1
+
+
+def test_file_cache_etag_change(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1024)
+    cache.put("bucket", "key", '"v1"', write(b"old")).close()
+    assert cache.get("bucket", "key", '"v2"') is None
+
+
+def test_file_cache_invalidate(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1024)
+    cache.put("bucket", "key", '"v1"', write(b"one")).close()
+    cache.put("bucket", "key", '"v2"', write(b"two")).close()
+    cache.put("bucket", "other", '"v1"', write(b"other")).close()
+
+    cache.invalidate("bucket", "key")
+    assert cache.get("bucket", "key", '"v1"') is None
+    assert cache.get("bucket", "key", '"v2"') is None
+    cache.get("bucket", "other", '"v1"').close()
+
+
+def test_file_cache_evicts_least_recently_used(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=25)
+    cache.put("bucket", "a", '"v1"', write(b"a" * 10)).close()
+    cache.put("bucket", "b", '"v1"', write(b"b" * 10)).close()
+    os.utime(cache.entry_path("bucket", "a", '"v1"'), (1, 1))
+    os.utime(cache.entry_path("bucket", "b", '"v1"'), (2, 2))
+
+    cache.put("bucket", "c", '"v1"', write(b"c" * 10)).close()
+    assert cache.get("bucket", "a", '"v1"') is None
+    cache.get("bucket", "b", '"v1"').close()
+    cache.get("bucket", "c", '"v1"').close()
+
+
+def test_file_cache_oversize_entry(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=10)
+    cache.put("bucket", "small", '"v1"', write(b"s" * 5)).close()
+
+    with cache.put("bucket", "big", '"v1"', write(b"b" * 100)) as fileobj:
+        assert fileobj.read() == b"b" * 100
+    assert cache.get("bucket", "small", '"v1"') is None
+
+
+def test_file_cache_sweeps_abandoned_partials(tmp_path):
+    cache = FileCache(str(tmp_path), max_bytes=1024, partial_timeout=60)
+    abandoned = tmp_path / "abandoned.partial"
+    abandoned.write_bytes(b"x")
+    os.utime(abandoned, (1, 1))
+    in_progress = tmp_path / "in-progress.partial"
+    in_progress.write_bytes(b"x")
+
+    cache.evict()
+    assert not abandoned.exists()
+    assert in_progress.exists()
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.downloads = []
+
+    def _object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+            )
+        return self.objects[(Bucket, Key)]
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": self._object(Bucket, Key)[1]}
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        self.downloads.append(Key)
+        Fileobj.write(self._object(Bucket, Key)[0])
+
+    def put_object(self, Bucket, Key, Body):
+        data = Body.read() if hasattr(Body, "read") else Body
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        self.objects[(Bucket, Key)] = (data, etag)
+        return {"ETag": etag}
+
+
+MIXED_CSV = b"""id,name,value,date
+1,a,1.5,2020-01-01
+2,,,2020-01-02
+3,c,3.25,
+"""
+
+
+@pytest.fixture
+def fake_s3(monkeypatch, tmp_path):
+    s3 = FakeS3()
+    monkeypatch.setattr(utils, "s3", s3)
+    monkeypatch.setattr(utils, "file_cache", FileCache(str(tmp_path), max_bytes=0))
+    return s3
+
+
+def test_read_csv_dataframe_from_sidecar(fake_s3):
+    path = "s3://datasets/uuid/raw_data.csv"
+    utils.put_csv(path, pd.read_csv(io.BytesIO(MIXED_CSV)))
+
+    dataframe = utils.read_csv_dataframe(path)
+    pd.testing.assert_frame_equal(dataframe, pd.read_csv(io.BytesIO(MIXED_CSV)))
+    assert fake_s3.downloads == ["uuid/raw_data.csv.parquet"]
+
+    pd.testing.assert_frame_equal(
+        utils.read_csv_dataframe(path, columns=["name", "date"]),
+        pd.read_csv(io.BytesIO(MIXED_CSV))[["name", "date"]],
+    )
+
+
+def test_read_csv_dataframe_rebuilds_stale_sidecar(fake_s3):
+    path = "s3://datasets/uuid/raw_data.csv"
+    utils.put_csv(path, pd.read_csv(io.BytesIO(MIXED_CSV)))
+    # CSV overwritten without its sidecar
+    etag = fake_s3.put_object("datasets", "uuid/raw_data.csv", b"id,name\n7,g\n")["ETag"]
+
+    pd.testing.assert_frame_equal(
+        utils.read_csv_dataframe(path), pd.DataFrame({"id": [7], "name": ["g"]})
+    )
+    sidecar = pq.ParquetFile(io.BytesIO(fake_s3.objects[("datasets", "uuid/raw_data.csv.parquet")][0]))
+    assert sidecar.schema_arrow.metadata[utils.SIDECAR_ETAG_KEY] == etag.encode("utf-8")
+
+
+def test_read_csv_dataframe_without_sidecar(fake_s3):
+    path = "s3://datasets/uuid/raw_data.csv"
+    fake_s3.put_object("datasets", "uuid/raw_data.csv", MIXED_CSV)
+    # Columns mixing numbers and strings can't be stored as parquet
+    utils.put_csv_sidecar(path, pd.DataFrame({"mixed": [1, "a"]}), '"v1"')
+    assert ("datasets", "uuid/raw_data.csv.parquet") not in fake_s3.objects
+
+    pd.testing.assert_frame_equal(
+        utils.read_csv_dataframe(path, columns=["value"]),
+        pd.read_csv(io.BytesIO(MIXED_CSV))[["value"]],
+    )
+
+
+def stub_streaming_bulk(responses):
+    """streaming_bulk answering each call with the next {id: status} of
+    `responses`, 201 for documents left out."""
+    calls = []
+
+    def streaming_bulk(es, actions, **kwargs):
+        statuses = responses[len(calls)]
+        calls.append([action["_id"] for action in actions])
+        for action in actions:
+            status = statuses.get(action["_id"], 201)
+            yield status < 300, {"index": {"_id": action["_id"], "status": status}}
+
+    return streaming_bulk, calls
+
+
+def test_bulk_index_retries_rejected_documents(monkeypatch):
+    streaming_bulk, calls = stub_streaming_bulk([{"b": 429, "c": 503}, {"c": 429}, {}])
+    monkeypatch.setattr(utils, "streaming_bulk", streaming_bulk)
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+
+    actions = [{"_index": "test", "_id": _id} for _id in "abc"]
+    assert utils.bulk_index(None, actions, max_retries=3) == 3
+    assert calls == [["a", "b", "c"], ["b", "c"], ["c"]]
+
+
+def test_bulk_index_fails_fast_on_invalid_documents(monkeypatch):
+    streaming_bulk, calls = stub_streaming_bulk([{"b": 400, "c": 429}, {}])
+    monkeypatch.setattr(utils, "streaming_bulk", streaming_bulk)
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+
+    actions = [{"_index": "test", "_id": _id} for _id in "abc"]
+    with pytest.raises(BulkIndexError) as error:
+        utils.bulk_index(None, actions, max_retries=3)
+    assert calls == [["a", "b", "c"], ["c"]]
+    assert [item["index"]["_id"] for item in error.value.errors] == ["b"]
+
+
+def test_bulk_index_gives_up_after_max_retries(monkeypatch):
+    streaming_bulk, calls = stub_streaming_bulk([{"a": 429}] * 3)
+    monkeypatch.setattr(utils, "streaming_bulk", streaming_bulk)
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+
+    with pytest.raises(BulkIndexError):
+        utils.bulk_index(None, [{"_index": "test", "_id": "a"}], max_retries=2)
+    assert len(calls) == 3